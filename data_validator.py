@@ -7,9 +7,12 @@ from enum import Enum
 from pathlib import Path
 from typing import List, Optional, Dict, Any
 
+import numpy as np
 from PIL import Image
 from jsonschema import validate, ValidationError as JsonSchemaValidationError
 
+from db_serializer import load_profile_catalog
+
 
 # -------------------------
 # Configuration & Constants
@@ -29,6 +32,25 @@ LOGO_MIN_SIZE = 100
 LOGO_MAX_SIZE = 400
 SNAKE_CASE_PATTERN = re.compile(r'^[a-z0-9]+(?:_[a-z0-9]+)*$')
 
+# The values checked by the StatisticsValidator, mapped to their hard plausibility bounds (inclusive) and the
+# smallest spread (MAD) assumed for a material, so groups that nearly all share one value don't flag normal variation
+STATISTIC_FIELDS = {
+    "density":                 (0.7, 15.0, 0.03),
+    "diameter_tolerance":      (0.0, 0.2, 0.02),
+    "max_dry_temperature":     (30, 150, 5),
+    "nozzle_temp":             (150, 500, 5),
+    "first_layer_nozzle_temp": (150, 500, 5),
+    "bed_temp":                (0, 160, 5),
+    "first_layer_bed_temp":    (0, 160, 5),
+    "empty_spool_weight":      (10, 2000, 50),
+    "spool_core_diameter":     (20, 250, 15),
+}
+STANDARD_DIAMETERS = (1.75, 2.85, 3.0)
+# Modified z-score above which a value is an outlier within its material (Iglewicz and Hoaglin)
+OUTLIER_Z_SCORE = 3.5
+# Minimum number of values a material needs before its distribution is trusted
+OUTLIER_MIN_SAMPLES = 5
+
 
 # -------------------------
 # Data Classes
@@ -374,6 +396,198 @@ class GTINValidator(BaseValidator):
         return result
 
 
+class StatisticsValidator(BaseValidator):
+    """Flags implausible values by comparing them to the distribution of their material."""
+
+    GENERIC_FIELDS = ("nozzle_temp", "first_layer_nozzle_temp", "bed_temp", "first_layer_bed_temp")
+
+    def __init__(self, schema_cache: Optional[SchemaCache] = None):
+        super().__init__(schema_cache)
+        # field -> [(group, value, path, location)], grouped by material
+        self._samples: Dict[str, List[tuple]] = {}
+        # (filament folder, diameter) -> [(path, location)], used to find diameters only one variant uses
+        self._diameters: Dict[Path, Dict[float, List[tuple]]] = {}
+
+    def _add_sample(self, field_name: str, material: str, value: Any, path: Path, location: str) -> None:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        self._samples.setdefault(field_name, []).append((material, float(value), path, location))
+
+    def _add_generic(self, material: str, slicer_settings: Any, path: Path, key: str) -> None:
+        if not isinstance(slicer_settings, dict) or not isinstance(slicer_settings.get("generic"), dict):
+            return
+        generic = slicer_settings["generic"]
+        for field_name in self.GENERIC_FIELDS:
+            self._add_sample(field_name, material, generic.get(field_name), path, f"{key}.generic.{field_name}")
+
+    def collect(self, data_dir: Path) -> None:
+        """Gather every checked value in the data folder, files that fail to load are reported by the JsonValidator"""
+        for brand_entry in os.scandir(data_dir):
+            if not brand_entry.is_dir():
+                continue
+            for material_entry in os.scandir(brand_entry.path):
+                if not material_entry.is_dir():
+                    continue
+                material_path = Path(material_entry.path, "material.json")
+                material_data = load_json(material_path) or {}
+                material = str(material_data.get("material", material_entry.name)).upper()
+                self._add_sample("max_dry_temperature", material, material_data.get("default_max_dry_temperature"),
+                                 material_path, "default_max_dry_temperature")
+                self._add_generic(material, material_data.get("default_slicer_settings"), material_path,
+                                  "default_slicer_settings")
+
+                for filament_entry in os.scandir(material_entry.path):
+                    if filament_entry.is_dir():
+                        self._collect_filament(Path(filament_entry.path), material)
+
+    def _collect_filament(self, filament_dir: Path, material: str) -> None:
+        filament_path = filament_dir / "filament.json"
+        filament_data = load_json(filament_path) or {}
+        for field_name in ("density", "diameter_tolerance", "max_dry_temperature"):
+            self._add_sample(field_name, material, filament_data.get(field_name), filament_path, field_name)
+        self._add_generic(material, filament_data.get("slicer_settings"), filament_path, "slicer_settings")
+
+        diameters = self._diameters.setdefault(filament_dir, {})
+        for variant_entry in os.scandir(filament_dir):
+            if not variant_entry.is_dir():
+                continue
+            sizes_path = Path(variant_entry.path, "sizes.json")
+            sizes_data = load_json(sizes_path)
+            if not isinstance(sizes_data, list):
+                continue
+            for idx, size in enumerate(sizes_data):
+                if not isinstance(size, dict):
+                    continue
+                # Spools scale with the amount of filament on them, so they're compared per material and weight
+                weight = size.get("filament_weight", 1000)
+                spool_group = f"{material} {weight:g}g" if isinstance(weight, (int, float)) else material
+                for field_name in ("empty_spool_weight", "spool_core_diameter"):
+                    self._add_sample(field_name, spool_group, size.get(field_name), sizes_path,
+                                     f"$[{idx}].{field_name}")
+                diameter = size.get("diameter", 1.75)
+                if isinstance(diameter, (int, float)) and diameter > 0:
+                    diameters.setdefault(float(diameter), []).append((sizes_path, f"$[{idx}]"))
+
+    @staticmethod
+    def _group_medians(groups: np.ndarray, values: np.ndarray, group_count: int) -> np.ndarray:
+        """The median of every group, computed in a single sort"""
+        order = np.lexsort((values, groups))
+        sorted_values = values[order]
+        counts = np.bincount(groups, minlength=group_count)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        lower = starts + (np.maximum(counts, 1) - 1) // 2
+        upper = starts + np.maximum(counts, 1) // 2
+        lower = np.minimum(lower, len(values) - 1)
+        upper = np.minimum(upper, len(values) - 1)
+        return (sorted_values[lower] + sorted_values[upper]) / 2
+
+    def _check_field(self, field_name: str, samples: List[tuple], result: ValidationResult) -> None:
+        groups, group_ids = np.unique([x[0] for x in samples], return_inverse=True)
+        values = np.array([x[1] for x in samples], dtype=np.float64)
+        low, high, min_mad = STATISTIC_FIELDS[field_name]
+
+        medians = self._group_medians(group_ids, values, len(groups))
+        deviations = np.abs(values - medians[group_ids])
+        mads = self._group_medians(group_ids, deviations, len(groups))
+        mads = np.maximum(mads, min_mad)
+        counts = np.bincount(group_ids, minlength=len(groups))
+
+        z_scores = 0.6745 * deviations / mads[group_ids]
+        out_of_bounds = (values < low) | (values > high)
+        outliers = ~out_of_bounds & (counts[group_ids] >= OUTLIER_MIN_SAMPLES) & (z_scores > OUTLIER_Z_SCORE)
+
+        for idx in np.flatnonzero(out_of_bounds | outliers):
+            group, value, path, location = samples[idx]
+            if out_of_bounds[idx]:
+                message = f"{location} = {value:g} is outside the plausible range {low:g}-{high:g}"
+            else:
+                message = (f"{location} = {value:g} is an outlier for {group} "
+                           f"(median {medians[group_ids[idx]]:g} over {counts[group_ids[idx]]} values)")
+            result.add_error(ValidationError(
+                level=ValidationLevel.WARNING,
+                category="Statistics",
+                message=message,
+                path=path
+            ))
+
+    def _check_diameters(self, result: ValidationResult) -> None:
+        """Flag non standard diameters, and a diameter that only one variant of an otherwise uniform filament uses"""
+        for filament_dir, diameters in self._diameters.items():
+            variants = {diameter: {x[0] for x in entries} for diameter, entries in diameters.items()}
+            variant_count = len(set().union(*variants.values())) if variants else 0
+            dominant = max(variants, key=lambda x: len(variants[x]), default=None)
+
+            for diameter, entries in diameters.items():
+                if not any(abs(diameter - x) < 0.05 for x in STANDARD_DIAMETERS):
+                    for path, location in entries:
+                        result.add_error(ValidationError(
+                            level=ValidationLevel.WARNING,
+                            category="Statistics",
+                            message=f"{location}.diameter = {diameter:g} is not a standard filament diameter",
+                            path=path
+                        ))
+                elif (diameter != dominant and len(variants[diameter]) == 1 and variant_count >= OUTLIER_MIN_SAMPLES
+                      and len(variants[dominant]) >= 0.8 * variant_count):
+                    for path, location in entries:
+                        result.add_error(ValidationError(
+                            level=ValidationLevel.WARNING,
+                            category="Statistics",
+                            message=(f"{location}.diameter = {diameter:g} but {len(variants[dominant])} of "
+                                     f"{variant_count} variants of this filament come in {dominant:g} mm"),
+                            path=path
+                        ))
+
+    def validate_statistics(self, data_dir: Path) -> ValidationResult:
+        """Compare every numeric property to its per-material distribution and report outliers as warnings"""
+        result = ValidationResult()
+        self._samples.clear()
+        self._diameters.clear()
+        self.collect(data_dir)
+
+        for field_name, samples in sorted(self._samples.items()):
+            self._check_field(field_name, samples, result)
+        self._check_diameters(result)
+        return result
+
+
+class ProfileReferenceValidator(BaseValidator):
+    """Validates that the slicer profiles referenced by slicer_settings exist in the profile catalog."""
+
+    SLICERS = ("prusaslicer", "bambustudio", "orcaslicer", "cura")
+
+    def validate_profile_references(self, data_dir: Path, profiles_dir: Path) -> ValidationResult:
+        """Check the profile_name of every slicer in material.json and filament.json files."""
+        result = ValidationResult()
+        catalog = load_profile_catalog(profiles_dir)
+
+        # Materials store their settings as the defaults of their filaments
+        json_files = [(x, "default_slicer_settings") for x in data_dir.glob("*/*/material.json")]
+        json_files += [(x, "slicer_settings") for x in data_dir.glob("*/*/*/filament.json")]
+        for json_file, settings_key in sorted(json_files):
+            data = load_json(json_file)
+            slicer_settings = data.get(settings_key) if isinstance(data, dict) else None
+            if not isinstance(slicer_settings, dict):
+                continue
+
+            for slicer in self.SLICERS:
+                settings = slicer_settings.get(slicer)
+                if not isinstance(settings, dict) or not isinstance(settings.get("profile_name"), str):
+                    continue
+                # Profiles aren't loaded for every slicer yet, only check slicers the catalog has profiles for
+                if slicer not in catalog.slicers:
+                    continue
+                profile_name = settings["profile_name"]
+                if not catalog.find(slicer, profile_name):
+                    result.add_error(ValidationError(
+                        level=ValidationLevel.WARNING,
+                        category="Profile",
+                        message=f"Unknown {slicer} profile '{profile_name}' at {settings_key}.{slicer}.profile_name",
+                        path=json_file
+                    ))
+
+        return result
+
+
 class MissingFileValidator(BaseValidator):
     """Validates that required JSON files exist."""
 
@@ -720,9 +934,11 @@ class ValidationOrchestrator:
 
     def __init__(self, data_dir: Path = Path("./data"),
                  stores_dir: Path = Path("./stores"),
-                 max_workers: Optional[int] = None):
+                 max_workers: Optional[int] = None,
+                 profiles_dir: Path = Path("./profiles")):
         self.data_dir = data_dir
         self.stores_dir = stores_dir
+        self.profiles_dir = profiles_dir
         self.max_workers = max_workers
         self.schema_cache = SchemaCache()
 
@@ -784,6 +1000,18 @@ class ValidationOrchestrator:
         validator = GTINValidator(self.schema_cache)
         return validator.validate_gtin_ean(self.data_dir)
 
+    def validate_statistics(self) -> ValidationResult:
+        """Flag statistical outliers as warnings."""
+        print("Validating value statistics...")
+        validator = StatisticsValidator(self.schema_cache)
+        return validator.validate_statistics(self.data_dir)
+
+    def validate_profile_references(self) -> ValidationResult:
+        """Validate slicer profile references."""
+        print("Validating slicer profile references...")
+        validator = ProfileReferenceValidator(self.schema_cache)
+        return validator.validate_profile_references(self.data_dir, self.profiles_dir)
+
     def validate_all(self) -> ValidationResult:
         """Run all validations."""
         result = ValidationResult()
@@ -798,6 +1026,8 @@ class ValidationOrchestrator:
         result.merge(self.validate_folder_names())
         result.merge(self.validate_store_ids())
         result.merge(self.validate_gtin())
+        result.merge(self.validate_statistics())
+        result.merge(self.validate_profile_references())
 
         return result
 
@@ -815,6 +1045,10 @@ def main():
     parser.add_argument("--folder-names", action="store_true",
                         help="Validate folder names")
     parser.add_argument("--store-ids", action="store_true", help="Validate store IDs")
+    parser.add_argument("--stats", action="store_true",
+                        help="Flag values that are outliers for their material (warnings only)")
+    parser.add_argument("--profiles", action="store_true",
+                        help="Check that referenced slicer profiles exist (warnings only)")
 
     args = parser.parse_args()
 
@@ -834,6 +1068,10 @@ def main():
             result.merge(orchestrator.validate_folder_names())
         if args.store_ids:
             result.merge(orchestrator.validate_store_ids())
+        if args.stats:
+            result.merge(orchestrator.validate_statistics())
+        if args.profiles:
+            result.merge(orchestrator.validate_profile_references())
 
     # Print results
     if result.errors:
@@ -851,9 +1089,14 @@ def main():
             for error in errors:
                 print(f"  {error}")
 
+    # Warnings are reported but don't fail the validation
+    if not result.is_valid:
         print(
             f"\nValidation failed: {result.error_count} errors, {result.warning_count} warnings")
         exit(1)
+    elif result.errors:
+        print(f"\nValidation passed with {result.warning_count} warnings")
+        exit(0)
     else:
         print("All validations passed!")
         exit(0)
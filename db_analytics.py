@@ -0,0 +1,718 @@
+import json
+from pathlib import Path
+from typing import Optional, NamedTuple, Any
+
+import numpy as np
+
+import db_serializer
+from db_index import IDENTIFIER_FIELDS, GTIN_FIELDS, normalize_gtin, location_codes
+from db_serializer import Brand, Material, Filament, FilamentVariant, PathLike, cleanse_folder_name, \
+    normalize_locations, load_brands_cached
+
+COLUMNS_VERSION = 1
+COLUMNS_META_FILE = "meta.json"
+
+# Float columns, missing values are stored as NaN
+SIZE_FLOAT_COLUMNS = [
+    "filament_weight",
+    "diameter",
+    "empty_spool_weight",
+    "spool_core_diameter",
+    "density",
+    "diameter_tolerance",
+    "max_dry_temperature",
+    "first_layer_bed_temp",
+    "first_layer_nozzle_temp",
+    "bed_temp",
+    "nozzle_temp"
+]
+
+# Boolean columns, missing values are stored as False
+SIZE_BOOL_COLUMNS = [
+    "size_discontinued",
+    "variant_discontinued",
+    "filament_discontinued",
+    "discontinued"
+]
+
+# Integer columns that index into the dictionary with the same name (without the "_id" suffix)
+SIZE_CODE_COLUMNS = [
+    "brand_id",
+    "material_id",
+    "filament_id",
+    "variant_id"
+]
+
+
+# ---------------------------------
+# Columnar Snapshot
+# ---------------------------------
+
+class CatalogColumns:
+    """
+    A struct-of-arrays view of every FilamentSize in the database
+
+    Each row is a single entry of a sizes.json file. String values are integer coded,
+    the strings can be found in the dictionary with the same name as the column (without "_id").
+    Purchase links are stored in CSR form: the links of row i are
+    link_store_id[link_offsets[i]:link_offsets[i + 1]]
+    """
+
+    columns: dict[str, np.ndarray]
+    dictionaries: dict[str, list[str]]
+
+    def __init__(self, columns: dict[str, np.ndarray], dictionaries: dict[str, list[str]]):
+        self.columns = columns
+        self.dictionaries = dictionaries
+
+    def __len__(self):
+        return len(self.columns["filament_weight"])
+
+    def __getitem__(self, item: str) -> np.ndarray:
+        return self.columns[item]
+
+    def __contains__(self, item: str):
+        return item in self.columns
+
+    def code_of(self, dictionary: str, value: str) -> int:
+        """Returns the integer code of the value, or -1 if the value isn't in the dictionary"""
+        try:
+            return self.dictionaries[dictionary].index(value)
+        except ValueError:
+            return -1
+
+    def decode(self, column: str, codes: np.ndarray) -> list[str]:
+        """Convert integer codes from a *_id column back to their strings"""
+        dictionary = self.dictionaries[column.removesuffix("_id")]
+        return [dictionary[x] for x in np.asarray(codes).tolist()]
+
+    def store_mask(self, store_id: str) -> np.ndarray:
+        """Returns a boolean mask of the rows that have at least one purchase link from the store"""
+        code = self.code_of("store", store_id)
+        mask = np.zeros(len(self), dtype=bool)
+        if code < 0:
+            return mask
+        link_rows = np.repeat(np.arange(len(self)), np.diff(self["link_offsets"]))
+        mask[link_rows[self["link_store_id"] == code]] = True
+        return mask
+
+    def group_count(self, by: str, mask: Optional[np.ndarray] = None) -> dict[str, int]:
+        """Count the rows per value of a *_id column"""
+        codes = self[by] if mask is None else self[by][mask]
+        counts = np.bincount(codes, minlength=len(self.dictionaries[by.removesuffix("_id")]))
+        return {k: int(v) for k, v in zip(self.dictionaries[by.removesuffix("_id")], counts) if v}
+
+    def group_mean(self, column: str, by: str, mask: Optional[np.ndarray] = None) -> dict[str, float]:
+        """The mean of a float column per value of a *_id column, NaN values are ignored"""
+        values = self[column]
+        codes = self[by]
+        valid = ~np.isnan(values)
+        if mask is not None:
+            valid &= mask
+        n = len(self.dictionaries[by.removesuffix("_id")])
+        sums = np.bincount(codes[valid], weights=values[valid], minlength=n)
+        counts = np.bincount(codes[valid], minlength=n)
+        return {k: float(s / c) for k, s, c in zip(self.dictionaries[by.removesuffix("_id")], sums, counts) if c}
+
+    def save(self, path: PathLike):
+        """
+        Save the columns
+        If the path ends with ".npz" a single (compressed) archive is written,
+        otherwise the path is used as a folder with one memory-mappable .npy file per column
+        """
+        path = Path(path)
+        meta = {
+            "version": COLUMNS_VERSION,
+            "columns": list(self.columns.keys()),
+            "dictionaries": self.dictionaries
+        }
+        if path.suffix == ".npz":
+            path.parent.mkdir(parents=True, exist_ok=True)
+            np.savez_compressed(path, __meta__=np.array(json.dumps(meta)), **self.columns)
+            return
+
+        path.mkdir(parents=True, exist_ok=True)
+        for name, values in self.columns.items():
+            np.save(path.joinpath(f"{name}.npy"), values, allow_pickle=False)
+        with path.joinpath(COLUMNS_META_FILE).open("w", encoding="utf8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    @staticmethod
+    def load(path: PathLike, mmap: bool = True) -> Optional['CatalogColumns']:
+        """
+        Load columns written by save()
+        Folder snapshots are memory-mapped (read only) unless mmap is False
+        """
+        path = Path(path)
+        if path.suffix == ".npz":
+            with np.load(path, allow_pickle=False) as archive:
+                meta = json.loads(archive["__meta__"].item())
+                if meta.get("version") != COLUMNS_VERSION:
+                    print(f"Unsupported column snapshot version: {path.__str__()}")
+                    return None
+                columns = {name: archive[name] for name in meta["columns"]}
+            return CatalogColumns(columns, meta["dictionaries"])
+
+        meta_path = path.joinpath(COLUMNS_META_FILE)
+        if not meta_path.exists():
+            print(f"The provided path is not a column snapshot: {path.__str__()}")
+            return None
+        with meta_path.open("r", encoding="utf8") as f:
+            meta = json.load(f)
+        if meta.get("version") != COLUMNS_VERSION:
+            print(f"Unsupported column snapshot version: {path.__str__()}")
+            return None
+        columns = {
+            name: np.load(path.joinpath(f"{name}.npy"), mmap_mode="r" if mmap else None, allow_pickle=False)
+            for name in meta["columns"]
+        }
+        return CatalogColumns(columns, meta["dictionaries"])
+
+
+class _Dictionary:
+    """Assigns sequential integer codes to strings"""
+
+    def __init__(self):
+        self.codes: dict[str, int] = {}
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.codes)
+        return code
+
+    def values(self) -> list[str]:
+        return list(self.codes.keys())
+
+
+def _nan_if_none(value: Optional[float]) -> float:
+    return np.nan if value is None else value
+
+
+def variant_path(brand: Brand, material: Material, filament: Filament, variant: FilamentVariant) -> str:
+    """The path of the variant's folder, relative to the data folder"""
+    return "/".join(cleanse_folder_name(x) for x in
+                    (brand.brand_name, material.material_name, filament.name, variant.color_name))
+
+
+def build_catalog_columns(brands: list[Brand]) -> CatalogColumns:
+    """Flatten every FilamentSize of the brands into columns, inherited values are resolved"""
+    floats: dict[str, list[float]] = {k: [] for k in SIZE_FLOAT_COLUMNS}
+    bools: dict[str, list[bool]] = {k: [] for k in SIZE_BOOL_COLUMNS}
+    codes: dict[str, list[int]] = {k: [] for k in SIZE_CODE_COLUMNS}
+    size_index: list[int] = []
+    link_offsets: list[int] = [0]
+    link_store_id: list[int] = []
+    link_spool_refill: list[bool] = []
+
+    dictionaries = {k.removesuffix("_id"): _Dictionary() for k in SIZE_CODE_COLUMNS}
+    store_dictionary = _Dictionary()
+    # Keep store codes stable between snapshots of the same stores
+    for store_id in sorted(db_serializer.stores.keys()):
+        store_dictionary.code(store_id)
+
+    for brand in brands:
+        brand_code = dictionaries["brand"].code(brand.brand_name)
+        for material in brand.materials:
+            material_code = dictionaries["material"].code(material.material_name)
+            for filament in material.filaments:
+                filament_code = dictionaries["filament"].code(
+                    f"{brand.brand_name}/{material.material_name}/{filament.name}")
+                max_dry_temperature = _nan_if_none(filament.get_max_dry_temperature())
+                generic = filament.get_resolved_slicer_settings().generic
+                temps = {
+                    k: _nan_if_none(getattr(generic, k) if generic is not None else None)
+                    for k in ("first_layer_bed_temp", "first_layer_nozzle_temp", "bed_temp", "nozzle_temp")
+                }
+                for variant in filament.variants:
+                    variant_code = dictionaries["variant"].code(variant_path(brand, material, filament, variant))
+                    for idx, size in enumerate(variant.sizes):
+                        floats["filament_weight"].append(size.filament_weight)
+                        floats["diameter"].append(size.diameter)
+                        floats["empty_spool_weight"].append(_nan_if_none(size.empty_spool_weight))
+                        floats["spool_core_diameter"].append(_nan_if_none(size.spool_core_diameter))
+                        floats["density"].append(filament.density)
+                        floats["diameter_tolerance"].append(filament.diameter_tolerance)
+                        floats["max_dry_temperature"].append(max_dry_temperature)
+                        for k, v in temps.items():
+                            floats[k].append(v)
+
+                        bools["size_discontinued"].append(bool(size.discontinued))
+                        bools["variant_discontinued"].append(bool(variant.discontinued))
+                        bools["filament_discontinued"].append(bool(filament.discontinued))
+                        bools["discontinued"].append(
+                            bool(size.discontinued or variant.discontinued or filament.discontinued))
+
+                        codes["brand_id"].append(brand_code)
+                        codes["material_id"].append(material_code)
+                        codes["filament_id"].append(filament_code)
+                        codes["variant_id"].append(variant_code)
+                        size_index.append(idx)
+
+                        for link in size.purchase_links:
+                            link_store_id.append(store_dictionary.code(link.store.store_id))
+                            link_spool_refill.append(bool(link.spool_refill))
+                        link_offsets.append(len(link_store_id))
+
+    columns: dict[str, np.ndarray] = {}
+    for k, v in floats.items():
+        columns[k] = np.asarray(v, dtype=np.float64)
+    for k, v in bools.items():
+        columns[k] = np.asarray(v, dtype=bool)
+    for k, v in codes.items():
+        columns[k] = np.asarray(v, dtype=np.int32)
+    columns["size_index"] = np.asarray(size_index, dtype=np.int32)
+    columns["link_offsets"] = np.asarray(link_offsets, dtype=np.int32)
+    columns["link_store_id"] = np.asarray(link_store_id, dtype=np.int32)
+    columns["link_spool_refill"] = np.asarray(link_spool_refill, dtype=bool)
+
+    out_dictionaries = {k: v.values() for k, v in dictionaries.items()}
+    out_dictionaries["store"] = store_dictionary.values()
+    return CatalogColumns(columns, out_dictionaries)
+
+
+# ---------------------------------
+# Color Search
+# ---------------------------------
+
+# sRGB (D65) to XYZ conversion matrix and the D65 reference white
+_SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041]
+])
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def hex_to_lab(color_hex: list[str]) -> np.ndarray:
+    """Convert a list of hex colors ("#RRGGBB" or "RRGGBB") into an (n, 3) array of CIELAB values"""
+    values = np.array([int(x.strip().lstrip("#"), 16) for x in color_hex], dtype=np.int64)
+    rgb = np.stack([(values >> 16) & 0xFF, (values >> 8) & 0xFF, values & 0xFF], axis=1) / 255.0
+
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ _SRGB_TO_XYZ.T / _D65_WHITE
+
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    return np.stack([
+        116 * f[:, 1] - 16,
+        500 * (f[:, 0] - f[:, 1]),
+        200 * (f[:, 1] - f[:, 2])
+    ], axis=1)
+
+
+def delta_e_2000(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """The CIEDE2000 color difference between lab1 (shape (3,) or (n, 3)) and lab2 (shape (n, 3))"""
+    lab1 = np.atleast_2d(lab1)
+    l1, a1, b1 = lab1[:, 0], lab1[:, 1], lab1[:, 2]
+    l2, a2, b2 = lab2[:, 0], lab2[:, 1], lab2[:, 2]
+
+    c_bar = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    c_bar7 = c_bar ** 7
+    g = 0.5 * (1 - np.sqrt(c_bar7 / (c_bar7 + 25.0 ** 7)))
+    a1p = a1 * (1 + g)
+    a2p = a2 * (1 + g)
+    c1p = np.hypot(a1p, b1)
+    c2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    dlp = l2 - l1
+    dcp = c2p - c1p
+    chroma_zero = (c1p * c2p) == 0
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(chroma_zero, 0, dhp)
+    d_hp = 2 * np.sqrt(c1p * c2p) * np.sin(np.radians(dhp / 2))
+
+    lp_bar = (l1 + l2) / 2
+    cp_bar = (c1p + c2p) / 2
+    h_sum = h1p + h2p
+    hp_bar = np.where(np.abs(h1p - h2p) > 180,
+                      np.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2),
+                      h_sum / 2)
+    hp_bar = np.where(chroma_zero, h_sum, hp_bar)
+
+    t = (1 - 0.17 * np.cos(np.radians(hp_bar - 30))
+         + 0.24 * np.cos(np.radians(2 * hp_bar))
+         + 0.32 * np.cos(np.radians(3 * hp_bar + 6))
+         - 0.20 * np.cos(np.radians(4 * hp_bar - 63)))
+    d_theta = 30 * np.exp(-(((hp_bar - 275) / 25) ** 2))
+    cp_bar7 = cp_bar ** 7
+    r_c = 2 * np.sqrt(cp_bar7 / (cp_bar7 + 25.0 ** 7))
+    lp_bar_sq = (lp_bar - 50) ** 2
+    s_l = 1 + 0.015 * lp_bar_sq / np.sqrt(20 + lp_bar_sq)
+    s_c = 1 + 0.045 * cp_bar
+    s_h = 1 + 0.015 * cp_bar * t
+    r_t = -np.sin(np.radians(2 * d_theta)) * r_c
+
+    return np.sqrt((dlp / s_l) ** 2 + (dcp / s_c) ** 2 + (d_hp / s_h) ** 2
+                   + r_t * (dcp / s_c) * (d_hp / s_h))
+
+
+class ColorMatch(NamedTuple):
+    delta_e: float
+    brand_name: str
+    variant: FilamentVariant
+    color_hex: str  # The entry of variant.color_hex that matched
+
+
+class ColorIndex:
+    """
+    Nearest color search over every FilamentVariant.color_hex entry (multi-color variants have a row per color)
+
+    All colors are converted to CIELAB once and bucketed into a uniform grid. A query visits the grid cells
+    in rings of increasing Chebyshev distance until enough candidates lie within the visited radius,
+    the candidates are then ranked by CIEDE2000.
+    """
+
+    # If the filters leave fewer rows than this, they are all ranked directly
+    BRUTE_FORCE_LIMIT = 2048
+    # Candidates gathered per requested result before ranking, as CIEDE2000 and the grid's
+    # euclidean distance don't order colors identically
+    CANDIDATE_FACTOR = 4
+    MIN_CANDIDATES = 32
+
+    def __init__(self, brands: list[Brand], cell_size: float = 8.0):
+        self.cell_size = cell_size
+        self.variants: list[FilamentVariant] = []
+        self.brand_names: list[str] = []
+
+        row_variant: list[int] = []
+        row_hex: list[str] = []
+        materials = _Dictionary()
+        variant_material: list[int] = []
+        diameter_pairs: list[tuple[int, float]] = []
+        self.__ships_to: dict[str, set[int]] = {}
+        self.__mask_cache: dict[tuple[str, Any], np.ndarray] = {}
+
+        for brand in brands:
+            for material in brand.materials:
+                material_code = materials.code(material.material_name.lower())
+                for filament in material.filaments:
+                    for variant in filament.variants:
+                        idx = len(self.variants)
+                        self.variants.append(variant)
+                        self.brand_names.append(brand.brand_name)
+                        variant_material.append(material_code)
+                        for color_hex in variant.color_hex:
+                            row_variant.append(idx)
+                            row_hex.append(color_hex)
+                        for size in variant.sizes or []:
+                            diameter_pairs.append((idx, size.diameter))
+                            for link in size.purchase_links:
+                                for country in normalize_locations(link.get_ships_to()):
+                                    self.__ships_to.setdefault(country, set()).add(idx)
+
+        self.row_variant = np.asarray(row_variant, dtype=np.int32)
+        self.row_hex = row_hex
+        self.lab = hex_to_lab(row_hex) if row_hex else np.zeros((0, 3))
+        self.__materials = materials.codes
+        self.__variant_material = np.asarray(variant_material, dtype=np.int32)
+        self.__diameter_variant = np.asarray([x[0] for x in diameter_pairs], dtype=np.int32)
+        self.__diameter_value = np.asarray([x[1] for x in diameter_pairs], dtype=np.float64)
+
+        # Group the rows by grid cell
+        cells = np.floor(self.lab / cell_size).astype(np.int32)
+        self.__cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.__cell_rows = np.argsort(inverse, kind="stable").astype(np.int32)
+        self.__cell_offsets = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=len(self.__cells)))))
+
+    def __len__(self):
+        return len(self.row_variant)
+
+    def __variant_mask(self,
+                       material: Optional[str],
+                       diameter: Optional[float],
+                       ships_to: Optional[str]) -> Optional[np.ndarray]:
+        """A boolean mask of the variants that pass the filters, None if there are no filters"""
+        if material is None and diameter is None and ships_to is None:
+            return None
+        mask = np.ones(len(self.variants), dtype=bool)
+        if material is not None:
+            mask &= self.__variant_material == self.__materials.get(material.lower(), -1)
+        if diameter is not None:
+            key = ("diameter", diameter)
+            if key not in self.__mask_cache:
+                diameter_mask = np.zeros(len(self.variants), dtype=bool)
+                diameter_mask[self.__diameter_variant[np.isclose(self.__diameter_value, diameter)]] = True
+                self.__mask_cache[key] = diameter_mask
+            mask &= self.__mask_cache[key]
+        if ships_to is not None:
+            key = ("ships_to", ships_to.strip().upper())
+            if key not in self.__mask_cache:
+                ships_to_mask = np.zeros(len(self.variants), dtype=bool)
+                # Stores can list a region (e.g. EU) instead of its countries
+                for location in location_codes(key[1]):
+                    ships_to_mask[list(self.__ships_to.get(location, ()))] = True
+                self.__mask_cache[key] = ships_to_mask
+            mask &= self.__mask_cache[key]
+        return mask
+
+    def __grid_candidates(self, target: np.ndarray, row_mask: Optional[np.ndarray], needed: int) -> np.ndarray:
+        """Gather rows ring by ring until `needed` rows lie within the visited radius"""
+        query_cell = np.floor(target / self.cell_size).astype(np.int32)
+        rings = np.abs(self.__cells - query_cell).max(axis=1)
+        cell_order = np.argsort(rings, kind="stable")
+        sorted_rings = rings[cell_order]
+        boundaries = np.flatnonzero(np.diff(sorted_rings)) + 1
+
+        found: list[np.ndarray] = []
+        found_dist: list[np.ndarray] = []
+        for group in np.split(cell_order, boundaries):
+            rows = np.concatenate([
+                self.__cell_rows[self.__cell_offsets[c]:self.__cell_offsets[c + 1]] for c in group
+            ])
+            if row_mask is not None:
+                rows = rows[row_mask[rows]]
+            found.append(rows)
+            found_dist.append(np.linalg.norm(self.lab[rows] - target, axis=1))
+            # Every row within ring * cell_size of the target has been visited at this point
+            radius = rings[group[0]] * self.cell_size
+            if sum(int(np.count_nonzero(x <= radius)) for x in found_dist) >= needed:
+                break
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int32)
+
+    def nearest(self,
+                color_hex: str,
+                count: int = 10,
+                material: Optional[str] = None,
+                diameter: Optional[float] = None,
+                ships_to: Optional[str] = None) -> list[ColorMatch]:
+        """
+        Find the variants with the closest color to color_hex
+        :param count: The maximum number of variants to return
+        :param material: Only include variants of this material (case-insensitive)
+        :param diameter: Only include variants that have a size with this diameter
+        :param ships_to: Only include variants that have a purchase link shipping to this location code
+        """
+        if len(self) == 0:
+            return []
+        target = hex_to_lab([color_hex])[0]
+        variant_mask = self.__variant_mask(material, diameter, ships_to)
+        row_mask = None if variant_mask is None else variant_mask[self.row_variant]
+
+        if row_mask is not None and np.count_nonzero(row_mask) <= self.BRUTE_FORCE_LIMIT:
+            candidates = np.flatnonzero(row_mask)
+        else:
+            needed = max(count * self.CANDIDATE_FACTOR, self.MIN_CANDIDATES)
+            candidates = self.__grid_candidates(target, row_mask, needed)
+        if len(candidates) == 0:
+            return []
+
+        distances = delta_e_2000(target, self.lab[candidates])
+        results: list[ColorMatch] = []
+        seen: set[int] = set()
+        for i in np.argsort(distances, kind="stable"):
+            row = int(candidates[i])
+            variant_idx = int(self.row_variant[row])
+            # Multi-color variants are only listed once, with their closest color
+            if variant_idx in seen:
+                continue
+            seen.add(variant_idx)
+            results.append(ColorMatch(float(distances[i]), self.brand_names[variant_idx],
+                                      self.variants[variant_idx], self.row_hex[row]))
+            if len(results) >= count:
+                break
+        return results
+
+
+# ---------------------------------
+# Filament Length
+# ---------------------------------
+
+def filament_volume(weight: Any, density: Any) -> np.ndarray:
+    """
+    The volume of filament in cm³, works element-wise on arrays
+    :param weight: The weight of the filament in grams
+    :param density: The density of the filament in g/cm³
+    :returns: The volume, NaN where the density is missing or not positive
+    """
+    weight = np.asarray(weight, dtype=np.float64)
+    density = np.asarray(density, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(density > 0, weight / density, np.nan)
+
+
+def filament_length(weight: Any, density: Any, diameter: Any) -> np.ndarray:
+    """
+    The length of filament in meters, works element-wise on arrays
+    :param weight: The weight of the filament in grams
+    :param density: The density of the filament in g/cm³
+    :param diameter: The diameter of the filament in mm
+    :returns: The length, NaN where the density or diameter is missing or not positive
+    """
+    diameter = np.asarray(diameter, dtype=np.float64)
+    # cm³ -> mm³ is * 1000 and mm -> m is / 1000, so the volume divided by the cross-section in mm² is in meters
+    cross_section = np.pi * (diameter / 2) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(diameter > 0, filament_volume(weight, density) / cross_section, np.nan)
+
+
+def remaining_weight(gross_weight: Any, empty_spool_weight: Any) -> np.ndarray:
+    """The weight of filament left on a spool in grams, never negative, NaN where the spool weight is missing"""
+    remaining = np.asarray(gross_weight, dtype=np.float64) - np.asarray(empty_spool_weight, dtype=np.float64)
+    return np.maximum(remaining, 0)
+
+
+class SpoolEstimate(NamedTuple):
+    row: np.ndarray  # The catalog row of each spool, -1 if it couldn't be resolved
+    filament_weight: np.ndarray  # The remaining filament in grams
+    filament_length: np.ndarray  # The remaining filament in meters
+    fraction: np.ndarray  # The remaining fraction of the nominal filament weight
+
+
+class SpoolCalculator:
+    """
+    Computes filament lengths for every size of a CatalogColumns snapshot,
+    and remaining amounts from measured gross spool weights in bulk
+    """
+
+    catalog: CatalogColumns
+    nominal_volume: np.ndarray  # cm³ per row
+    nominal_length: np.ndarray  # Meters per row
+
+    def __init__(self, catalog: CatalogColumns, identifiers: Optional[dict[str, int]] = None):
+        """
+        :param catalog: The catalog to compute the lengths of
+        :param identifiers: Spool identifiers mapped to their catalog row, used by resolve()
+        """
+        self.catalog = catalog
+        self.nominal_volume = filament_volume(catalog["filament_weight"], catalog["density"])
+        self.nominal_length = filament_length(catalog["filament_weight"], catalog["density"], catalog["diameter"])
+
+        identifiers = identifiers or {}
+        keys = sorted(identifiers)
+        self.__identifier_keys = np.asarray(keys, dtype=str)
+        self.__identifier_rows = np.asarray([identifiers[x] for x in keys], dtype=np.int64)
+
+    @staticmethod
+    def from_brands(brands: list[Brand]) -> 'SpoolCalculator':
+        """Build the catalog and the identifier lookup of the brands"""
+        identifiers: dict[str, int] = {}
+        row = 0
+        for brand in brands:
+            for material in brand.materials:
+                for filament in material.filaments:
+                    for variant in filament.variants:
+                        for size in variant.sizes:
+                            # Identifiers are stored like db_index.IdentifierIndex stores them
+                            for field in IDENTIFIER_FIELDS:
+                                value = getattr(size, field)
+                                if not isinstance(value, str) or not value.strip():
+                                    continue
+                                code = normalize_gtin(value) if field in GTIN_FIELDS else None
+                                # The first size with an identifier wins if it isn't unique
+                                identifiers.setdefault(code or value.strip(), row)
+                            row += 1
+        return SpoolCalculator(build_catalog_columns(brands), identifiers)
+
+    def __lookup(self, keys: list[str]) -> np.ndarray:
+        keys = np.asarray(keys, dtype=str)
+        if len(self.__identifier_keys) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        idx = np.searchsorted(self.__identifier_keys, keys)
+        idx = np.minimum(idx, len(self.__identifier_keys) - 1)
+        return np.where(self.__identifier_keys[idx] == keys, self.__identifier_rows[idx], -1)
+
+    def resolve(self, identifiers: list[str]) -> np.ndarray:
+        """
+        Map identifiers to catalog rows, identifiers that aren't in the database resolve to -1
+        Identifiers match like in db_index.IdentifierIndex.lookup(), GTINs by their GTIN-14 form, others exactly
+        """
+        raw = self.__lookup([x.strip() for x in identifiers])
+        gtin = self.__lookup([normalize_gtin(x) or "" for x in identifiers])
+        return np.where(gtin >= 0, gtin, raw)
+
+    def remaining(self, rows: Any, gross_weight: Any, empty_spool_weight: Any = None) -> SpoolEstimate:
+        """
+        Estimate the filament left on spools from their measured gross weight
+        :param rows: The catalog row of each spool, -1 for unknown spools
+        :param gross_weight: The measured weight of each spool in grams, including the spool
+        :param empty_spool_weight: Used when the database has no empty spool weight for a size (scalar or per spool)
+        :returns: The estimates, NaN where the row is unknown or a required value is missing
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        gross_weight = np.broadcast_to(np.asarray(gross_weight, dtype=np.float64), rows.shape)
+        known = rows >= 0
+        safe_rows = np.where(known, rows, 0)
+
+        def column(name: str) -> np.ndarray:
+            if len(self.catalog) == 0:
+                return np.full(rows.shape, np.nan)
+            return np.where(known, np.asarray(self.catalog[name])[safe_rows], np.nan)
+
+        spool_weight = column("empty_spool_weight")
+        if empty_spool_weight is not None:
+            spool_weight = np.where(np.isnan(spool_weight), empty_spool_weight, spool_weight)
+        spool_weight = np.where(known, spool_weight, np.nan)
+
+        weight = remaining_weight(gross_weight, spool_weight)
+        length = filament_length(weight, column("density"), column("diameter"))
+        nominal = column("filament_weight")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(nominal > 0, weight / nominal, np.nan)
+        return SpoolEstimate(rows, weight, length, fraction)
+
+    def remaining_by_identifier(self, identifiers: list[str], gross_weight: Any,
+                                empty_spool_weight: Any = None) -> SpoolEstimate:
+        """Same as remaining(), with the spools given by an identifier (GTIN, EAN, article number, barcode, NFC, QR)"""
+        return self.remaining(self.resolve(identifiers), gross_weight, empty_spool_weight)
+
+
+# If running from the command line, provide argument parsing
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--data-path", default="data", help="Set the path of the data folder to load")
+    parser.add_argument("--export-columns",
+                        help="Export every size as NumPy columns. Use a path ending in .npz for a single archive")
+    parser.add_argument("--nearest-color", help="List the filaments with the closest color to the provided hex color")
+    parser.add_argument("--count", type=int, default=10, help="The number of results for --nearest-color")
+    parser.add_argument("--material", help="Only include this material in --nearest-color results")
+    parser.add_argument("--diameter", type=float, help="Only include this diameter in --nearest-color results")
+    parser.add_argument("--ships-to", help="Only include filaments shipping to this location in --nearest-color results")
+    parser.add_argument("--remaining",
+                        help="Estimate the filament left on spools from a CSV file of 'identifier,gross_weight' lines")
+    parser.add_argument("--spool-weight", type=float,
+                        help="The empty spool weight used for --remaining when the database doesn't have it")
+    args = parser.parse_args()
+
+    loaded_brands = load_brands_cached(args.data_path)
+
+    if args.export_columns is not None:
+        catalog = build_catalog_columns(loaded_brands)
+        catalog.save(args.export_columns)
+        print(f"Exported {len(catalog)} sizes to {args.export_columns}")
+
+    if args.nearest_color is not None:
+        index = ColorIndex(loaded_brands)
+        for match in index.nearest(args.nearest_color, args.count, args.material, args.diameter, args.ships_to):
+            filament = match.variant.parent
+            print(f"{match.delta_e:6.2f}  #{match.color_hex}  {match.brand_name} / "
+                  f"{filament.parent.material_name} / {filament.name} / {match.variant.color_name}")
+
+    if args.remaining is not None:
+        import csv
+
+        with open(args.remaining, newline="", encoding="utf-8") as f:
+            lines = [x for x in csv.reader(f) if len(x) >= 2 and x[0].strip()]
+        spool_ids = [x[0] for x in lines]
+        try:
+            weights = np.asarray([float(x[1]) for x in lines])
+        except ValueError as e:
+            print(f"Invalid gross weight in {args.remaining}: {e}")
+            exit(1)
+
+        calculator = SpoolCalculator.from_brands(loaded_brands)
+        estimate = calculator.remaining_by_identifier(spool_ids, weights, args.spool_weight)
+        for spool_id, row, weight, length, fraction in zip(spool_ids, estimate.row.tolist(),
+                                                           estimate.filament_weight, estimate.filament_length,
+                                                           estimate.fraction):
+            if row < 0:
+                print(f"{spool_id}: not found")
+                continue
+            name = calculator.catalog.decode("variant_id", [calculator.catalog["variant_id"][row]])[0]
+            print(f"{spool_id}: {weight:.0f} g, {length:.1f} m ({fraction:.0%}) left of {name}")
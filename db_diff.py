@@ -0,0 +1,378 @@
+import hashlib
+import json
+import os
+import subprocess
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+from db_serializer import Brand, PathLike, cleanse_folder_name
+
+# The kinds of entities below the root, in folder order
+FOLDER_KINDS = ["brand", "material", "filament", "variant"]
+FOLDER_FILES = {
+    "brand": "brand.json",
+    "material": "material.json",
+    "filament": "filament.json",
+    "variant": "variant.json",
+}
+
+
+class DiffEvent(NamedTuple):
+    action: str  # "add", "remove" or "modify"
+    kind: str  # "brand", "material", "filament", "variant", "size" or "purchase_link"
+    path: tuple[str, ...]  # The natural keys from the brand down to the entity
+    old: Optional[dict[str, Any]]
+    new: Optional[dict[str, Any]]
+    changes: dict[str, tuple[Any, Any]]  # The modified fields and their (old, new) values
+
+    def to_dict(self):
+        return {
+            "action": self.action,
+            "kind": self.kind,
+            "path": list(self.path),
+            "old": self.old,
+            "new": self.new,
+            "changes": {k: list(v) for k, v in self.changes.items()}
+        }
+
+
+class DiffNode:
+    """
+    A node of a snapshot tree that can be diffed
+    The digest covers the node and everything below it, so equal digests mean equal subtrees
+    The fields and children are loaded on first access, so unchanged subtrees are never read
+    """
+    def __init__(self, kind: str, key: str, digest: str,
+                 load: Callable[[], tuple[dict[str, Any], list['DiffNode']]]):
+        self.kind = kind
+        self.key = key
+        self.digest = digest
+        self.__load = load
+        self.__fields: Optional[dict[str, Any]] = None
+        self.__children: Optional[list[DiffNode]] = None
+
+    def __ensure_loaded(self):
+        if self.__fields is None:
+            self.__fields, self.__children = self.__load()
+
+    @property
+    def fields(self) -> dict[str, Any]:
+        self.__ensure_loaded()
+        return self.__fields
+
+    @property
+    def children(self) -> list['DiffNode']:
+        self.__ensure_loaded()
+        return self.__children
+
+
+# ---------------------------------
+# Sizes and Purchase Links
+# ---------------------------------
+
+def hash_json(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _unique_keys(keys: list[str]) -> list[str]:
+    """Entries with the same natural key are told apart by their order of occurrence"""
+    seen: dict[str, int] = {}
+    out = []
+    for key in keys:
+        count = seen.get(key, 0) + 1
+        seen[key] = count
+        out.append(key if count == 1 else f"{key} #{count}")
+    return out
+
+
+def _number_key(value: Any) -> str:
+    """Numbers are formatted the same whether they're stored as int or float (1000 and 1000.0)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f"{float(value):g}"
+    return f"{value}"
+
+
+def size_key(size: dict[str, Any]) -> str:
+    return f"{_number_key(size.get('filament_weight'))}g {_number_key(size.get('diameter'))}mm"
+
+
+def purchase_link_key(link: dict[str, Any]) -> str:
+    return f"{link.get('store_id')} {link.get('url')}"
+
+
+def _leaf_node(kind: str, key: str, fields: dict[str, Any], children: list[DiffNode]) -> DiffNode:
+    digest = hash_json([fields, [x.digest for x in children]])
+    return DiffNode(kind, key, digest, lambda: (fields, children))
+
+
+def size_nodes(sizes: list[dict[str, Any]]) -> list[DiffNode]:
+    """Create the nodes of the sizes in a sizes.json file"""
+    nodes = []
+    for key, size in zip(_unique_keys([size_key(x) for x in sizes]), sizes):
+        fields = {k: v for k, v in size.items() if k != "purchase_links"}
+        links = size.get("purchase_links", [])
+        link_nodes = [_leaf_node("purchase_link", link_key, link, [])
+                      for link_key, link in zip(_unique_keys([purchase_link_key(x) for x in links]), links)]
+        nodes.append(_leaf_node("size", key, fields, link_nodes))
+    return nodes
+
+
+# ---------------------------------
+# Snapshot Sources
+# ---------------------------------
+
+class _RawEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    digest: str
+    ref: str  # A path or a git object id
+
+
+class FolderSource:
+    """
+    Reads a data folder from the file system
+    Digests are computed the same way git computes object ids,
+    so a folder can be diffed against a git revision and unchanged subtrees are still skipped
+    """
+    def __init__(self, data_folder: PathLike):
+        self.__entries: dict[str, list[_RawEntry]] = {}
+        self.root = self.__scan(str(data_folder))
+
+    def __scan(self, folder: str) -> _RawEntry:
+        entries = []
+        tree_entries = []
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_dir():
+                    child = self.__scan(entry.path)
+                    # Git doesn't store empty folders
+                    if not self.__entries[entry.path]:
+                        continue
+                    mode = b"40000"
+                    sort_name = entry.name + "/"
+                else:
+                    with open(entry.path, "rb") as f:
+                        data = f.read()
+                    digest = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+                    child = _RawEntry(entry.name, False, digest, entry.path)
+                    mode = b"100755" if entry.stat().st_mode & 0o100 else b"100644"
+                    sort_name = entry.name
+                entries.append(child)
+                tree_entries.append((sort_name.encode("utf-8"), mode, child))
+
+        entries.sort(key=lambda x: x.name)
+        self.__entries[folder] = entries
+        tree_entries.sort(key=lambda x: x[0])
+        tree = b"".join(mode + b" " + child.name.encode("utf-8") + b"\0" + bytes.fromhex(child.digest)
+                        for _, mode, child in tree_entries)
+        digest = hashlib.sha1(b"tree %d\0" % len(tree) + tree).hexdigest()
+        return _RawEntry(os.path.basename(folder), True, digest, folder)
+
+    def list_dir(self, ref: str) -> list[_RawEntry]:
+        return self.__entries[ref]
+
+    def read(self, ref: str) -> bytes:
+        with open(ref, "rb") as f:
+            return f.read()
+
+
+class GitSource:
+    """
+    Reads a data folder from a git revision without checking it out
+    Git tree ids are used as the digests, so unchanged subtrees are skipped without reading any objects
+    """
+    def __init__(self, revision: str, data_folder: str = "data", repo_path: PathLike = "."):
+        self.__repo_path = str(repo_path)
+        tree_id = subprocess.run(["git", "rev-parse", f"{revision}:{data_folder}"], cwd=self.__repo_path,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+        self.__process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=self.__repo_path,
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.root = _RawEntry(data_folder, True, tree_id, tree_id)
+
+    def close(self):
+        if self.__process.poll() is None:
+            self.__process.stdin.close()
+            self.__process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __read_object(self, object_id: str) -> tuple[str, bytes]:
+        self.__process.stdin.write(object_id.encode("ascii") + b"\n")
+        self.__process.stdin.flush()
+        header = self.__process.stdout.readline().split()
+        if len(header) != 3:
+            raise Exception(f"Could not read git object {object_id}")
+        data = self.__process.stdout.read(int(header[2]))
+        self.__process.stdout.read(1)  # Trailing newline
+        return header[1].decode("ascii"), data
+
+    def list_dir(self, ref: str) -> list[_RawEntry]:
+        object_type, data = self.__read_object(ref)
+        if object_type != "tree":
+            raise Exception(f"Git object {ref} is a {object_type}, not a tree")
+        entries = []
+        pos = 0
+        # Tree entries are "<mode> <name>\0<20 byte object id>"
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            null = data.index(b"\0", space)
+            mode = data[pos:space]
+            name = data[space + 1:null].decode("utf-8")
+            object_id = data[null + 1:null + 21].hex()
+            entries.append(_RawEntry(name, mode == b"40000", object_id, object_id))
+            pos = null + 21
+        return entries
+
+    def read(self, ref: str) -> bytes:
+        return self.__read_object(ref)[1]
+
+
+def _raw_node(source, entry: _RawEntry, depth: int) -> DiffNode:
+    kind = FOLDER_KINDS[depth]
+
+    def load():
+        fields: dict[str, Any] = {}
+        children: list[DiffNode] = []
+        for child in source.list_dir(entry.ref):
+            if child.is_dir:
+                if depth + 1 < len(FOLDER_KINDS):
+                    children.append(_raw_node(source, child, depth + 1))
+            elif child.name == FOLDER_FILES[kind]:
+                fields = json.loads(source.read(child.ref))
+            elif kind == "variant" and child.name == "sizes.json":
+                children = size_nodes(json.loads(source.read(child.ref)))
+        return fields, children
+
+    return DiffNode(kind, entry.name, entry.digest, load)
+
+
+def _raw_root(source) -> DiffNode:
+    brands = [_raw_node(source, x, 0) for x in source.list_dir(source.root.ref) if x.is_dir]
+    return DiffNode("root", "", source.root.digest, lambda: ({}, brands))
+
+
+def tree_from_folder(data_folder: PathLike = "data") -> DiffNode:
+    """Create a snapshot tree of a data folder, every file is hashed but only changed files are parsed when diffing"""
+    return _raw_root(FolderSource(data_folder))
+
+
+def tree_from_git(revision: str, data_folder: str = "data", repo_path: PathLike = ".") -> DiffNode:
+    """
+    Create a snapshot tree of the data folder at a git revision
+    The git process is kept open so objects can be read while diffing, it is closed when the program exits
+    """
+    return _raw_root(GitSource(revision, data_folder, repo_path))
+
+
+def tree_from_brands(brands: list[Brand]) -> DiffNode:
+    """Create a snapshot tree of loaded brands"""
+    def node(kind: str, key: str, fields: dict[str, Any], children: list[DiffNode]):
+        return _leaf_node(kind, cleanse_folder_name(key), fields, children)
+
+    brand_nodes = []
+    for brand in brands:
+        material_nodes = []
+        for material in brand.materials:
+            filament_nodes = []
+            for filament in material.filaments:
+                variant_nodes = []
+                for variant in filament.variants:
+                    sizes = size_nodes([x.to_dict() for x in variant.sizes])
+                    variant_nodes.append(node("variant", variant.color_name, variant.to_dict(), sizes))
+                filament_nodes.append(node("filament", filament.name, filament.to_dict(), variant_nodes))
+            material_nodes.append(node("material", material.material_name, material.to_dict(), filament_nodes))
+        brand_nodes.append(node("brand", brand.brand_name, brand.to_dict(), material_nodes))
+    return _leaf_node("root", "", {}, brand_nodes)
+
+
+# ---------------------------------
+# Diffing
+# ---------------------------------
+
+def diff_fields(old: dict[str, Any], new: dict[str, Any]) -> dict[str, tuple[Any, Any]]:
+    changes = {}
+    for k in sorted(old.keys() | new.keys()):
+        if old.get(k) != new.get(k):
+            changes[k] = (old.get(k), new.get(k))
+    return changes
+
+
+def _subtree_events(action: str, node: DiffNode, path: tuple[str, ...]) -> Iterator[DiffEvent]:
+    """An added or removed entity also adds or removes everything below it"""
+    path = path + (node.key,)
+    old, new = (node.fields, None) if action == "remove" else (None, node.fields)
+    yield DiffEvent(action, node.kind, path, old, new, {})
+    for child in node.children:
+        yield from _subtree_events(action, child, path)
+
+
+def diff_trees(old: DiffNode, new: DiffNode, path: tuple[str, ...] = ()) -> Iterator[DiffEvent]:
+    """
+    Diff two snapshot trees, entities are matched by their natural keys
+    Subtrees with matching digests are skipped
+    """
+    if old.digest == new.digest:
+        return
+
+    if old.kind != "root":
+        path = path + (new.key,)
+        changes = diff_fields(old.fields, new.fields)
+        if changes:
+            yield DiffEvent("modify", new.kind, path, old.fields, new.fields, changes)
+
+    old_children = {x.key: x for x in old.children}
+    new_children = {x.key: x for x in new.children}
+    for key in sorted(old_children.keys() | new_children.keys()):
+        old_child = old_children.get(key)
+        new_child = new_children.get(key)
+        if new_child is None:
+            yield from _subtree_events("remove", old_child, path)
+        elif old_child is None:
+            yield from _subtree_events("add", new_child, path)
+        else:
+            yield from diff_trees(old_child, new_child, path)
+
+
+# If running from the command line, provide argument parsing
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from collections import Counter
+
+    parser = ArgumentParser()
+    parser.add_argument("old", help="The old git revision, or a data folder with --folders")
+    parser.add_argument("new", nargs="?", help="The new git revision, or a data folder with --folders "
+                                               "(default: the working tree's data folder)")
+    parser.add_argument("--data-path", default="data", help="The path of the data folder within the repository")
+    parser.add_argument("--folders", action="store_true", help="Diff two data folders instead of git revisions")
+    parser.add_argument("--output", help="Write the events to this file as JSON lines")
+    args = parser.parse_args()
+
+    if args.folders:
+        old_tree = tree_from_folder(args.old)
+    else:
+        old_tree = tree_from_git(args.old, args.data_path)
+
+    if args.new is None:
+        new_tree = tree_from_folder(args.data_path)
+    elif args.folders:
+        new_tree = tree_from_folder(args.new)
+    else:
+        new_tree = tree_from_git(args.new, args.data_path)
+
+    counts = Counter()
+    output = Path(args.output).open("w", encoding="utf-8") if args.output else None
+    for event in diff_trees(old_tree, new_tree):
+        counts[(event.action, event.kind)] += 1
+        if output is not None:
+            output.write(json.dumps(event.to_dict()) + "\n")
+        else:
+            print(f"{event.action:<6} {event.kind:<13} {' / '.join(event.path)}")
+    if output is not None:
+        output.close()
+
+    for (action, kind), count in sorted(counts.items()):
+        print(f"{count} {kind} {action}")
@@ -0,0 +1,480 @@
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+from typing import Optional, Any, Iterator
+
+import db_serializer
+from db_serializer import Brand, Material, Filament, FilamentVariant, FilamentSize, PathLike, \
+    cleanse_folder_name, normalize_color_hex, validate_json, brand_files, load_brands_cached, \
+    encode_data_file, read_data_file
+from db_diff import tree_from_brands, diff_trees
+
+# The fields a feed row can be mapped to, and the type they are converted to
+IMPORT_FIELDS = {
+    # Filament
+    "brand": str,
+    "material": str,
+    "filament": str,
+    "density": float,
+    "diameter_tolerance": float,
+    "max_dry_temperature": int,
+    "data_sheet_url": str,
+    "safety_sheet_url": str,
+    # Variant
+    "color_name": str,
+    "color_hex": list,
+    "variant_discontinued": bool,
+    # Size
+    "filament_weight": float,
+    "diameter": float,
+    "empty_spool_weight": float,
+    "spool_core_diameter": float,
+    "gtin": str,
+    "ean": str,
+    "article_number": str,
+    "barcode_identifier": str,
+    "nfc_identifier": str,
+    "qr_identifier": str,
+    "discontinued": bool,
+    # Purchase link
+    "store_id": str,
+    "url": str,
+    "spool_refill": bool,
+}
+
+FILAMENT_FIELDS = ["density", "diameter_tolerance", "max_dry_temperature", "data_sheet_url", "safety_sheet_url"]
+SIZE_FIELDS = ["filament_weight", "diameter", "empty_spool_weight", "spool_core_diameter", "gtin", "ean",
+               "article_number", "barcode_identifier", "nfc_identifier", "qr_identifier", "discontinued"]
+
+# Feed column names that are understood without a mapping, besides the field names themselves
+DEFAULT_COLUMN_MAP = {
+    "name": "filament",
+    "filament_name": "filament",
+    "color": "color_name",
+    "colour": "color_name",
+    "hex": "color_hex",
+    "weight": "filament_weight",
+    "store": "store_id",
+    "purchase_url": "url",
+}
+
+TRUE_VALUES = {"1", "true", "yes", "y"}
+FALSE_VALUES = {"0", "false", "no", "n"}
+
+
+# ---------------------------------
+# Reading Feeds
+# ---------------------------------
+
+def convert_value(field: str, value: Any) -> Any:
+    """
+    Convert a raw feed value to the type of the field
+    Empty strings are treated as missing values
+    :returns: The converted value, or None if the value is missing
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    field_type = IMPORT_FIELDS[field]
+    if field_type is str:
+        return str(value).strip()
+    if field_type is list:
+        if isinstance(value, list):
+            return [str(x).strip() for x in value]
+        return [x.strip() for x in str(value).replace(";", ",").split(",") if x.strip()]
+    if field_type is bool:
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in TRUE_VALUES:
+            return True
+        if text in FALSE_VALUES:
+            return False
+        raise ValueError(f"'{value}' is not a boolean")
+    number = float(value)
+    if field_type is int or number.is_integer():
+        if not number.is_integer():
+            raise ValueError(f"'{value}' is not an integer")
+        return int(number)
+    return number
+
+
+def read_feed(feed_path: PathLike, column_map: Optional[dict[str, str]] = None,
+              constants: Optional[dict[str, Any]] = None, feed_format: Optional[str] = None) \
+        -> Iterator[tuple[int, dict[str, Any]]]:
+    """
+    Stream the rows of a CSV or JSON lines vendor feed, every row is one size of a variant
+    :param feed_path: The feed, the format is detected from the extension (.csv, .tsv, .jsonl, .ndjson)
+    :param column_map: Feed column names mapped to IMPORT_FIELDS, used before DEFAULT_COLUMN_MAP
+    :param constants: Field values used for every row, unless the row has its own value
+    :param feed_format: "csv", "tsv" or "jsonl", overrides the format detected from the extension
+    :returns: (line number, row with the mapped fields), rows that can't be converted are reported and skipped
+    """
+    column_map = {k.strip().lower(): v for k, v in (column_map or {}).items()}
+    constants = constants or {}
+    feed_path = Path(feed_path)
+    if feed_format is None:
+        feed_format = {".csv": "csv", ".tsv": "tsv"}.get(feed_path.suffix.lower(), "jsonl")
+
+    def field_of(column: str) -> Optional[str]:
+        column = column.strip().lower()
+        if column in column_map:
+            return column_map[column]
+        if column in IMPORT_FIELDS:
+            return column
+        return DEFAULT_COLUMN_MAP.get(column)
+
+    with feed_path.open(newline="", encoding="utf-8-sig") as f:
+        if feed_format == "jsonl":
+            raw_rows = ((line_no, json.loads(line)) for line_no, line in enumerate(f, 1) if line.strip())
+        else:
+            reader = csv.DictReader(f, delimiter="\t" if feed_format == "tsv" else ",")
+            # Line 1 is the header
+            raw_rows = enumerate(reader, 2)
+
+        for line_no, raw in raw_rows:
+            row = dict(constants)
+            try:
+                for column, value in raw.items():
+                    field = field_of(column) if column is not None else None
+                    if field is None:
+                        continue
+                    value = convert_value(field, value)
+                    if value is not None:
+                        row[field] = value
+            except ValueError as e:
+                print(f"Skipping {feed_path}:{line_no}, {e}")
+                continue
+            yield line_no, row
+
+
+# ---------------------------------
+# Importing
+# ---------------------------------
+
+def _name_key(name: str) -> str:
+    """Names are matched by the folder they would be stored in, ignoring case"""
+    return cleanse_folder_name(name).casefold()
+
+
+_MISSING = object()
+
+
+def keep_current_values(new: Any, old: Any, current: Any) -> Any:
+    """
+    Values the import didn't change are taken from the current file, so defaults the serializer adds (e.g. a derived
+    gtin) aren't written into entries that weren't touched
+    :param new: The serialized file after the import
+    :param old: The serialized file before the import
+    :param current: The file as it is in the data folder
+    """
+    if new == old:
+        return current
+    if isinstance(new, dict) and isinstance(old, dict) and isinstance(current, dict):
+        res = {}
+        for key, value in new.items():
+            kept = keep_current_values(value, old.get(key, _MISSING), current.get(key, _MISSING))
+            if kept is not _MISSING:
+                res[key] = kept
+        return res
+    if isinstance(new, list) and isinstance(old, list) and isinstance(current, list) and len(old) == len(current):
+        return [keep_current_values(value, old[i], current[i]) if i < len(old) else value
+                for i, value in enumerate(new)]
+    return new
+
+
+class CatalogImporter:
+    """
+    Merges vendor feed rows into the loaded brands
+    Existing sizes are found by GTIN/EAN first, then by the variant's color_name and the size's weight and diameter.
+    New materials, filaments, variants, sizes and purchase links are created, existing ones are updated
+    with the values of the row. Every change is validated with the schemas before it is applied.
+    """
+
+    brands: list[Brand]
+
+    def __init__(self, brands: list[Brand]):
+        self.brands = brands
+        self.created: dict[str, int] = {"material": 0, "filament": 0, "variant": 0, "size": 0, "purchase_link": 0}
+        self.updated: dict[str, int] = {"filament": 0, "variant": 0, "size": 0}
+        self.skipped = 0
+        # The brands before the import, by brand name, copied when a brand is first modified
+        self.__originals: dict[str, Brand] = {}
+        self.__brands = {_name_key(x.brand_name): x for x in brands}
+        self.__identifiers: dict[str, tuple[FilamentVariant, FilamentSize]] = {}
+        for brand in brands:
+            for material in brand.materials:
+                for filament in material.filaments:
+                    for variant in filament.variants:
+                        for size in variant.sizes:
+                            self.__index_size(variant, size)
+
+    def __index_size(self, variant: FilamentVariant, size: FilamentSize):
+        for identifier in (size.gtin, size.ean):
+            if identifier:
+                self.__identifiers.setdefault(identifier, (variant, size))
+
+    def __touch(self, brand: Brand):
+        if brand.brand_name not in self.__originals:
+            self.__originals[brand.brand_name] = deepcopy(brand)
+
+    @property
+    def touched_brands(self) -> list[Brand]:
+        return [x for x in self.brands if x.brand_name in self.__originals]
+
+    @property
+    def original_brands(self) -> list[Brand]:
+        """Copies of the touched brands, as they were before the import"""
+        return [self.__originals[x.brand_name] for x in self.touched_brands]
+
+    @staticmethod
+    def __merge(current: dict[str, Any], row: dict[str, Any], fields: dict[str, str]) -> dict[str, Any]:
+        """Overlay the row's values on the JSON data of an entity, fields maps row fields to JSON keys"""
+        merged = dict(current)
+        for field, key in fields.items():
+            if field in row:
+                merged[key] = row[field]
+        return merged
+
+    def import_rows(self, rows: Iterator[tuple[int, dict[str, Any]]], source: str = "feed") -> int:
+        """
+        Import every row
+        :param rows: (line number, row) like read_feed() returns
+        :param source: The name used for the feed in error messages
+        :returns: The number of imported rows
+        """
+        imported = 0
+        for line_no, row in rows:
+            # validate_json reports errors with the last loaded file
+            db_serializer.last_json_file_loaded = f"{source}:{line_no}"
+            try:
+                ok = self.import_row(row)
+            except Exception as e:
+                print(f"Failed to import {source}:{line_no}, {e}")
+                ok = False
+            if ok:
+                imported += 1
+            else:
+                self.skipped += 1
+        return imported
+
+    def import_row(self, row: dict[str, Any]) -> bool:
+        """
+        Merge a single row, an error message is emitted if it can't be imported
+        Everything the row changes is validated before anything is applied, so a rejected row changes nothing
+        :returns: True if the row was imported
+        """
+        brand = self.__brands.get(_name_key(row["brand"])) if "brand" in row else None
+        material = filament = variant = size = None
+
+        existing = next((self.__identifiers[row[x]] for x in ("gtin", "ean") if row.get(x) in self.__identifiers), None)
+        if existing is not None:
+            variant, size = existing
+            filament = variant.parent
+            material = filament.parent
+            owner = next(x for x in self.brands if material in x.materials)
+            if brand is not None and brand is not owner:
+                print(f"GTIN/EAN {row.get('gtin') or row.get('ean')} belongs to '{owner.brand_name}', "
+                      f"not '{brand.brand_name}'")
+                return False
+            brand = owner
+        else:
+            if brand is None:
+                print(f"Unknown brand '{row.get('brand')}', brands have to be added by hand before importing")
+                return False
+            for key in ("material", "filament", "color_name", "filament_weight", "diameter"):
+                if key not in row:
+                    print(f"Missing '{key}', rows that don't match an existing GTIN/EAN need it")
+                    return False
+            material = next((x for x in brand.materials if _name_key(x.material_name) == _name_key(row["material"])),
+                            None)
+            if material is not None:
+                filament = next((x for x in material.filaments if _name_key(x.name) == _name_key(row["filament"])),
+                                None)
+            if filament is not None:
+                variant = next((x for x in filament.variants
+                                if _name_key(x.color_name) == _name_key(row["color_name"])), None)
+            if variant is not None:
+                size = next((x for x in variant.sizes if x.filament_weight == row["filament_weight"]
+                             and x.diameter == row["diameter"]), None)
+
+        # Build and validate the JSON data of every entity the row creates or changes
+        material_data = {"material": row["material"]} if material is None else None
+        if material_data is not None and not validate_json(material_data, db_serializer.MATERIAL_SCHEMA):
+            return False
+
+        filament_current = filament.to_dict() if filament is not None else {"name": row["filament"]}
+        filament_data = self.__merge(filament_current, row, {x: x for x in FILAMENT_FIELDS})
+        if filament_data != filament_current or filament is None:
+            if not validate_json(filament_data, db_serializer.FILAMENT_SCHEMA):
+                return False
+
+        if "color_hex" in row:
+            row = dict(row, color_hex=["#" + x for x in normalize_color_hex(row["color_hex"])])
+            if len(row["color_hex"]) == 1:
+                row["color_hex"] = row["color_hex"][0]
+        elif variant is None:
+            print(f"Missing 'color_hex' for the new variant '{row['color_name']}'")
+            return False
+        variant_current = variant.to_dict() if variant is not None else {"color_name": row["color_name"]}
+        variant_data = self.__merge(variant_current, row,
+                                    {"color_hex": "color_hex", "variant_discontinued": "discontinued"})
+        if variant_data != variant_current or variant is None:
+            if not validate_json(variant_data, db_serializer.VARIANT_SCHEMA):
+                return False
+
+        size_current = size.to_dict() if size is not None else {}
+        size_data = self.__merge(size_current, row, {x: x for x in SIZE_FIELDS})
+        links = size_data.get("purchase_links", [])
+        new_link = False
+        if "store_id" in row and "url" in row:
+            if row["store_id"] not in db_serializer.stores:
+                print(f"Unknown store_id '{row['store_id']}'")
+                return False
+            link = next((x for x in links if x["store_id"] == row["store_id"] and x["url"] == row["url"]), None)
+            if link is None:
+                link = {"store_id": row["store_id"], "url": row["url"]}
+                links = links + [link]
+                new_link = True
+            if "spool_refill" in row and link.get("spool_refill", False) != row["spool_refill"]:
+                links = [dict(x, spool_refill=row["spool_refill"]) if x is link else x for x in links]
+        size_data["purchase_links"] = links
+        if size_data != size_current or size is None:
+            if not validate_json([size_data], db_serializer.SIZE_SCHEMA):
+                return False
+        # Raises if the GTIN/EAN combination is invalid
+        new_size = FilamentSize.from_json_data(size_data)
+
+        # Apply the changes
+        self.__touch(brand)
+        if material is None:
+            material = Material.from_json_data(material_data)
+            brand.materials.append(material)
+            self.created["material"] += 1
+
+        if filament is None:
+            filament = Filament.from_json_data(filament_data, material)
+            material.filaments.append(filament)
+            self.created["filament"] += 1
+        elif filament_data != filament_current:
+            for field in FILAMENT_FIELDS:
+                setattr(filament, field, filament_data.get(field))
+            self.updated["filament"] += 1
+
+        if variant is None:
+            variant = FilamentVariant.from_json_data(variant_data, filament)
+            filament.variants.append(variant)
+            self.created["variant"] += 1
+        elif variant_data != variant_current:
+            color_hex = variant_data["color_hex"]
+            variant.color_hex = normalize_color_hex(color_hex if isinstance(color_hex, list) else [color_hex])
+            variant.discontinued = variant_data.get("discontinued")
+            self.updated["variant"] += 1
+
+        if new_link:
+            self.created["purchase_link"] += 1
+        if size is None:
+            variant.sizes.append(new_size)
+            self.created["size"] += 1
+        elif size_data != size_current:
+            variant.sizes[variant.sizes.index(size)] = new_size
+            self.updated["size"] += 1
+            # Identifiers that pointed to the replaced size point to the new one
+            for identifier in (size.gtin, size.ean):
+                if identifier and self.__identifiers.get(identifier, (None, None))[1] is size:
+                    del self.__identifiers[identifier]
+        else:
+            return True
+        self.__index_size(variant, new_size)
+        return True
+
+    def changed_files(self, data_folder: PathLike = "data") -> list[tuple[str, bytes]]:
+        """
+        The files of the touched brands whose contents changed
+        Files are compared with how the brand serialized before the import, so files that only differ from the
+        data folder by formatting aren't rewritten, changed files are encoded like the files in the data folder
+        :returns: (path relative to the data folder, file contents)
+        """
+        data_folder = Path(data_folder)
+        changed = []
+        for brand in self.touched_brands:
+            old_files = {path: data for path, data in brand_files(self.__originals[brand.brand_name])}
+            for path, data in brand_files(brand):
+                if old_files.get(path) != data:
+                    current = read_data_file(data_folder.joinpath(path))
+                    if current is not None and path in old_files:
+                        try:
+                            data = keep_current_values(data, old_files[path], json.loads(current))
+                        except ValueError:
+                            pass
+                    changed.append((path, encode_data_file(data, current)))
+        return changed
+
+    def write(self, data_folder: PathLike = "data", max_workers: Optional[int] = None) -> int:
+        """
+        Write the changed files to the data folder in parallel
+        :returns: The number of written files
+        """
+        data_folder = Path(data_folder)
+
+        def write_file(item: tuple[str, bytes]):
+            path = data_folder.joinpath(item[0])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            tmp_path.write_bytes(item[1])
+            os.replace(tmp_path, path)
+
+        files = self.changed_files(data_folder)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(write_file, files))
+        return len(files)
+
+
+# If running from the command line, provide argument parsing
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    def key_value(text: str) -> tuple[str, str]:
+        if "=" not in text:
+            raise ValueError(f"Expected KEY=VALUE: {text}")
+        key, value = text.split("=", 1)
+        return key.strip(), value.strip()
+
+    parser = ArgumentParser(description="Import a vendor feed (CSV or JSON lines, one size per row) into the database")
+    parser.add_argument("feed", help="The feed to import")
+    parser.add_argument("--data-path", default="data", help="Set the path of the data folder")
+    parser.add_argument("--format", choices=["csv", "tsv", "jsonl"], help="The feed format (default: from the extension)")
+    parser.add_argument("--map", action="append", default=[], metavar="COLUMN=FIELD",
+                        help=f"Map a feed column to a field (can be repeated), fields: {', '.join(IMPORT_FIELDS)}")
+    parser.add_argument("--set", action="append", default=[], metavar="FIELD=VALUE",
+                        help="Use a value for every row that doesn't have one, e.g. --set brand=Polymaker")
+    parser.add_argument("--dry-run", action="store_true", help="Print the changes instead of writing them")
+    parser.add_argument("--workers", type=int, help="Max number of threads used to write files")
+    args = parser.parse_args()
+
+    try:
+        feed_map = dict(key_value(x) for x in args.map)
+        feed_constants = {k: convert_value(k, v) for k, v in (key_value(x) for x in args.set)}
+    except (ValueError, KeyError) as e:
+        print(f"Invalid --map/--set value: {e}")
+        exit(1)
+    for mapped_field in feed_map.values():
+        if mapped_field not in IMPORT_FIELDS:
+            print(f"Unknown field '{mapped_field}', fields: {', '.join(IMPORT_FIELDS)}")
+            exit(1)
+
+    importer = CatalogImporter(load_brands_cached(args.data_path))
+    imported_rows = importer.import_rows(read_feed(args.feed, feed_map, feed_constants, args.format), args.feed)
+    print(f"Imported {imported_rows} rows ({importer.skipped} skipped)")
+    print("Created: " + ", ".join(f"{v} {k}s" for k, v in importer.created.items()))
+    print("Updated: " + ", ".join(f"{v} {k}s" for k, v in importer.updated.items()))
+
+    if args.dry_run:
+        for event in diff_trees(tree_from_brands(importer.original_brands), tree_from_brands(importer.touched_brands)):
+            print(f"{event.action:<6} {event.kind:<13} {' / '.join(event.path)}")
+            for field, (old, new) in event.changes.items():
+                print(f"{'':<21}{field}: {json.dumps(old)} -> {json.dumps(new)}")
+    else:
+        print(f"Wrote {importer.write(args.data_path, args.workers)} files")
@@ -0,0 +1,923 @@
+import bisect
+import difflib
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+from pathlib import Path
+from typing import Optional, NamedTuple, Iterator
+
+import numpy as np
+
+from db_serializer import PathLike, normalize_locations
+
+# The default location of the index files
+index_output_path = Path("./.cache")
+
+IDENTIFIER_FIELDS = ["gtin", "ean", "article_number", "barcode_identifier", "nfc_identifier", "qr_identifier"]
+# These fields are stored in their normalized GTIN-14 form
+GTIN_FIELDS = {"gtin", "ean"}
+
+GTIN_SEPARATORS_PATTERN = re.compile(r"[\s-]")
+
+
+# ---------------------------------
+# General Methods
+# ---------------------------------
+
+def load_json(path: PathLike):
+    """Load JSON from the file, returns None if there is an error"""
+    try:
+        with open(path, mode="r", encoding="utf8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return None
+
+
+def normalize_gtin(code: str) -> Optional[str]:
+    """
+    Normalize a GTIN-8, GTIN-12 (UPC-A), GTIN-13 (EAN-13) or GTIN-14 to its 14 digit form by left padding with zeros
+    This makes a UPC-A scan and the same code stored as an EAN-13 (with a leading 0) equal
+    Returns None if the code is not a GTIN
+    """
+    digits = GTIN_SEPARATORS_PATTERN.sub("", code)
+    if not digits.isdigit() or len(digits) not in (8, 12, 13, 14):
+        return None
+    return digits.zfill(14)
+
+
+def iter_sizes_files(data_folder: PathLike) -> Iterator[tuple[str, os.DirEntry]]:
+    """
+    Walk brand/material/filament/variant folders and yield every sizes.json
+    :returns: Tuples of (the variant folder relative to the data folder, the sizes.json DirEntry)
+    """
+    def sub_dirs(path: str) -> list[os.DirEntry]:
+        with os.scandir(path) as it:
+            return sorted((x for x in it if x.is_dir()), key=lambda x: x.name)
+
+    for brand_dir in sub_dirs(os.fspath(data_folder)):
+        for material_dir in sub_dirs(brand_dir.path):
+            for filament_dir in sub_dirs(material_dir.path):
+                for variant_dir in sub_dirs(filament_dir.path):
+                    with os.scandir(variant_dir.path) as it:
+                        for entry in it:
+                            if entry.name == "sizes.json" and entry.is_file():
+                                yield f"{brand_dir.name}/{material_dir.name}/{filament_dir.name}/{variant_dir.name}", entry
+
+
+class _NameCache:
+    """Caches the names read from brand.json/material.json/filament.json/variant.json per folder"""
+
+    FILES = [("brand.json", "brand"), ("material.json", "material"), ("filament.json", "name"),
+             ("variant.json", "color_name")]
+
+    def __init__(self, data_folder: Path):
+        self.data_folder = data_folder
+        self.__names: dict[str, Optional[str]] = {}
+
+    def names(self, variant_path: str) -> list[Optional[str]]:
+        """Returns the brand, material, filament and color names of the variant folder"""
+        parts = variant_path.split("/")
+        res = []
+        for depth, (file_name, key) in enumerate(self.FILES):
+            folder = "/".join(parts[:depth + 1])
+            if folder not in self.__names:
+                data = load_json(self.data_folder.joinpath(folder, file_name))
+                self.__names[folder] = data.get(key) if isinstance(data, dict) else None
+            res.append(self.__names[folder])
+        return res
+
+
+# ---------------------------------
+# Identifier Index
+# ---------------------------------
+
+class IdentifierMatch(NamedTuple):
+    field: str  # The sizes.json field that matched
+    code: str  # The stored (normalized) code
+    variant_path: str  # The variant folder, relative to the data folder
+    size_index: int  # The index of the size within sizes.json
+    brand: Optional[str]
+    material: Optional[str]
+    filament: Optional[str]
+    color_name: Optional[str]
+    filament_weight: Optional[float]
+    diameter: Optional[float]
+
+
+class IdentifierIndex:
+    """
+    A persistent SQLite index from scanned codes (GTIN/EAN/article number/barcode/NFC/QR) to sizes
+
+    sync() indexes the data folder in a single pass and afterwards only re-indexes the sizes.json files
+    whose modification time or size changed, update_sizes_file() re-indexes a single file.
+    """
+
+    SCHEMA_VERSION = "1"
+
+    def __init__(self, data_folder: PathLike = "data", index_path: Optional[PathLike] = None):
+        self.data_folder = Path(data_folder)
+        if index_path is None:
+            index_path = index_output_path.joinpath("identifier_index.sqlite")
+        self.index_path = Path(index_path)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.__conn = sqlite3.connect(self.index_path)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA mmap_size=268435456")
+        self.__init_schema()
+
+    def __init_schema(self):
+        conn = self.__conn
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if row is not None and row[0] != self.SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS files")
+            conn.execute("DROP TABLE IF EXISTS identifiers")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                variant_path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS identifiers (
+                code TEXT NOT NULL,
+                field TEXT NOT NULL,
+                variant_path TEXT NOT NULL,
+                size_index INTEGER NOT NULL,
+                brand TEXT,
+                material TEXT,
+                filament TEXT,
+                color_name TEXT,
+                filament_weight REAL,
+                diameter REAL
+            );
+            CREATE INDEX IF NOT EXISTS identifiers_code ON identifiers (code);
+            CREATE INDEX IF NOT EXISTS identifiers_variant_path ON identifiers (variant_path);
+        """)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (self.SCHEMA_VERSION,))
+        conn.commit()
+
+    def close(self):
+        self.__conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def __rows_for_sizes(variant_path: str, names: list[Optional[str]], sizes_data) -> list[tuple]:
+        rows = []
+        if not isinstance(sizes_data, list):
+            return rows
+        for size_index, size in enumerate(sizes_data):
+            if not isinstance(size, dict):
+                continue
+            codes: set[tuple[str, str]] = set()
+            for field in IDENTIFIER_FIELDS:
+                value = size.get(field)
+                if not isinstance(value, str) or not value.strip():
+                    continue
+                code = normalize_gtin(value) if field in GTIN_FIELDS else value.strip()
+                if code is None:
+                    code = value.strip()
+                codes.add((code, field))
+            for code, field in sorted(codes):
+                rows.append((code, field, variant_path, size_index, *names,
+                             size.get("filament_weight"), size.get("diameter")))
+        return rows
+
+    def __index_file(self, variant_path: str, stat: os.stat_result, names: _NameCache):
+        sizes_data = load_json(self.data_folder.joinpath(variant_path, "sizes.json"))
+        rows = self.__rows_for_sizes(variant_path, names.names(variant_path), sizes_data)
+        self.__conn.execute("DELETE FROM identifiers WHERE variant_path = ?", (variant_path,))
+        self.__conn.executemany("INSERT INTO identifiers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.__conn.execute("INSERT OR REPLACE INTO files (variant_path, mtime_ns, size) VALUES (?, ?, ?)",
+                            (variant_path, stat.st_mtime_ns, stat.st_size))
+
+    def __remove_file(self, variant_path: str):
+        self.__conn.execute("DELETE FROM identifiers WHERE variant_path = ?", (variant_path,))
+        self.__conn.execute("DELETE FROM files WHERE variant_path = ?", (variant_path,))
+
+    def sync(self) -> tuple[int, int]:
+        """
+        Bring the index up to date with the data folder
+        :returns: The number of (re-)indexed and removed sizes.json files
+        """
+        known = {row[0]: (row[1], row[2]) for row in
+                 self.__conn.execute("SELECT variant_path, mtime_ns, size FROM files")}
+        names = _NameCache(self.data_folder)
+        indexed = 0
+        with self.__conn:
+            for variant_path, entry in iter_sizes_files(self.data_folder):
+                stat = entry.stat()
+                if known.pop(variant_path, None) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                self.__index_file(variant_path, stat, names)
+                indexed += 1
+            for variant_path in known:
+                self.__remove_file(variant_path)
+        return indexed, len(known)
+
+    def update_sizes_file(self, sizes_path: PathLike):
+        """Re-index a single sizes.json file, or remove it from the index if it no longer exists"""
+        variant_path = Path(sizes_path).parent.resolve().relative_to(self.data_folder.resolve()).as_posix()
+        path = self.data_folder.joinpath(variant_path, "sizes.json")
+        with self.__conn:
+            if not path.exists():
+                self.__remove_file(variant_path)
+                return
+            self.__index_file(variant_path, path.stat(), _NameCache(self.data_folder))
+
+    def lookup(self, scanned_code: str) -> list[IdentifierMatch]:
+        """Find all sizes with an identifier matching the scanned code"""
+        code = scanned_code.strip()
+        candidates = {code}
+        gtin = normalize_gtin(code)
+        if gtin is not None:
+            candidates.add(gtin)
+        placeholders = ", ".join("?" for _ in candidates)
+        rows = self.__conn.execute(
+            f"SELECT field, code, variant_path, size_index, brand, material, filament, color_name, "
+            f"filament_weight, diameter FROM identifiers WHERE code IN ({placeholders}) "
+            f"ORDER BY variant_path, size_index, field",
+            tuple(candidates)
+        ).fetchall()
+        return [IdentifierMatch(*row) for row in rows]
+
+    def __len__(self):
+        return self.__conn.execute("SELECT COUNT(*) FROM identifiers").fetchone()[0]
+
+
+# ---------------------------------
+# Shipping Index
+# ---------------------------------
+
+# Location codes used by stores that cover several countries
+REGION_MEMBERS = {
+    "EU": ["AT", "BE", "BG", "HR", "CY", "CZ", "DK", "EE", "FI", "FR", "DE", "GR", "HU", "IE", "IT", "LV", "LT", "LU",
+           "MT", "NL", "PL", "PT", "RO", "SK", "SI", "ES", "SE"]
+}
+
+
+def location_codes(location: str) -> list[str]:
+    """The location code and every region that includes it"""
+    location = location.strip().upper()
+    return [location] + [k for k, v in REGION_MEMBERS.items() if location in v]
+
+
+class ShippingLink(NamedTuple):
+    variant_path: str  # The variant folder, relative to the data folder
+    size_index: int  # The index of the size within sizes.json
+    store_id: str
+    url: str
+
+
+class ShippingIndex:
+    """
+    An inverted index from location codes to purchase links, for questions like "what can ship to DE"
+
+    Each purchase link gets an integer id. Per location the ids of the links that ship to/from it are stored
+    as sorted int32 arrays, with the store fallback of SizePurchaseLink.get_ships_to()/get_ships_from() applied.
+    Brand, material and store filters are applied with vectorized lookups on per link code arrays.
+
+    sync() only re-reads the sizes.json and store.json files whose modification time or size changed,
+    the arrays are then rebuilt from the cached file contents.
+    """
+
+    VERSION = 1
+
+    def __init__(self, data_folder: PathLike = "data", stores_folder: PathLike = "stores",
+                 index_path: Optional[PathLike] = None):
+        self.data_folder = Path(data_folder)
+        self.stores_folder = Path(stores_folder)
+        if index_path is None:
+            index_path = index_output_path.joinpath("shipping_index.npz")
+        self.index_path = Path(index_path)
+
+        # Parsed source files, keyed by variant path/store folder: (signature, data)
+        self.__files: dict[str, tuple[list[int], dict]] = {}
+        self.__stores: dict[str, tuple[list[int], dict]] = {}
+
+        self.variant_paths: list[str] = []
+        self.brands: list[str] = []
+        self.materials: list[str] = []
+        self.store_ids: list[str] = []
+        self.link_variant = np.zeros(0, dtype=np.int32)
+        self.link_size_index = np.zeros(0, dtype=np.int32)
+        self.link_brand = np.zeros(0, dtype=np.int32)
+        self.link_material = np.zeros(0, dtype=np.int32)
+        self.link_store = np.zeros(0, dtype=np.int32)
+        self.link_urls: list[str] = []
+        self.ships_to: dict[str, np.ndarray] = {}
+        self.ships_from: dict[str, np.ndarray] = {}
+
+        self.__load()
+
+    def __len__(self):
+        return len(self.link_urls)
+
+    # Persistence
+
+    def __load(self):
+        if not self.index_path.exists():
+            return
+        try:
+            with np.load(self.index_path, allow_pickle=False) as archive:
+                meta = json.loads(archive["__meta__"].item())
+                if meta.get("version") != self.VERSION:
+                    return
+                self.__files = {k: (v[0], v[1]) for k, v in meta["files"].items()}
+                self.__stores = {k: (v[0], v[1]) for k, v in meta["stores"].items()}
+                for name in ("variant_paths", "brands", "materials", "store_ids", "link_urls"):
+                    setattr(self, name, meta[name])
+                for name in ("link_variant", "link_size_index", "link_brand", "link_material", "link_store"):
+                    setattr(self, name, archive[name])
+                self.ships_to = {k.removeprefix("to:"): archive[k] for k in archive.files if k.startswith("to:")}
+                self.ships_from = {k.removeprefix("from:"): archive[k] for k in archive.files if k.startswith("from:")}
+        except (OSError, ValueError, KeyError):
+            print(f"Failed to load the shipping index, it will be rebuilt: {self.index_path.__str__()}")
+            self.__files = {}
+            self.__stores = {}
+
+    def save(self):
+        meta = {
+            "version": self.VERSION,
+            "files": self.__files,
+            "stores": self.__stores,
+            "variant_paths": self.variant_paths,
+            "brands": self.brands,
+            "materials": self.materials,
+            "store_ids": self.store_ids,
+            "link_urls": self.link_urls
+        }
+        arrays = {
+            "link_variant": self.link_variant,
+            "link_size_index": self.link_size_index,
+            "link_brand": self.link_brand,
+            "link_material": self.link_material,
+            "link_store": self.link_store
+        }
+        arrays.update({f"to:{k}": v for k, v in self.ships_to.items()})
+        arrays.update({f"from:{k}": v for k, v in self.ships_from.items()})
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp.npz")
+        np.savez(tmp_path, __meta__=np.array(json.dumps(meta, ensure_ascii=False)), **arrays)
+        os.replace(tmp_path, self.index_path)
+
+    # Building
+
+    def sync(self) -> int:
+        """
+        Re-read changed sizes.json/store.json files and rebuild the index if anything changed
+        :returns: The number of changed (including removed) files
+        """
+        changed = 0
+
+        remaining_stores = set(self.__stores.keys())
+        with os.scandir(self.stores_folder) as it:
+            for store_dir in sorted((x for x in it if x.is_dir()), key=lambda x: x.name):
+                store_file = Path(store_dir.path).joinpath("store.json")
+                if not store_file.exists():
+                    continue
+                remaining_stores.discard(store_dir.name)
+                stat = store_file.stat()
+                signature = [stat.st_mtime_ns, stat.st_size]
+                previous = self.__stores.get(store_dir.name)
+                if previous is not None and previous[0] == signature:
+                    continue
+                json_data = load_json(store_file)
+                if not isinstance(json_data, dict):
+                    json_data = {}
+                self.__stores[store_dir.name] = (signature, {
+                    "id": json_data.get("id"),
+                    "ships_from": normalize_locations(json_data.get("ships_from")),
+                    "ships_to": normalize_locations(json_data.get("ships_to"))
+                })
+                changed += 1
+        for folder in remaining_stores:
+            del self.__stores[folder]
+            changed += 1
+
+        remaining = set(self.__files.keys())
+        names = _NameCache(self.data_folder)
+        for variant_path, entry in iter_sizes_files(self.data_folder):
+            remaining.discard(variant_path)
+            stat = entry.stat()
+            signature = [stat.st_mtime_ns, stat.st_size]
+            previous = self.__files.get(variant_path)
+            if previous is not None and previous[0] == signature:
+                continue
+            brand, material = names.names(variant_path)[:2]
+            links = []
+            sizes_data = load_json(entry.path)
+            for size_index, size in enumerate(sizes_data if isinstance(sizes_data, list) else []):
+                for link in size.get("purchase_links", []) if isinstance(size, dict) else []:
+                    links.append([
+                        size_index,
+                        link.get("store_id"),
+                        link.get("url"),
+                        normalize_locations(link.get("ships_from")),
+                        normalize_locations(link.get("ships_to"))
+                    ])
+            self.__files[variant_path] = (signature, {"brand": brand, "material": material, "links": links})
+            changed += 1
+        for variant_path in remaining:
+            del self.__files[variant_path]
+            changed += 1
+
+        if changed or not self.index_path.exists():
+            self.__rebuild()
+            self.save()
+        return changed
+
+    def __rebuild(self):
+        """Rebuild the link arrays and the inverted indexes from the parsed files"""
+        variant_paths: list[str] = []
+        brands: dict[str, int] = {}
+        materials: dict[str, int] = {}
+        stores = {v[1]["id"]: v[1] for v in self.__stores.values() if v[1]["id"] is not None}
+        store_ids = {k: i for i, k in enumerate(sorted(stores.keys()))}
+
+        link_variant, link_size_index, link_brand, link_material, link_store = [], [], [], [], []
+        link_urls: list[str] = []
+        to_pairs: list[tuple[str, int]] = []
+        from_pairs: list[tuple[str, int]] = []
+
+        for variant_path in sorted(self.__files.keys()):
+            data = self.__files[variant_path][1]
+            variant_code = len(variant_paths)
+            variant_paths.append(variant_path)
+            brand_code = brands.setdefault(data["brand"] or "", len(brands))
+            material_code = materials.setdefault(data["material"] or "", len(materials))
+            for size_index, store_id, url, ships_from, ships_to in data["links"]:
+                store = stores.get(store_id)
+                if store is None:
+                    # Invalid store IDs are reported by data_validator.py
+                    continue
+                link_id = len(link_urls)
+                link_variant.append(variant_code)
+                link_size_index.append(size_index)
+                link_brand.append(brand_code)
+                link_material.append(material_code)
+                link_store.append(store_ids[store_id])
+                link_urls.append(url)
+                # Same fallback as SizePurchaseLink.get_ships_to()/get_ships_from()
+                to_pairs.extend((x, link_id) for x in (ships_to or store["ships_to"]))
+                from_pairs.extend((x, link_id) for x in (ships_from or store["ships_from"]))
+
+        self.variant_paths = variant_paths
+        self.brands = list(brands.keys())
+        self.materials = list(materials.keys())
+        self.store_ids = list(store_ids.keys())
+        self.link_variant = np.asarray(link_variant, dtype=np.int32)
+        self.link_size_index = np.asarray(link_size_index, dtype=np.int32)
+        self.link_brand = np.asarray(link_brand, dtype=np.int32)
+        self.link_material = np.asarray(link_material, dtype=np.int32)
+        self.link_store = np.asarray(link_store, dtype=np.int32)
+        self.link_urls = link_urls
+        self.ships_to = self.__postings(to_pairs)
+        self.ships_from = self.__postings(from_pairs)
+
+    @staticmethod
+    def __postings(pairs: list[tuple[str, int]]) -> dict[str, np.ndarray]:
+        postings: dict[str, list[int]] = {}
+        for location, link_id in pairs:
+            postings.setdefault(location, []).append(link_id)
+        # Link ids are assigned in increasing order so every list is already sorted, duplicates are removed
+        return {k: np.unique(np.asarray(v, dtype=np.int32)) for k, v in sorted(postings.items())}
+
+    # Queries
+
+    def __location_links(self, postings: dict[str, np.ndarray], location: str) -> np.ndarray:
+        found = [postings[x] for x in location_codes(location) if x in postings]
+        if not found:
+            return np.zeros(0, dtype=np.int32)
+        res = found[0]
+        for x in found[1:]:
+            res = np.union1d(res, x)
+        return res
+
+    @staticmethod
+    def __codes(dictionary: list[str], values: Optional[str | list[str]]) -> np.ndarray:
+        if isinstance(values, str):
+            values = [values]
+        lookup = {k.lower(): i for i, k in enumerate(dictionary)}
+        return np.asarray([lookup[x.lower()] for x in values if x.lower() in lookup], dtype=np.int32)
+
+    def query(self,
+              ships_to: Optional[str] = None,
+              ships_from: Optional[str] = None,
+              brand: Optional[str | list[str]] = None,
+              material: Optional[str | list[str]] = None,
+              store: Optional[str | list[str]] = None) -> np.ndarray:
+        """
+        Find purchase links matching all the provided filters
+        Location codes also match regions that contain them (e.g. "DE" matches links shipping to "EU")
+        :returns: The sorted ids of the matching links
+        """
+        links: Optional[np.ndarray] = None
+        for postings, location in ((self.ships_to, ships_to), (self.ships_from, ships_from)):
+            if location is None:
+                continue
+            location_links = self.__location_links(postings, location)
+            links = location_links if links is None else np.intersect1d(links, location_links, assume_unique=True)
+        if links is None:
+            links = np.arange(len(self), dtype=np.int32)
+        for values, dictionary, codes in ((brand, self.brands, self.link_brand),
+                                          (material, self.materials, self.link_material),
+                                          (store, self.store_ids, self.link_store)):
+            if values is not None:
+                links = links[np.isin(codes[links], self.__codes(dictionary, values))]
+        return links
+
+    def links(self, link_ids: np.ndarray) -> list[ShippingLink]:
+        return [ShippingLink(self.variant_paths[self.link_variant[i]], int(self.link_size_index[i]),
+                             self.store_ids[self.link_store[i]], self.link_urls[i]) for i in link_ids.tolist()]
+
+    def sizes(self, link_ids: np.ndarray) -> list[tuple[str, int]]:
+        """The distinct (variant path, size index) pairs of the links"""
+        keys = np.unique(self.link_variant[link_ids].astype(np.int64) << 16 | self.link_size_index[link_ids])
+        return [(self.variant_paths[x >> 16], int(x & 0xFFFF)) for x in keys.tolist()]
+
+
+# ---------------------------------
+# Search Index
+# ---------------------------------
+
+SEARCH_SPLIT_PATTERN = re.compile(r"[\W_]+")
+
+# The JSON file of each folder depth and the kind of document it creates
+SEARCH_FILES = [("brand.json", "brand"), ("material.json", "material"), ("filament.json", "filament"),
+                ("variant.json", "variant")]
+# Color standards of variants that are searchable
+SEARCH_COLOR_STANDARDS = ["ral", "pantone", "ncs"]
+
+
+def normalize_search_text(text: str) -> list[str]:
+    """Split text into case folded tokens without accents or punctuation"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return [x for x in SEARCH_SPLIT_PATTERN.split(text) if x]
+
+
+def token_trigrams(token: str) -> list[str]:
+    """The trigrams of a token padded with spaces, so short tokens and word boundaries get trigrams too"""
+    padded = f" {token} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+class SearchResult(NamedTuple):
+    score: float
+    kind: str  # "brand", "material", "filament" or "variant"
+    path: str  # The folder relative to the data folder
+    name: str  # The brand, material, filament or color name
+    text: str  # Everything that was searched, including the names of the parents
+
+
+class _Postings:
+    """An inverted index from keys to sorted document ids, stored as CSR arrays"""
+
+    def __init__(self, keys: list[str], offsets: np.ndarray, docs: np.ndarray):
+        self.keys = keys
+        self.offsets = offsets
+        self.docs = docs
+        self.__lookup = {k: i for i, k in enumerate(keys)}
+
+    @classmethod
+    def build(cls, doc_keys: list[set[str]]) -> '_Postings':
+        postings: dict[str, list[int]] = {}
+        for doc_id, keys in enumerate(doc_keys):
+            for key in keys:
+                postings.setdefault(key, []).append(doc_id)
+        keys = sorted(postings.keys())
+        offsets = np.zeros(len(keys) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum([len(postings[k]) for k in keys])
+        docs = np.fromiter((x for k in keys for x in postings[k]), dtype=np.int32, count=int(offsets[-1]))
+        return cls(keys, offsets, docs)
+
+    def get(self, key: str) -> np.ndarray:
+        idx = self.__lookup.get(key)
+        if idx is None:
+            return np.zeros(0, dtype=np.int32)
+        return self.docs[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def prefix_range(self, prefix: str) -> tuple[int, int]:
+        """The range of keys that start with the prefix, keys are sorted so this is a binary search"""
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start)
+        return start, end
+
+    def get_range(self, start: int, end: int) -> np.ndarray:
+        return self.docs[self.offsets[start]:self.offsets[end]]
+
+
+class SearchIndex:
+    """
+    A full text search index over brand, material, filament and color names (and color standards)
+
+    Every brand, material, filament and variant is a document. Documents include the names of their parents,
+    so "bambu basic jade" finds the Jade White variant of Bambu Lab's PLA Basic.
+    search() is typo tolerant: candidates are found by their trigram similarity (Dice coefficient) to the query,
+    and the best of them are reranked by per token edit similarity. complete() is prefix autocomplete on tokens.
+
+    The index is persisted as CSR arrays. sync() only re-reads the JSON files whose modification time or size
+    changed, the postings are then rebuilt from the cached file contents.
+    """
+
+    VERSION = 1
+    # Results below this trigram similarity are dropped
+    MIN_SCORE = 0.3
+    # The number of candidates per requested result that are reranked
+    RERANK_FACTOR = 4
+    # Autocomplete ranks shorter documents higher, and brands over materials over filaments over variants
+    KIND_ORDER = {"brand": 0, "material": 1, "filament": 2, "variant": 3}
+
+    def __init__(self, data_folder: PathLike = "data", index_path: Optional[PathLike] = None):
+        self.data_folder = Path(data_folder)
+        if index_path is None:
+            index_path = index_output_path.joinpath("search_index.npz")
+        self.index_path = Path(index_path)
+
+        # Parsed source files, keyed by folder relative to the data folder: (signature, fields)
+        self.__files: dict[str, tuple[list[int], dict]] = {}
+
+        self.doc_kinds: list[str] = []
+        self.doc_paths: list[str] = []
+        self.doc_names: list[str] = []
+        self.doc_texts: list[str] = []
+        self.doc_trigram_count = np.zeros(0, dtype=np.int32)
+        self.doc_order = np.zeros(0, dtype=np.int32)
+        self.trigrams = _Postings([], np.zeros(1, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        self.tokens = _Postings([], np.zeros(1, dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+        self.__load()
+
+    def __len__(self):
+        return len(self.doc_paths)
+
+    # Persistence
+
+    def __load(self):
+        if not self.index_path.exists():
+            return
+        try:
+            with np.load(self.index_path, allow_pickle=False) as archive:
+                meta = json.loads(archive["__meta__"].item())
+                if meta.get("version") != self.VERSION:
+                    return
+                self.__files = {k: (v[0], v[1]) for k, v in meta["files"].items()}
+                for name in ("doc_kinds", "doc_paths", "doc_names", "doc_texts"):
+                    setattr(self, name, meta[name])
+                self.doc_trigram_count = archive["doc_trigram_count"]
+                self.doc_order = archive["doc_order"]
+                self.trigrams = _Postings(meta["trigrams"], archive["trigram_offsets"], archive["trigram_docs"])
+                self.tokens = _Postings(meta["tokens"], archive["token_offsets"], archive["token_docs"])
+        except (OSError, ValueError, KeyError):
+            print(f"Failed to load the search index, it will be rebuilt: {self.index_path.__str__()}")
+            self.__files = {}
+
+    def save(self):
+        meta = {
+            "version": self.VERSION,
+            "files": self.__files,
+            "doc_kinds": self.doc_kinds,
+            "doc_paths": self.doc_paths,
+            "doc_names": self.doc_names,
+            "doc_texts": self.doc_texts,
+            "trigrams": self.trigrams.keys,
+            "tokens": self.tokens.keys
+        }
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp.npz")
+        np.savez(tmp_path, __meta__=np.array(json.dumps(meta, ensure_ascii=False)),
+                 doc_trigram_count=self.doc_trigram_count,
+                 doc_order=self.doc_order,
+                 trigram_offsets=self.trigrams.offsets,
+                 trigram_docs=self.trigrams.docs,
+                 token_offsets=self.tokens.offsets,
+                 token_docs=self.tokens.docs)
+        os.replace(tmp_path, self.index_path)
+
+    # Building
+
+    @staticmethod
+    def __fields(kind: str, json_data) -> dict:
+        if not isinstance(json_data, dict):
+            return {}
+        if kind == "brand":
+            return {"name": json_data.get("brand")}
+        if kind == "material":
+            return {"name": json_data.get("material")}
+        if kind == "filament":
+            return {"name": json_data.get("name")}
+        standards = json_data.get("color_standards")
+        if not isinstance(standards, dict):
+            standards = {}
+        return {"name": json_data.get("color_name"),
+                "standards": [str(standards[x]) for x in SEARCH_COLOR_STANDARDS if standards.get(x)]}
+
+    def sync(self) -> int:
+        """
+        Re-read changed brand/material/filament/variant JSON files and rebuild the index if anything changed
+        :returns: The number of changed (including removed) files
+        """
+        changed = 0
+        remaining = set(self.__files.keys())
+
+        def walk(folder: str, rel_path: str, depth: int):
+            nonlocal changed
+            file_name, kind = SEARCH_FILES[depth]
+            json_path = os.path.join(folder, file_name)
+            try:
+                stat = os.stat(json_path)
+            except OSError:
+                # Folders without their JSON file are skipped by the loader too
+                return
+            remaining.discard(rel_path)
+            signature = [stat.st_mtime_ns, stat.st_size]
+            previous = self.__files.get(rel_path)
+            if previous is None or previous[0] != signature:
+                self.__files[rel_path] = (signature, self.__fields(kind, load_json(json_path)))
+                changed += 1
+            if depth + 1 < len(SEARCH_FILES):
+                with os.scandir(folder) as it:
+                    for entry in sorted((x for x in it if x.is_dir()), key=lambda x: x.name):
+                        walk(entry.path, f"{rel_path}/{entry.name}", depth + 1)
+
+        with os.scandir(self.data_folder) as it:
+            for brand_dir in sorted((x for x in it if x.is_dir()), key=lambda x: x.name):
+                walk(brand_dir.path, brand_dir.name, 0)
+        for rel_path in remaining:
+            del self.__files[rel_path]
+            changed += 1
+
+        if changed or not self.index_path.exists():
+            self.__rebuild()
+            self.save()
+        return changed
+
+    def __rebuild(self):
+        kinds, paths, names, texts = [], [], [], []
+        doc_trigrams: list[set[str]] = []
+        doc_tokens: list[set[str]] = []
+
+        for rel_path in sorted(self.__files.keys()):
+            fields = self.__files[rel_path][1]
+            parts = rel_path.split("/")
+            kind = SEARCH_FILES[len(parts) - 1][1]
+            name = fields.get("name")
+            if not name:
+                continue
+            # The parent names, unless they are already part of a name further down (e.g. material "PLA", filament "PLA Basic")
+            chain = [self.__files.get("/".join(parts[:depth + 1]), (None, {}))[1].get("name") or ""
+                     for depth in range(len(parts) - 1)] + [name]
+            words = [x for i, x in enumerate(chain)
+                     if x and not any(x.casefold() in y.casefold() for y in chain[i + 1:])]
+            words.extend(fields.get("standards", []))
+            text = " ".join(words)
+
+            tokens = normalize_search_text(text)
+            kinds.append(kind)
+            paths.append(rel_path)
+            names.append(name)
+            texts.append(text)
+            doc_tokens.append(set(tokens))
+            doc_trigrams.append({t for token in tokens for t in token_trigrams(token)})
+
+        self.doc_kinds = kinds
+        self.doc_paths = paths
+        self.doc_names = names
+        self.doc_texts = texts
+        self.doc_trigram_count = np.asarray([len(x) for x in doc_trigrams], dtype=np.int32)
+        # Autocomplete rank of every document, lower is better
+        rank = sorted(range(len(paths)), key=lambda i: (self.KIND_ORDER[kinds[i]], len(texts[i]), texts[i]))
+        self.doc_order = np.zeros(len(paths), dtype=np.int32)
+        self.doc_order[rank] = np.arange(len(paths), dtype=np.int32)
+        self.trigrams = _Postings.build(doc_trigrams)
+        self.tokens = _Postings.build(doc_tokens)
+
+    # Queries
+
+    def __result(self, doc_id: int, score: float) -> SearchResult:
+        return SearchResult(score, self.doc_kinds[doc_id], self.doc_paths[doc_id], self.doc_names[doc_id],
+                            self.doc_texts[doc_id])
+
+    def __kind_mask(self, kinds: Optional[list[str]]) -> Optional[np.ndarray]:
+        if kinds is None:
+            return None
+        return np.isin(np.asarray(self.doc_kinds), kinds)
+
+    def search(self, query: str, limit: int = 10, kinds: Optional[list[str]] = None) -> list[SearchResult]:
+        """
+        Typo tolerant ranked search
+        :param query: The text to search for
+        :param limit: The max number of results
+        :param kinds: Only return these kinds of documents ("brand", "material", "filament", "variant")
+        """
+        tokens = normalize_search_text(query)
+        query_trigrams = {t for token in tokens for t in token_trigrams(token)}
+        if not query_trigrams or not len(self) or limit <= 0:
+            return []
+
+        shared = np.bincount(np.concatenate([self.trigrams.get(t) for t in query_trigrams]), minlength=len(self))
+        scores = 2.0 * shared / (len(query_trigrams) + self.doc_trigram_count)
+
+        mask = scores >= self.MIN_SCORE
+        kind_mask = self.__kind_mask(kinds)
+        if kind_mask is not None:
+            mask &= kind_mask
+        candidates = np.flatnonzero(mask)
+        rerank_count = limit * self.RERANK_FACTOR
+        if len(candidates) > rerank_count:
+            candidates = candidates[np.argpartition(-scores[candidates], rerank_count - 1)[:rerank_count]]
+
+        # Trigram similarity favours short names, so the best candidates are reranked by how well
+        # every query token matches its closest document token
+        results = []
+        for doc_id in candidates.tolist():
+            doc_tokens = normalize_search_text(self.doc_texts[doc_id])
+            token_score = sum(max(difflib.SequenceMatcher(None, token, x).ratio() for x in doc_tokens)
+                              for token in tokens) / len(tokens)
+            score = (float(scores[doc_id]) + token_score) / 2
+            results.append((-score, int(self.doc_order[doc_id]), doc_id))
+        results.sort()
+        return [self.__result(doc_id, -score) for score, _, doc_id in results[:limit]]
+
+    def complete(self, prefix: str, limit: int = 10, kinds: Optional[list[str]] = None) -> list[SearchResult]:
+        """
+        Prefix autocomplete, every token must match and the last token may be incomplete
+        Results are ordered by kind (brands first) and then by length
+        """
+        tokens = normalize_search_text(prefix)
+        if not tokens or not len(self) or limit <= 0:
+            return []
+
+        start, end = self.tokens.prefix_range(tokens[-1])
+        docs = np.unique(self.tokens.get_range(start, end))
+        for token in tokens[:-1]:
+            if not len(docs):
+                break
+            docs = np.intersect1d(docs, self.tokens.get(token), assume_unique=True)
+
+        kind_mask = self.__kind_mask(kinds)
+        if kind_mask is not None:
+            docs = docs[kind_mask[docs]]
+        order = self.doc_order[docs]
+        if len(docs) > limit:
+            keep = np.argpartition(order, limit - 1)[:limit]
+            docs, order = docs[keep], order[keep]
+        docs = docs[np.argsort(order)]
+        return [self.__result(int(i), 1.0) for i in docs]
+
+
+# If running from the command line, provide argument parsing
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--data-path", default="data", help="Set the path of the data folder to index")
+    parser.add_argument("--index-path", help="Set the output path for the index files")
+    parser.add_argument("--lookup", nargs="*", default=[], help="Look up scanned codes (GTIN/EAN/article number/...)")
+    parser.add_argument("--ships-to", help="List the sizes that can be shipped to this location code")
+    parser.add_argument("--brand", help="Only include this brand in --ships-to results")
+    parser.add_argument("--material", help="Only include this material in --ships-to results")
+    parser.add_argument("--store", help="Only include this store ID in --ships-to results")
+    parser.add_argument("--search", help="Typo tolerant search for brands, materials, filaments and colors")
+    parser.add_argument("--complete", help="Autocomplete a brand, material, filament or color name")
+    args = parser.parse_args()
+
+    if isinstance(args.index_path, str):
+        index_output_path = Path(args.index_path)
+
+    with IdentifierIndex(args.data_path) as identifier_index:
+        updated, removed = identifier_index.sync()
+        print(f"Identifier index: {updated} files indexed, {removed} removed, {len(identifier_index)} identifiers")
+        for scanned in args.lookup:
+            matches = identifier_index.lookup(scanned)
+            if not matches:
+                print(f"{scanned}: no match")
+            for match in matches:
+                print(f"{scanned}: {match.brand} / {match.material} / {match.filament} / {match.color_name} "
+                      f"({match.filament_weight}g, {match.diameter}mm) [{match.field}]")
+
+    if args.ships_to is not None:
+        shipping_index = ShippingIndex(args.data_path)
+        shipping_index.sync()
+        found = shipping_index.query(ships_to=args.ships_to, brand=args.brand, material=args.material,
+                                     store=args.store)
+        for path, index in shipping_index.sizes(found):
+            print(f"{path} [{index}]")
+        print(f"{len(found)} purchase links, {len(shipping_index.sizes(found))} sizes ship to {args.ships_to}")
+
+    if args.search is not None or args.complete is not None:
+        search_index = SearchIndex(args.data_path)
+        search_index.sync()
+        if args.search is not None:
+            for result in search_index.search(args.search):
+                print(f"{result.score:.2f} {result.kind:<8} {result.text} ({result.path})")
+        if args.complete is not None:
+            for result in search_index.complete(args.complete):
+                print(f"{result.kind:<8} {result.text} ({result.path})")
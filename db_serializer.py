@@ -1,13 +1,20 @@
+import gzip
+import hashlib
+import itertools
 import json
 import os
+import pickle
 import re
+import shutil
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Optional, Any, Union, Self
+from typing import Optional, Any, Union, Self, NamedTuple, Iterator, Iterable
 
-from jsonschema.exceptions import ValidationError
-from jsonschema.validators import validate
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 
 PathLike = Union[str, os.PathLike[str]]
 
@@ -47,6 +54,53 @@ def cleanse_folder_name(name: str) -> str:
     return name.replace("/", " ").strip()
 
 
+def normalize_locations(locations: Optional[str | list[str]]) -> list[str]:
+    """
+    ships_from/ships_to values may be a list or a (comma separated) string
+    Returns them as a list of upper case location codes
+    """
+    if locations is None:
+        return []
+    if isinstance(locations, str):
+        locations = [locations]
+    res: list[str] = []
+    for item in locations:
+        res.extend(x.strip().upper() for x in item.split(",") if x.strip())
+    return res
+
+
+GTIN_PATTERN = re.compile(r"^[0-9]{12,13}$")
+EAN_PATTERN = re.compile(r"^[0-9]{13}$")
+
+
+def normalize_gtin_ean(gtin: Optional[str], ean: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    """
+    Normalize and validate GTIN/EAN per rules
+    A 13 digit value is used for both when only one of them is set
+    :returns: The normalized (gtin, ean)
+    """
+    gtin = gtin.strip() if isinstance(gtin, str) else gtin
+    ean = ean.strip() if isinstance(ean, str) else ean
+
+    # Input normalization
+    if (not gtin) and ean and EAN_PATTERN.fullmatch(ean):
+        gtin = ean
+    if gtin and (not ean) and len(gtin) == 13:
+        ean = gtin
+
+    # Validation rules
+    if gtin is not None:
+        if not GTIN_PATTERN.fullmatch(gtin):
+            raise Exception("Invalid gtin: must be 12 or 13 digits only")
+    if ean is not None:
+        if not EAN_PATTERN.fullmatch(ean):
+            raise Exception("Invalid ean: must be exactly 13 digits")
+    if gtin and ean:
+        if len(gtin) == 13 and len(ean) == 13 and gtin != ean:
+            raise Exception("Mismatch between gtin and ean (both 13 digits); they must match")
+    return gtin, ean
+
+
 def get_json_from_file(json_path: PathLike):
     """
     Attempt to load JSON from the specified path
@@ -64,19 +118,30 @@ def get_json_from_file(json_path: PathLike):
     return None
 
 
+# Compiled validators for each schema, keyed by the id of the schema dict
+# The schema is only checked once, instead of on every validation
+_validators: dict[int, Any] = {}
+
+
 def validate_json(json_data, schema) -> bool:
     """
     Validate the json data with the provided schema
     If valid, returns true.
     If not valid, returns false and emits an error message
     """
-    try:
-        validate(json_data, schema)
+    validator = _validators.get(id(schema))
+    if validator is None or validator.schema is not schema:
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        _validators[id(schema)] = validator
+
+    error = best_match(validator.iter_errors(json_data))
+    if error is None:
         return True
-    except ValidationError as error:
-        print(
-            f"Failed to validate json. JSON path: {error.json_path}, Error: {error.message}, JSON file: {last_json_file_loaded}")
-        return False
+    print(
+        f"Failed to validate json. JSON path: {error.json_path}, Error: {error.message}, JSON file: {last_json_file_loaded}")
+    return False
 
 
 # These will be inited at the end of the file
@@ -302,6 +367,16 @@ class SizePurchaseLink(IToFromJSONData):
             return self.ships_to
         return self.store.ships_to
 
+    # Pickle the store by its ID so unpickled links point to the loaded stores
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["store"] = self.store.store_id
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.store = stores[state["store"]]
+
     def to_dict(self):
         return shallow_remove_empty({
             "store_id": self.store.store_id,
@@ -356,30 +431,7 @@ class FilamentSize(IToFromJSONData):
         self.diameter = diameter
         self.empty_spool_weight = empty_spool_weight
         self.spool_core_diameter = spool_core_diameter
-        # Normalize and validate GTIN/EAN per rules
-        gtin = gtin.strip() if isinstance(gtin, str) else gtin
-        ean = ean.strip() if isinstance(ean, str) else ean
-
-        gtin_pattern = re.compile(r"^[0-9]{12,13}$")
-        ean_pattern = re.compile(r"^[0-9]{13}$")
-
-        # Input normalization
-        if (not gtin) and ean and ean_pattern.fullmatch(ean):
-            gtin = ean
-        if gtin and (not ean) and len(gtin) == 13:
-            ean = gtin
-
-        # Validation rules
-        if gtin is not None:
-            if not gtin_pattern.fullmatch(gtin):
-                raise Exception("Invalid gtin: must be 12 or 13 digits only")
-        if ean is not None:
-            if not ean_pattern.fullmatch(ean):
-                raise Exception("Invalid ean: must be exactly 13 digits")
-        if gtin and ean:
-            if len(gtin) == 13 and len(ean) == 13 and gtin != ean:
-                raise Exception("Mismatch between gtin and ean (both 13 digits); they must match")
-
+        gtin, ean = normalize_gtin_ean(gtin, ean)
         self.gtin = gtin
         self.ean = ean
         self.article_number = article_number
@@ -632,7 +684,98 @@ class FilamentVariant(IToFromFS):
 # For filament.json and material.json
 # ---------------------------------
 
-class GenericSlicerSettings(IToFromJSONData):
+# Every modification of slicer settings takes a new stamp from this counter
+# Cached values derived from slicer settings store the newest stamp they were computed from
+_modification_stamps = itertools.count(1)
+
+
+def _read_only_error(obj: Any):
+    return Exception(f"This {type(obj).__name__} is read only, use deepcopy() to get a modifiable copy")
+
+
+class _TrackedOverrides(dict):
+    """A dict of slicer overrides that records a modification stamp whenever it is changed"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stamp = next(_modification_stamps)
+        self._frozen = False
+
+    def __modified(self):
+        if self._frozen:
+            raise _read_only_error(self)
+        self._stamp = next(_modification_stamps)
+
+    def __setitem__(self, key, value):
+        self.__modified()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.__modified()
+        super().__delitem__(key)
+
+    def __ior__(self, other):
+        self.__modified()
+        return super().__ior__(other)
+
+    def clear(self):
+        self.__modified()
+        super().clear()
+
+    def pop(self, *args):
+        self.__modified()
+        return super().pop(*args)
+
+    def popitem(self):
+        self.__modified()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.__modified()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.__modified()
+        super().update(*args, **kwargs)
+
+    def freeze(self):
+        self._frozen = True
+
+    # Copies are always modifiable
+    def __deepcopy__(self, memo):
+        return _TrackedOverrides(deepcopy(dict(self), memo))
+
+    def __reduce__(self):
+        return _TrackedOverrides, (dict(self),)
+
+
+class TrackedSettings(IToFromJSONData):
+    """
+    Base class for the slicer settings classes
+    Every attribute assignment records a new modification stamp, which is used to invalidate cached resolved settings
+    Frozen instances are shared between callers and are read only, deepcopy() returns a modifiable copy
+    """
+    _stamp = 0
+    _frozen = False
+
+    def __setattr__(self, key, value):
+        if self._frozen:
+            raise _read_only_error(self)
+        super().__setattr__(key, value)
+        object.__setattr__(self, "_stamp", next(_modification_stamps))
+
+    def latest_stamp(self) -> int:
+        """:returns: The newest modification stamp of this object and anything it contains"""
+        return self._stamp
+
+    def freeze(self):
+        object.__setattr__(self, "_frozen", True)
+
+    def __getstate__(self):
+        # Copies are always modifiable and start without any cached values
+        return {k: v for k, v in self.__dict__.items() if k not in ("_frozen", "_cache")}
+
+
+class GenericSlicerSettings(TrackedSettings):
     first_layer_bed_temp: Optional[int]
     first_layer_nozzle_temp: Optional[int]
     bed_temp: Optional[int]
@@ -659,7 +802,12 @@ class GenericSlicerSettings(IToFromJSONData):
             self.nozzle_temp = other.nozzle_temp
 
     def to_dict(self):
-        return shallow_remove_empty(self.__dict__)
+        return shallow_remove_empty({
+            "first_layer_bed_temp": self.first_layer_bed_temp,
+            "first_layer_nozzle_temp": self.first_layer_nozzle_temp,
+            "bed_temp": self.bed_temp,
+            "nozzle_temp": self.nozzle_temp
+        })
 
     @staticmethod
     def from_json_data(json_data: Optional[dict[str, Any]], parent: None = None) -> Optional['GenericSlicerSettings']:
@@ -674,7 +822,7 @@ class GenericSlicerSettings(IToFromJSONData):
         )
 
 
-class SpecificSlicerSettings(IToFromJSONData):
+class SpecificSlicerSettings(TrackedSettings):
     profile_name: str  # Required
     overrides: dict[str, str]
 
@@ -689,6 +837,19 @@ class SpecificSlicerSettings(IToFromJSONData):
         self.profile_name = profile_name
         self.overrides = overrides
 
+    def __setattr__(self, key, value):
+        # Keep the overrides tracked so changes to them invalidate cached resolved settings
+        if key == "overrides" and not isinstance(value, _TrackedOverrides):
+            value = _TrackedOverrides(value)
+        super().__setattr__(key, value)
+
+    def latest_stamp(self) -> int:
+        return max(self._stamp, self.overrides._stamp)
+
+    def freeze(self):
+        self.overrides.freeze()
+        super().freeze()
+
     def update(self, other: 'SpecificSlicerSettings'):
         if other is None: return
         self.profile_name = other.profile_name
@@ -711,13 +872,15 @@ class SpecificSlicerSettings(IToFromJSONData):
         )
 
 
-class SlicerSettings(IToFromJSONData):
+class SlicerSettings(TrackedSettings):
     prusaslicer: Optional[SpecificSlicerSettings]
     bambustudio: Optional[SpecificSlicerSettings]
     orcaslicer: Optional[SpecificSlicerSettings]
     cura: Optional[SpecificSlicerSettings]
     generic: Optional[GenericSlicerSettings]
 
+    FIELDS = ["prusaslicer", "bambustudio", "orcaslicer", "cura", "generic"]
+
     PS_MAP = {
         "first_layer_bed_temp": "first_layer_bed_temperature",
         "first_layer_nozzle_temp": "first_layer_temperature",
@@ -767,33 +930,42 @@ class SlicerSettings(IToFromJSONData):
             return attrib
         return None
 
+    def latest_stamp(self) -> int:
+        stamp = self._stamp
+        for var in self.FIELDS:
+            value = getattr(self, var)
+            if value is not None:
+                stamp = max(stamp, value.latest_stamp())
+        return stamp
+
+    def freeze(self):
+        for var in self.FIELDS:
+            value = getattr(self, var)
+            if value is not None:
+                value.freeze()
+        super().freeze()
+
     def get_prusaslicer_data(self):
-        if self.prusaslicer is None:
-            return None
-        prusaslicer = deepcopy(self.prusaslicer)
-        self.__map_generic_to_overrides(prusaslicer, self.PS_MAP)
-        return prusaslicer
+        return self.__get_mapped_data("prusaslicer", self.PS_MAP)
 
     def get_bambustudio_data(self):
-        if self.bambustudio is None:
-            return None
-        bambustudio = deepcopy(self.bambustudio)
-        self.__map_generic_to_overrides(bambustudio, self.BS_MAP)
-        return bambustudio
+        return self.__get_mapped_data("bambustudio", self.BS_MAP)
 
     def get_orcaslicer_data(self):
-        if self.orcaslicer is None:
-            return None
-        orcaslicer = deepcopy(self.orcaslicer)
-        self.__map_generic_to_overrides(orcaslicer, self.ORCA_MAP)
-        return orcaslicer
+        return self.__get_mapped_data("orcaslicer", self.ORCA_MAP)
 
     def get_cura_data(self):
-        if self.cura is None:
-            return None
-        cura = deepcopy(self.cura)
-        self.__map_generic_to_overrides(cura, self.CURA_MAP)
-        return cura
+        return self.__get_mapped_data("cura", self.CURA_MAP)
+
+    def get_base_profiles(self, slicer_name: str, catalog: 'ProfileCatalog') -> list['CatalogProfile']:
+        """
+        Find the profiles the settings of a slicer are based on
+        :returns: Every printer variant of the profile in the catalog, empty if there are no settings for the slicer
+        """
+        specific = self[slicer_name] if slicer_name in self.FIELDS else None
+        if not isinstance(specific, SpecificSlicerSettings):
+            return []
+        return catalog.find(slicer_name, specific.profile_name)
 
     def get_slicer_data(self, slicer_name: str):
         attrib = self.__getattribute__(f"get_{slicer_name}_data")
@@ -803,6 +975,31 @@ class SlicerSettings(IToFromJSONData):
                 return ret
         raise Exception(f"There is not a function named 'get_{slicer_name}_data' in SlicerSettings")
 
+    def __get_mapped_data(self, slicer_name: str, override_map: dict[str, str]) -> Optional[SpecificSlicerSettings]:
+        """
+        Get the settings of a slicer with the generic values mapped into its overrides
+        The result is cached until these settings are modified, it is shared and read only
+        """
+        specific_settings = getattr(self, slicer_name)
+        if specific_settings is None:
+            return None
+
+        cache = self.__dict__.get("_cache")
+        if cache is None:
+            cache = {}
+            object.__setattr__(self, "_cache", cache)
+
+        stamp = self.latest_stamp()
+        cached = cache.get(slicer_name)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        data = deepcopy(specific_settings)
+        self.__map_generic_to_overrides(data, override_map)
+        data.freeze()
+        cache[slicer_name] = (stamp, data)
+        return data
+
     def __map_generic_to_overrides(self, specific_settings: SpecificSlicerSettings, override_map: dict[str, str]):
         generic = self.generic
         if generic is None:
@@ -813,7 +1010,7 @@ class SlicerSettings(IToFromJSONData):
                 specific_settings.overrides[v] = value
 
     def update(self, other: 'SlicerSettings'):
-        for var in ["prusaslicer", "bambustudio", "orcaslicer", "cura", "generic"]:
+        for var in self.FIELDS:
             this_var = getattr(self, var)
             other_var = getattr(other, var)
             if other_var is not None:
@@ -823,7 +1020,7 @@ class SlicerSettings(IToFromJSONData):
                     this_var.update(other_var)
 
     def to_dict(self):
-        return {k: v.to_dict() for k, v in self.__dict__.items() if v is not None}
+        return {k: v.to_dict() for k in self.FIELDS if (v := getattr(self, k)) is not None}
 
     @staticmethod
     def from_json_data(json_data: Optional[dict[str, Any]], parent: None = None):
@@ -920,28 +1117,49 @@ class Filament(IToFromFS):
         self.slicer_ids = slicer_ids
         self.slicer_settings = slicer_settings
         self.variants = variants
+        self.__resolved_slicer_settings = None
 
     @property
     def parent(self):
         return self.__parent
 
+    def __getstate__(self):
+        # Copies don't share the cached resolved settings
+        state = self.__dict__.copy()
+        state["_Filament__resolved_slicer_settings"] = None
+        return state
+
     def get_resolved_slicer_settings(self):
         """
         Get the resolved slicer_settings value
         If the parent Material has default_slicer_settings, a copy is made
         If not, a new SlicerSettings is created
-        If this Filament has slicer_settings, that is used to update the copy/new SlicerSettings
-        The result of these operations is returned
+        If this Filament has slicer_settings, a copy of it is used to update the copy/new SlicerSettings
+        The result is cached until the slicer settings of this Filament or its Material are modified or replaced,
+        it is shared and read only, use deepcopy() on it to get a modifiable copy
         """
         def_settings = self.parent.default_slicer_settings
+        own_settings = self.slicer_settings
+        def_stamp = def_settings.latest_stamp() if def_settings is not None else None
+        own_stamp = own_settings.latest_stamp() if own_settings is not None else None
+
+        cached = self.__resolved_slicer_settings
+        if cached is not None:
+            cached_def, cached_def_stamp, cached_own, cached_own_stamp, data = cached
+            if (cached_def is def_settings and cached_def_stamp == def_stamp
+                    and cached_own is own_settings and cached_own_stamp == own_stamp):
+                return data
+
         if def_settings is None:
             data = SlicerSettings()
         else:
             data = deepcopy(def_settings)
 
-        if self.slicer_settings is not None:
-            data.update(self.slicer_settings)
+        if own_settings is not None:
+            data.update(deepcopy(own_settings))
 
+        data.freeze()
+        self.__resolved_slicer_settings = (def_settings, def_stamp, own_settings, own_stamp, data)
         return data
 
     def get_max_dry_temperature(self):
@@ -1164,6 +1382,1190 @@ class Brand(IToFromFS):
         return brand
 
 
+# ---------------------------------
+# Load/Save Brands
+# ---------------------------------
+
+def load_brands(data_folder: PathLike = "data") -> list[Brand]:
+    """Load every brand folder within the data folder, sorted by folder name"""
+    brands: list[Brand] = []
+    for entry in sorted(Path(data_folder).iterdir()):
+        if not entry.is_dir():
+            continue
+        brand = Brand.from_folder(entry)
+        if brand is None:
+            continue
+        brands.append(brand)
+    return brands
+
+
+def brand_files(brand: Brand) -> list[tuple[str, Any]]:
+    """The files Brand.to_folder() writes, as (path relative to the data folder, JSON data)"""
+    brand_path = cleanse_folder_name(brand.brand_name)
+    files = [(f"{brand_path}/brand.json", brand.to_dict())]
+    for material in brand.materials:
+        material_path = f"{brand_path}/{cleanse_folder_name(material.material_name)}"
+        files.append((f"{material_path}/material.json", material.to_dict()))
+        for filament in material.filaments:
+            filament_path = f"{material_path}/{cleanse_folder_name(filament.name)}"
+            files.append((f"{filament_path}/filament.json", filament.to_dict()))
+            for variant in filament.variants:
+                variant_path = f"{filament_path}/{cleanse_folder_name(variant.color_name)}"
+                files.append((f"{variant_path}/variant.json", variant.to_dict()))
+                files.append((f"{variant_path}/sizes.json", [x.to_dict() for x in variant.sizes]))
+    return files
+
+
+def _link_or_copy(source: Path, target: Path):
+    """Hard link the file so unchanged files are never rewritten, copy it if hard links aren't supported"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def encode_data_file(json_data: Any, current: Optional[bytes] = None) -> bytes:
+    """
+    Encode a file like the files in the data folder, a trailing newline is kept if the current file has one
+    :param current: The contents of the current file, if there is one
+    """
+    data = json.dumps(json_data, indent=2, ensure_ascii=False).encode("utf-8")
+    if current is not None and current.endswith(b"\n"):
+        data += b"\n"
+    return data
+
+
+def read_data_file(path: Path) -> Optional[bytes]:
+    """The contents of a file in the data folder, None if it can't be read"""
+    try:
+        return path.read_bytes()
+    except OSError:
+        return None
+
+
+def _serialize_brand(brand: Brand, data_folder: Path) -> list[tuple[str, bytes, bool]]:
+    """:returns: (path relative to the data folder, file contents, if the current file has the same contents)"""
+    res = []
+    for rel_path, json_data in brand_files(brand):
+        current = read_data_file(data_folder.joinpath(rel_path))
+        data = encode_data_file(json_data, current)
+        res.append((rel_path, data, current == data))
+    return res
+
+
+# The entity stored in the folders at each depth below the data folder
+_FOLDER_LEVELS = [Brand, Material, Filament, FilamentVariant]
+
+
+def _folder_loads(folder: Path, depth: int) -> bool:
+    """If load_brands() loads the entity of the folder, its sub folders aren't checked"""
+    if depth > len(_FOLDER_LEVELS):
+        return False
+    try:
+        return _FOLDER_LEVELS[depth - 1].from_folder(folder, None) is not None
+    except Exception:
+        return False
+
+
+def _unloadable_folders(data_folder: Path, saved_folders: set[str], rel_folder: str = "", depth: int = 1) -> list[str]:
+    """
+    Find the folders that aren't saved because load_brands() skipped them, e.g. because of an invalid JSON file
+    Folders that loaded but aren't saved were removed on purpose.
+    :param saved_folders: The folders the saved files are in, relative to the data folder
+    :returns: The skipped folders relative to the data folder, their sub folders aren't listed
+    """
+    res = []
+    for entry in sorted(data_folder.joinpath(rel_folder).iterdir()):
+        if not entry.is_dir():
+            continue
+        rel_path = f"{rel_folder}/{entry.name}" if rel_folder else entry.name
+        if rel_path in saved_folders:
+            res.extend(_unloadable_folders(data_folder, saved_folders, rel_path, depth + 1))
+        elif not _folder_loads(entry, depth):
+            res.append(rel_path)
+    return res
+
+
+def _stage_files(files: list[tuple[str, bytes, bool]], data_folder: Path, staging_folder: Path):
+    for rel_path, data, unchanged in files:
+        target = staging_folder.joinpath(rel_path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if unchanged:
+            _link_or_copy(data_folder.joinpath(rel_path), target)
+        else:
+            target.write_bytes(data)
+
+
+def _save_swap_folders(data_folder: Path) -> tuple[Path, Path]:
+    """The staging folder a save is written to, and the folder the previous tree is moved to during the swap"""
+    return (data_folder.with_name(f".{data_folder.name}.staging"),
+            data_folder.with_name(f".{data_folder.name}.old"))
+
+
+def recover_interrupted_save(data_folder: PathLike = "data"):
+    """
+    Clean up after a save_brands() that didn't finish
+    If it stopped between moving the old tree away and moving the new one in, the old tree is restored
+    """
+    data_folder = Path(data_folder)
+    staging_folder, old_folder = _save_swap_folders(data_folder)
+    if old_folder.exists():
+        if data_folder.exists():
+            shutil.rmtree(old_folder)
+        else:
+            os.rename(old_folder, data_folder)
+            print(f"Restored {data_folder} after an interrupted save")
+    if staging_folder.exists():
+        shutil.rmtree(staging_folder)
+
+
+def save_brands(brands: list[Brand], data_folder: PathLike = "data", max_workers: Optional[int] = None) -> tuple[int, int]:
+    """
+    Write the brands to the data folder, like calling to_folder() on every brand but safe against interruptions
+    The brands are serialized in parallel and compared with the current files, if nothing changed nothing is written.
+    Otherwise the tree is built in a staging folder next to the data folder, where files with unchanged bytes are
+    hard linked from the current tree instead of being written. Other files within the brand folders (like logos)
+    are kept. Once everything is staged the staging folder is swapped into place with renames,
+    folders of entities that aren't in the list are removed.
+    Folders that load_brands() skipped because they couldn't be loaded are kept as they are,
+    otherwise loading and saving the brands would delete them.
+    :returns: The number of (written, unchanged) files
+    """
+    data_folder = Path(data_folder)
+    recover_interrupted_save(data_folder)
+    staging_folder, old_folder = _save_swap_folders(data_folder)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        serialized = list(executor.map(lambda x: _serialize_brand(x, data_folder), brands))
+        written = sum(1 for files in serialized for x in files if not x[2])
+        unchanged = sum(1 for files in serialized for x in files if x[2])
+
+        skipped = []
+        if data_folder.exists():
+            saved_folders = {x[0].rsplit("/", 1)[0] for files in serialized for x in files}
+            saved_folders.update(parent for folder in list(saved_folders)
+                                 for parent in (folder[:i] for i, c in enumerate(folder) if c == "/"))
+            skipped = _unloadable_folders(data_folder, saved_folders)
+            for rel_path in skipped:
+                print(f"Keeping {data_folder.joinpath(rel_path)} as it is, it couldn't be loaded")
+
+        # Nothing to do if every file is unchanged and there are no files of removed entities
+        if written == 0 and data_folder.exists():
+            current = set()
+            for folder, dir_names, file_names in os.walk(data_folder):
+                rel_folder = Path(folder).relative_to(data_folder).as_posix()
+                dir_names[:] = [x for x in dir_names if
+                                (x if rel_folder == "." else f"{rel_folder}/{x}") not in skipped]
+                current.update(Path(folder, x).relative_to(data_folder).as_posix()
+                               for x in file_names if x.endswith(".json"))
+            if current == {x[0] for files in serialized for x in files}:
+                return written, unchanged
+
+        staging_folder.mkdir(parents=True)
+        list(executor.map(lambda x: _stage_files(x, data_folder, staging_folder), serialized))
+
+    for rel_path in skipped:
+        shutil.copytree(data_folder.joinpath(rel_path), staging_folder.joinpath(rel_path),
+                        copy_function=_link_or_copy, dirs_exist_ok=True)
+
+    # Keep files that aren't written by to_folder() (logos etc.) within the folders that still exist
+    if data_folder.exists():
+        for folder, _, file_names in os.walk(data_folder):
+            staged_folder = staging_folder.joinpath(Path(folder).relative_to(data_folder))
+            if not staged_folder.is_dir():
+                continue
+            for file_name in file_names:
+                if file_name.endswith(".json") or staged_folder.joinpath(file_name).exists():
+                    continue
+                _link_or_copy(Path(folder, file_name), staged_folder.joinpath(file_name))
+
+    if data_folder.exists():
+        os.rename(data_folder, old_folder)
+    os.rename(staging_folder, data_folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+    return written, unchanged
+
+
+# ---------------------------------
+# Streaming Iteration
+# Flat passes over the data folder without building the Brand tree
+# ---------------------------------
+
+class FilamentRecord(NamedTuple):
+    """A filament with the values it inherits from its material resolved"""
+    path: str  # The filament folder relative to the data folder
+    brand_name: str
+    material_name: str
+    name: str
+    density: float
+    diameter_tolerance: float
+    max_dry_temperature: Optional[int]
+    discontinued: bool
+
+
+class LinkRecord(NamedTuple):
+    store_id: str
+    url: str
+    spool_refill: bool
+    ships_from: list[str]  # Normalized location codes, the store's value is used if the link doesn't have one
+    ships_to: list[str]
+
+
+class SizeRecord(NamedTuple):
+    filament: FilamentRecord
+    variant_path: str  # The variant folder relative to the data folder
+    color_name: str
+    index: int  # The position of the size within sizes.json
+    filament_weight: float
+    diameter: float
+    empty_spool_weight: Optional[float]
+    spool_core_diameter: Optional[float]
+    gtin: Optional[str]
+    ean: Optional[str]
+    article_number: Optional[str]
+    discontinued: bool  # True if the size, its variant or its filament is discontinued
+    purchase_links: list[LinkRecord]
+
+
+class VariantRecord(NamedTuple):
+    filament: FilamentRecord
+    path: str  # The variant folder relative to the data folder
+    color_name: str
+    color_hex: list[str]  # Normalized, without the leading '#'
+    discontinued: bool  # True if the variant or its filament is discontinued
+    sizes: list[SizeRecord]
+
+
+def _sub_dirs(path: str) -> list[os.DirEntry]:
+    with os.scandir(path) as it:
+        return sorted((x for x in it if x.is_dir()), key=lambda x: x.name)
+
+
+def _read_json(folder: str, file_name: str, schema: Optional[dict], validate: bool) -> Optional[Any]:
+    path = os.path.join(folder, file_name)
+    if not os.path.isfile(path):
+        return None
+    json_data = get_json_from_file(path)
+    if json_data is None or (validate and schema is not None and not validate_json(json_data, schema)):
+        # An error msg will be emitted by get_json_from_file or validate_json
+        return None
+    return json_data
+
+
+def _link_record(json_data: dict[str, Any]) -> LinkRecord:
+    store = stores[json_data["store_id"]]
+    return LinkRecord(
+        store_id=store.store_id,
+        url=json_data["url"],
+        spool_refill=bool(json_data.get("spool_refill", False)),
+        ships_from=normalize_locations(json_data.get("ships_from") or store.ships_from),
+        ships_to=normalize_locations(json_data.get("ships_to") or store.ships_to)
+    )
+
+
+def iter_variants(data_folder: PathLike = "data", validate=True) -> Iterator[VariantRecord]:
+    """
+    Walk the data folder and yield every variant with its sizes
+    Only one variant is held in memory at a time, folders that would fail to load with from_folder() are skipped
+    :param data_folder: The data folder to walk
+    :param validate: Validate the JSON files with their schemas, like loading the Brand tree does
+    """
+    for brand_dir in _sub_dirs(os.fspath(data_folder)):
+        brand = _read_json(brand_dir.path, "brand.json", BRAND_SCHEMA, validate)
+        if brand is None:
+            continue
+        for material_dir in _sub_dirs(brand_dir.path):
+            material = _read_json(material_dir.path, "material.json", MATERIAL_SCHEMA, validate)
+            if material is None:
+                continue
+            for filament_dir in _sub_dirs(material_dir.path):
+                filament_data = _read_json(filament_dir.path, "filament.json", FILAMENT_SCHEMA, validate)
+                if filament_data is None:
+                    continue
+                max_dry_temperature = filament_data.get("max_dry_temperature")
+                if max_dry_temperature is None:
+                    max_dry_temperature = material.get("default_max_dry_temperature")
+                filament = FilamentRecord(
+                    path=f"{brand_dir.name}/{material_dir.name}/{filament_dir.name}",
+                    brand_name=brand["brand"],
+                    material_name=material["material"],
+                    name=filament_data["name"],
+                    density=filament_data["density"],
+                    diameter_tolerance=filament_data["diameter_tolerance"],
+                    max_dry_temperature=max_dry_temperature,
+                    discontinued=bool(filament_data.get("discontinued"))
+                )
+
+                for variant_dir in _sub_dirs(filament_dir.path):
+                    variant = _read_json(variant_dir.path, "variant.json", VARIANT_SCHEMA, validate)
+                    if variant is None:
+                        continue
+                    sizes_data = _read_json(variant_dir.path, "sizes.json", SIZE_SCHEMA, validate)
+                    if not isinstance(sizes_data, list) or not sizes_data:
+                        continue
+
+                    variant_path = f"{filament.path}/{variant_dir.name}"
+                    variant_discontinued = filament.discontinued or bool(variant.get("discontinued"))
+                    color_hex = variant["color_hex"]
+                    sizes = []
+                    for idx, size in enumerate(sizes_data):
+                        gtin, ean = normalize_gtin_ean(size.get("gtin"), size.get("ean"))
+                        sizes.append(SizeRecord(
+                            filament=filament,
+                            variant_path=variant_path,
+                            color_name=variant["color_name"],
+                            index=idx,
+                            filament_weight=size["filament_weight"],
+                            diameter=size["diameter"],
+                            empty_spool_weight=size.get("empty_spool_weight"),
+                            spool_core_diameter=size.get("spool_core_diameter"),
+                            gtin=gtin,
+                            ean=ean,
+                            article_number=size.get("article_number"),
+                            discontinued=variant_discontinued or bool(size.get("discontinued")),
+                            purchase_links=[_link_record(x) for x in size.get("purchase_links", [])]
+                        ))
+
+                    yield VariantRecord(
+                        filament=filament,
+                        path=variant_path,
+                        color_name=variant["color_name"],
+                        color_hex=normalize_color_hex([color_hex] if isinstance(color_hex, str) else color_hex),
+                        discontinued=variant_discontinued,
+                        sizes=sizes
+                    )
+
+
+def iter_sizes(data_folder: PathLike = "data", validate=True) -> Iterator[SizeRecord]:
+    """Walk the data folder and yield every size, see iter_variants()"""
+    for variant in iter_variants(data_folder, validate):
+        yield from variant.sizes
+
+
+# ---------------------------------
+# Snapshot Cache
+# ---------------------------------
+
+# The file the snapshot of the loaded brands is stored in
+snapshot_path = Path("./.cache/brands.snapshot")
+# Bump when the classes change in a way that makes old snapshots unusable
+SNAPSHOT_VERSION = 1
+
+
+def tree_signature(folder: PathLike) -> str:
+    """
+    Get a Merkle hash of a folder from the names, sizes and modification times of everything within it
+    Files are not read, so this is cheap enough to run on every load
+    """
+    h = hashlib.sha256()
+    with os.scandir(folder) as it:
+        for entry in sorted(it, key=lambda x: x.name):
+            if entry.is_dir():
+                h.update(f"d {entry.name} {tree_signature(entry.path)}\n".encode("utf-8"))
+            else:
+                stat = entry.stat()
+                h.update(f"f {entry.name} {stat.st_size} {stat.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _snapshot_key() -> str:
+    """Everything except the brand folders that a loaded brand depends on: the schemas and the stores"""
+    schemas = [STORE_SCHEMA, BRAND_SCHEMA, MATERIAL_SCHEMA, FILAMENT_SCHEMA, VARIANT_SCHEMA, SIZE_SCHEMA]
+    data = json.dumps([SNAPSHOT_VERSION, schemas, {k: v.to_dict() for k, v in sorted(stores.items())}],
+                      sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _load_snapshot(key: str) -> dict[str, tuple[str, 'Brand']]:
+    if not snapshot_path.exists():
+        return {}
+    try:
+        with snapshot_path.open("rb") as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        # Missing classes, renamed stores, truncated files etc. just mean the snapshot is rebuilt
+        print(f"Ignoring unreadable snapshot {snapshot_path}: {e}")
+        return {}
+    if not isinstance(snapshot, dict) or snapshot.get("key") != key:
+        return {}
+    return snapshot["brands"]
+
+
+def load_brands_cached(data_folder: PathLike = "data") -> list[Brand]:
+    """
+    Load every brand like load_brands(), using a snapshot of the loaded brands when possible
+    Only brands whose folder changed since the snapshot was written are loaded from the folder,
+    a change to the schemas or stores invalidates every brand
+    Set global var 'snapshot_path' to change where the snapshot is stored
+    """
+    key = _snapshot_key()
+    cached = _load_snapshot(key)
+
+    brands: list[Brand] = []
+    snapshot_brands: dict[str, tuple[str, Brand]] = {}
+    for entry in sorted(Path(data_folder).iterdir()):
+        if not entry.is_dir():
+            continue
+        signature = tree_signature(entry)
+        cached_brand = cached.get(entry.name)
+        if cached_brand is not None and cached_brand[0] == signature:
+            brand = cached_brand[1]
+        else:
+            brand = Brand.from_folder(entry)
+            if brand is None:
+                # Not cached so the errors are shown again on the next load
+                continue
+        snapshot_brands[entry.name] = (signature, brand)
+        brands.append(brand)
+
+    if snapshot_brands.keys() != cached.keys() or any(
+            cached[k][0] != v[0] for k, v in snapshot_brands.items()):
+        data = pickle.dumps({"key": key, "brands": snapshot_brands}, protocol=pickle.HIGHEST_PROTOCOL)
+        _write_bytes_atomic(snapshot_path, data)
+
+    return brands
+
+
+# ---------------------------------
+# Static API Export
+# ---------------------------------
+
+STATIC_API_MANIFEST = "manifest.json"
+STATIC_API_VERSION = 1
+
+
+def slugify(name: str) -> str:
+    """Convert a name into a lowercase, URL safe path segment"""
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    slug = re.sub(r"[^a-z0-9]+", "-", ascii_name.lower()).strip("-")
+    return slug if slug else "_"
+
+
+def _unique_slug(name: str, used: set[str]) -> str:
+    """Returns a slug for the name that isn't in used (a numbered suffix is added on collision)"""
+    base = slugify(name)
+    slug = base
+    i = 2
+    while slug in used:
+        slug = f"{base}-{i}"
+        i += 1
+    used.add(slug)
+    return slug
+
+
+def _write_bytes_atomic(path: Path, data: bytes):
+    """Write the data to a temporary file next to the path and then move it into place"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class StaticApiExporter:
+    """
+    Writes the database as a static API that can be served from a CDN or static host
+
+    Every document is stored as compact JSON with an optional precompressed .gz sibling.
+    The manifest maps each document path to its sha256 hash and size, documents whose hash has
+    not changed since the previous export are not rewritten and documents that are no longer
+    produced are removed.
+    """
+
+    def __init__(self, output_folder: PathLike, compress: bool = True):
+        self.output_folder = Path(output_folder)
+        self.compress = compress
+        self.files: dict[str, dict[str, Any]] = {}
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.__previous_files = self.__load_previous_files()
+
+    def __load_previous_files(self) -> dict[str, dict[str, Any]]:
+        manifest_path = self.output_folder.joinpath(STATIC_API_MANIFEST)
+        if not manifest_path.exists():
+            return {}
+        manifest = get_json_from_file(manifest_path)
+        if not isinstance(manifest, dict) or manifest.get("version") != STATIC_API_VERSION:
+            return {}
+        return manifest.get("files", {})
+
+    @staticmethod
+    def encode(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf8")
+
+    def add_document(self, rel_path: str, data: Any):
+        """Add a JSON document to the export, it is only written if its content changed"""
+        content = self.encode(data)
+        entry = {
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "size": len(content)
+        }
+        path = self.output_folder.joinpath(rel_path)
+        gz_path = path.with_name(f"{path.name}.gz")
+
+        previous = self.__previous_files.get(rel_path)
+        if (previous is not None and previous.get("sha256") == entry["sha256"] and path.exists()
+                and (not self.compress or gz_path.exists())):
+            if self.compress:
+                entry["gzip_size"] = previous.get("gzip_size", gz_path.stat().st_size)
+            self.files[rel_path] = entry
+            self.unchanged += 1
+            return
+
+        _write_bytes_atomic(path, content)
+        if self.compress:
+            # mtime is fixed so identical content always produces identical archives
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            _write_bytes_atomic(gz_path, compressed)
+            entry["gzip_size"] = len(compressed)
+        self.files[rel_path] = entry
+        self.written += 1
+
+    def finish(self):
+        """Remove documents that were not produced by this export and write the manifest"""
+        for rel_path in self.__previous_files.keys() - self.files.keys():
+            path = self.output_folder.joinpath(rel_path)
+            for stale in (path, path.with_name(f"{path.name}.gz")):
+                if stale.exists():
+                    stale.unlink()
+            self.removed += 1
+            # Clean up any folders that are now empty
+            parent = path.parent
+            while parent != self.output_folder and parent.exists() and not any(parent.iterdir()):
+                parent.rmdir()
+                parent = parent.parent
+
+        manifest = {
+            "version": STATIC_API_VERSION,
+            "files": dict(sorted(self.files.items()))
+        }
+        content = json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf8")
+        _write_bytes_atomic(self.output_folder.joinpath(STATIC_API_MANIFEST), content)
+        if self.compress:
+            _write_bytes_atomic(self.output_folder.joinpath(f"{STATIC_API_MANIFEST}.gz"),
+                                gzip.compress(content, compresslevel=9, mtime=0))
+
+
+def export_static_api(brands: list[Brand], output_folder: PathLike, compress: bool = True) -> StaticApiExporter:
+    """
+    Export the brands (and the loaded stores) as a static API
+
+    Layout of the output folder:
+    index.json                                   All brands with the path to their document
+    stores.json                                  All stores
+    brands/[brand]/index.json                    The brand and its materials
+    brands/[brand]/[material]/index.json         The material and its filaments
+    brands/[brand]/[material]/[filament].json    The filament with all its variants and sizes
+    manifest.json                                Path -> sha256/size of every document above
+    """
+    exporter = StaticApiExporter(output_folder, compress)
+
+    exporter.add_document("stores.json", {
+        "stores": [stores[k].to_dict() for k in sorted(stores.keys())]
+    })
+
+    brand_entries = []
+    brand_slugs: set[str] = set()
+    for brand in sorted(brands, key=lambda x: x.brand_name.lower()):
+        brand_path = f"brands/{_unique_slug(brand.brand_name, brand_slugs)}"
+
+        material_entries = []
+        material_slugs: set[str] = set()
+        for material in sorted(brand.materials, key=lambda x: x.material_name.lower()):
+            material_path = f"{brand_path}/{_unique_slug(material.material_name, material_slugs)}"
+
+            filament_entries = []
+            filament_slugs: set[str] = set()
+            for filament in sorted(material.filaments, key=lambda x: x.name.lower()):
+                filament_path = f"{material_path}/{_unique_slug(filament.name, filament_slugs)}.json"
+                variants = []
+                for variant in sorted(filament.variants, key=lambda x: x.color_name.lower()):
+                    variant_data = variant.to_dict()
+                    variant_data["sizes"] = [x.to_dict() for x in variant.sizes]
+                    variants.append(variant_data)
+
+                filament_data = filament.to_dict()
+                filament_data["brand"] = brand.brand_name
+                filament_data["material"] = material.material_name
+                filament_data["variants"] = variants
+                exporter.add_document(filament_path, filament_data)
+                filament_entries.append({
+                    "name": filament.name,
+                    "path": filament_path,
+                    "variant_count": len(variants)
+                })
+
+            material_path_index = f"{material_path}/index.json"
+            material_data = material.to_dict()
+            material_data["brand"] = brand.brand_name
+            material_data["filaments"] = filament_entries
+            exporter.add_document(material_path_index, material_data)
+            material_entries.append({
+                "material": material.material_name,
+                "path": material_path_index
+            })
+
+        brand_path_index = f"{brand_path}/index.json"
+        brand_data = brand.to_dict()
+        brand_data["materials"] = material_entries
+        exporter.add_document(brand_path_index, brand_data)
+        brand_entries.append({
+            "brand": brand.brand_name,
+            "path": brand_path_index
+        })
+
+    exporter.add_document("index.json", {
+        "brands": brand_entries,
+        "stores": "stores.json"
+    })
+
+    exporter.finish()
+    return exporter
+
+
+# ---------------------------------
+# Profile Catalog
+# An index of the slicer profiles created by load_profiles.py, so they can be looked up without parsing them
+# ---------------------------------
+
+PROFILE_CATALOG_FILE = "catalog.json"
+# Bump when the catalog format changes
+PROFILE_CATALOG_VERSION = 1
+# The hash of every profile, written by load_profiles.py and committed with the profiles
+# The catalog isn't committed, it is rebuilt whenever the manifest changed since the catalog was written
+PROFILE_MANIFEST_FILE = "manifest.json"
+
+# The key fields of the catalog mapped to the settings they are read from in each slicer's profiles
+PROFILE_FIELD_MAPS = {
+    "prusaslicer": SlicerSettings.PS_MAP,
+    "bambustudio": SlicerSettings.BS_MAP,
+    "orcaslicer": SlicerSettings.ORCA_MAP,
+    "cura": SlicerSettings.CURA_MAP
+}
+
+
+def split_profile_name(name: str) -> tuple[str, str]:
+    """
+    Split a profile name into the base name and the printer variant suffix
+    The base name matches the profile_name stored in SpecificSlicerSettings
+    """
+    if "@" not in name:
+        return name.strip(), ""
+    idx = name.rfind("@")
+    return name[:idx].rstrip(), name[idx + 1:].strip()
+
+
+class CatalogProfile(NamedTuple):
+    slicer: str
+    name: str  # The file name without the extension, including the printer variant suffix
+    vendor: str  # The vendor folder the profile is in
+    path: str  # Relative to the slicer's profile folder
+    hash: str  # sha1 of the file contents
+    filament_type: str
+    nozzle_temp: Optional[float]
+    first_layer_nozzle_temp: Optional[float]
+    bed_temp: Optional[float]
+    first_layer_bed_temp: Optional[float]
+    compatible_printers: tuple[str, ...]
+
+    @property
+    def base_name(self) -> str:
+        return split_profile_name(self.name)[0]
+
+    @property
+    def suffix(self) -> str:
+        """The printer variant after the "@" in the profile name, empty if there isn't one"""
+        return split_profile_name(self.name)[1]
+
+
+def _first_value(value: Any) -> Any:
+    """Slic3r JSON profiles store most values as lists (one per extruder)"""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def _profile_temperature(value: Any) -> Optional[float]:
+    try:
+        return float(_first_value(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def catalog_profile(slicer_name: str, rel_path: str, content: bytes) -> Optional[CatalogProfile]:
+    """
+    Create the catalog entry of a profile file
+    :param rel_path: The path of the profile relative to the slicer's profile folder
+    :param content: The contents of the profile file
+    :returns: The catalog entry, None if the file isn't a JSON profile
+    """
+    try:
+        data = json.loads(content)
+    except (JSONDecodeError, UnicodeDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    field_map = PROFILE_FIELD_MAPS.get(slicer_name, {})
+    if slicer_name == "cura":
+        filament_type = data.get("material", "")
+        printers = list(data.get("machines", {}).keys())
+    else:
+        filament_type = _first_value(data.get("filament_type", ""))
+        printers = data.get("compatible_printers", [])
+        if isinstance(printers, str):
+            # PrusaSlicer stores the printers as a string: "printer 1";"printer 2"
+            printers = [x.strip().strip('"') for x in printers.split(";")]
+
+    file_name = rel_path.rsplit("/", 1)[-1]
+    return CatalogProfile(
+        slicer=slicer_name,
+        name=file_name[:file_name.rfind(".")] if "." in file_name else file_name,
+        vendor=rel_path.split("/")[0],
+        path=rel_path,
+        hash=hashlib.sha1(content).hexdigest(),
+        filament_type=str(filament_type or ""),
+        nozzle_temp=_profile_temperature(data.get(field_map.get("nozzle_temp", ""))),
+        first_layer_nozzle_temp=_profile_temperature(data.get(field_map.get("first_layer_nozzle_temp", ""))),
+        bed_temp=_profile_temperature(data.get(field_map.get("bed_temp", ""))),
+        first_layer_bed_temp=_profile_temperature(data.get(field_map.get("first_layer_bed_temp", ""))),
+        compatible_printers=tuple(str(x) for x in printers if x)
+    )
+
+
+# The columns of the catalog that store a value per profile, besides the name, vendor, path and hash
+_CATALOG_TEMPERATURE_FIELDS = ("nozzle_temp", "first_layer_nozzle_temp", "bed_temp", "first_layer_bed_temp")
+
+
+class ProfileCatalog:
+    """
+    The profiles of every slicer by (slicer, profile name), with their path, content hash and key fields
+
+    The catalog is stored as a single JSON file with a block of columns per slicer,
+    the rows are sorted by base name so every printer variant of a profile is a contiguous range.
+    Repeated strings (vendors, filament types, printers) are stored once in shared tables,
+    paths are only stored when they aren't "<vendor>/<name>.json" and the hashes are a single string.
+    Loading only parses the file and builds the name lookups, CatalogProfiles are created when accessed.
+    The digest of the profile manifest the catalog was created for is stored with it, see load_profile_catalog().
+    """
+
+    def __init__(self, profiles: Iterable[CatalogProfile] = (), manifest_digest: Optional[str] = None):
+        tables: dict[str, dict[str, int]] = {"vendors": {}, "filament_types": {}, "printers": {}}
+
+        def ref(table: str, value: str) -> int:
+            return tables[table].setdefault(value, len(tables[table]))
+
+        blocks: dict[str, dict[str, Any]] = {}
+        for x in sorted(profiles, key=lambda x: (x.slicer, x.base_name, x.path)):
+            block = blocks.get(x.slicer)
+            if block is None:
+                block = {"bases": [], "counts": [], "names": [], "vendors": [], "paths": {}, "hashes": [],
+                         "filament_types": [], "compatible_printers": []}
+                block.update({k: [] for k in _CATALOG_TEMPERATURE_FIELDS})
+                blocks[x.slicer] = block
+            if block["bases"] and block["bases"][-1] == x.base_name:
+                block["counts"][-1] += 1
+            else:
+                block["bases"].append(x.base_name)
+                block["counts"].append(1)
+            if x.path != f"{x.vendor}/{x.name}.json":
+                block["paths"][str(len(block["names"]))] = x.path
+            block["names"].append(x.name)
+            block["vendors"].append(ref("vendors", x.vendor))
+            block["hashes"].append(x.hash)
+            block["filament_types"].append(ref("filament_types", x.filament_type))
+            for field in _CATALOG_TEMPERATURE_FIELDS:
+                block[field].append(getattr(x, field))
+            block["compatible_printers"].append([ref("printers", p) for p in x.compatible_printers])
+        for block in blocks.values():
+            block["hashes"] = "".join(block["hashes"])
+
+        self.__data = {"version": PROFILE_CATALOG_VERSION, "manifest": manifest_digest}
+        self.__data.update({k: list(v) for k, v in tables.items()})
+        self.__data["slicers"] = blocks
+        self.__build_lookups()
+
+    def __build_lookups(self):
+        # slicer -> profile name -> row, the first row wins if a name is used by multiple vendors
+        self.__rows: dict[str, dict[str, int]] = {}
+        # slicer -> base name -> (first row, end row)
+        self.__groups: dict[str, dict[str, tuple[int, int]]] = {}
+        for slicer_name, block in self.__data["slicers"].items():
+            names = block["names"]
+            self.__rows[slicer_name] = dict(zip(reversed(names), range(len(names) - 1, -1, -1)))
+            ends = list(itertools.accumulate(block["counts"]))
+            self.__groups[slicer_name] = dict(zip(block["bases"], zip([0] + ends[:-1], ends)))
+
+    def __profile(self, slicer_name: str, row: int) -> CatalogProfile:
+        block = self.__data["slicers"][slicer_name]
+        name = block["names"][row]
+        vendor = self.__data["vendors"][block["vendors"][row]]
+        printers = self.__data["printers"]
+        return CatalogProfile(
+            slicer=slicer_name,
+            name=name,
+            vendor=vendor,
+            path=block["paths"].get(str(row), f"{vendor}/{name}.json"),
+            hash=block["hashes"][row * 40:(row + 1) * 40],
+            filament_type=self.__data["filament_types"][block["filament_types"][row]],
+            nozzle_temp=block["nozzle_temp"][row],
+            first_layer_nozzle_temp=block["first_layer_nozzle_temp"][row],
+            bed_temp=block["bed_temp"][row],
+            first_layer_bed_temp=block["first_layer_bed_temp"][row],
+            compatible_printers=tuple(printers[x] for x in block["compatible_printers"][row])
+        )
+
+    def __len__(self):
+        return sum(len(x["names"]) for x in self.__data["slicers"].values())
+
+    def __iter__(self) -> Iterator[CatalogProfile]:
+        for slicer_name, block in self.__data["slicers"].items():
+            for row in range(len(block["names"])):
+                yield self.__profile(slicer_name, row)
+
+    def __contains__(self, item: tuple[str, str]):
+        return item[1] in self.__rows.get(item[0], {})
+
+    @property
+    def manifest_digest(self) -> Optional[str]:
+        return self.__data.get("manifest")
+
+    @property
+    def slicers(self) -> list[str]:
+        return list(self.__data["slicers"].keys())
+
+    def get(self, slicer_name: str, name: str) -> Optional[CatalogProfile]:
+        """Get a profile by its full name (including the printer variant suffix)"""
+        row = self.__rows.get(slicer_name, {}).get(name)
+        return None if row is None else self.__profile(slicer_name, row)
+
+    def find(self, slicer_name: str, base_name: str) -> list[CatalogProfile]:
+        """
+        Find every printer variant of a profile
+        :param base_name: The profile name without the printer variant suffix, like SpecificSlicerSettings.profile_name
+        :returns: The profiles sorted by path
+        """
+        rows = self.__groups.get(slicer_name, {}).get(split_profile_name(base_name)[0])
+        if rows is None:
+            return []
+        return [self.__profile(slicer_name, row) for row in range(*rows)]
+
+    @staticmethod
+    def from_profiles(profiles: dict[str, dict[str, bytes]], manifest_digest: Optional[str] = None) -> 'ProfileCatalog':
+        """
+        Create the catalog from profile contents
+        :param profiles: The slicers mapped to their profiles by path relative to the slicer's profile folder
+        :param manifest_digest: The digest of the profile manifest the profiles belong to
+        """
+        entries = []
+        for slicer_name, slicer_profiles in profiles.items():
+            for rel_path, content in slicer_profiles.items():
+                if not rel_path.endswith(".json"):
+                    continue
+                entry = catalog_profile(slicer_name, rel_path, content)
+                if entry is not None:
+                    entries.append(entry)
+        return ProfileCatalog(entries, manifest_digest)
+
+    @staticmethod
+    def from_folder(profile_path: PathLike = "profiles") -> 'ProfileCatalog':
+        """Create the catalog by reading every profile in the profile folder, including the profile stores"""
+        profiles: dict[str, dict[str, bytes]] = {}
+        profile_path = Path(profile_path)
+        if not profile_path.is_dir():
+            return ProfileCatalog()
+        for store_path in sorted(profile_path.glob(f"*{PROFILE_STORE_SUFFIX}")):
+            store = ProfileStore.load(store_path)
+            if store is not None:
+                profiles[store_path.name.removesuffix(PROFILE_STORE_SUFFIX)] = {x: store.read(x) for x in store}
+        for slicer_dir in sorted(x for x in profile_path.iterdir() if x.is_dir()):
+            slicer_profiles = profiles.setdefault(slicer_dir.name, {})
+            for dir_path, _, file_names in os.walk(slicer_dir):
+                for file_name in file_names:
+                    if file_name.endswith(".json"):
+                        file_path = Path(dir_path, file_name)
+                        slicer_profiles[file_path.relative_to(slicer_dir).as_posix()] = file_path.read_bytes()
+        return ProfileCatalog.from_profiles(profiles, profile_manifest_digest(profile_path))
+
+    def encode(self) -> bytes:
+        return json.dumps(self.__data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def save(self, path: PathLike):
+        _write_bytes_atomic(Path(path), self.encode())
+
+    @staticmethod
+    def load(path: PathLike) -> Optional['ProfileCatalog']:
+        """:returns: The catalog, None if it doesn't exist or was written by a different version"""
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(f.read())
+        except (OSError, JSONDecodeError, UnicodeDecodeError):
+            return None
+        if not isinstance(data, dict) or data.get("version") != PROFILE_CATALOG_VERSION:
+            return None
+
+        catalog = ProfileCatalog.__new__(ProfileCatalog)
+        catalog.__data = data
+        catalog.__build_lookups()
+        return catalog
+
+
+# Catalogs loaded by load_profile_catalog(), by their path
+_profile_catalogs: dict[str, tuple[tuple[int, int], ProfileCatalog]] = {}
+
+
+def profile_manifest_digest(profile_path: PathLike = "profiles") -> Optional[str]:
+    """:returns: The sha1 of the profile folder's manifest, None if there is no manifest"""
+    try:
+        with Path(profile_path).joinpath(PROFILE_MANIFEST_FILE).open("rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _catalog_signature(catalog_path: Path) -> Optional[tuple[int, int]]:
+    try:
+        stat = catalog_path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_profile_catalog(profile_path: PathLike = "profiles") -> ProfileCatalog:
+    """
+    Load the catalog of the profile folder, the loaded catalog is reused until the file changes
+    If there is no catalog, or it was created for a different profile manifest (e.g. the profiles were updated by git),
+    it is created from the profile files and saved
+    """
+    catalog_path = Path(profile_path).joinpath(PROFILE_CATALOG_FILE)
+    signature = _catalog_signature(catalog_path)
+    digest = profile_manifest_digest(profile_path)
+
+    cached = _profile_catalogs.get(str(catalog_path))
+    if cached is not None and signature is not None and cached[0] == signature and cached[1].manifest_digest == digest:
+        return cached[1]
+
+    catalog = ProfileCatalog.load(catalog_path) if signature is not None else None
+    if catalog is None or catalog.manifest_digest != digest:
+        print(f"The profile catalog at {catalog_path} is missing or outdated, reading the profiles instead")
+        catalog = ProfileCatalog.from_folder(profile_path)
+        if not Path(profile_path).is_dir():
+            return catalog
+        try:
+            catalog.save(catalog_path)
+        except OSError as e:
+            print(f"Failed to save the profile catalog: {e}")
+            return catalog
+        signature = _catalog_signature(catalog_path)
+    _profile_catalogs[str(catalog_path)] = (signature, catalog)
+    return catalog
+
+
+# ---------------------------------
+# Profile Store
+# An optional compact storage of a slicer's profiles, instead of a file per profile
+# ---------------------------------
+
+# The store of a slicer is written to "<profile folder>/<slicer><PROFILE_STORE_SUFFIX>"
+PROFILE_STORE_SUFFIX = ".store.json.gz"
+# Bump when the store format changes
+PROFILE_STORE_VERSION = 1
+
+
+def encode_profile_data(data: dict) -> bytes:
+    """Encode a profile the way load_profiles.py writes them"""
+    return json.dumps(data, indent=4).encode("utf-8")
+
+
+class ProfileStore:
+    """
+    The profiles of a slicer stored as content addressed blocks and deltas
+
+    Keys and values are stored once in tables, a block is the (key, value) pairs of a complete profile.
+    Blocks are addressed by the hash of their contents, so identical profiles are stored once.
+    The first printer variant of a profile (in a vendor folder) is stored as a block,
+    the other variants only store the hash of that block and their differences to it:
+    [block hash, changed/added (key, value) pairs, removed keys, the key order if it differs]
+    Profiles that wouldn't be written back byte for byte from their data are stored as text.
+
+    The whole store is loaded at once, profiles are rebuilt when they are read.
+    """
+
+    def __init__(self, profiles: Optional[dict[str, bytes]] = None):
+        """:param profiles: The profile contents by their path relative to the slicer's profile folder"""
+        keys: dict[str, int] = {}
+        values: dict[str, int] = {}
+        value_list: list[Any] = []
+        blocks: dict[str, list[int]] = {}
+        entries: dict[str, Any] = {}
+
+        def value_id(value: Any) -> int:
+            encoded = json.dumps(value, ensure_ascii=False)
+            idx = values.get(encoded)
+            if idx is None:
+                idx = values[encoded] = len(value_list)
+                value_list.append(value)
+            return idx
+
+        # (vendor, base name) -> (block hash, {key id: value id}, [key ids]) of the first variant
+        bases: dict[tuple[str, str], tuple[str, dict[int, int], list[int]]] = {}
+        for rel_path, content in sorted((profiles or {}).items()):
+            try:
+                data = json.loads(content)
+            except (JSONDecodeError, UnicodeDecodeError):
+                data = None
+            if not isinstance(data, dict) or encode_profile_data(data) != content:
+                entries[rel_path] = content.decode("utf-8", errors="replace")
+                continue
+
+            pairs = [(keys.setdefault(k, len(keys)), value_id(v)) for k, v in data.items()]
+            block_hash = hashlib.sha1(json.dumps(list(data.items()), ensure_ascii=False).encode("utf-8")).hexdigest()
+            if block_hash in blocks:
+                entries[rel_path] = [block_hash]
+                continue
+
+            file_name = rel_path.rsplit("/", 1)[-1]
+            group = (rel_path.split("/")[0], split_profile_name(file_name.removesuffix(".json"))[0])
+            base = bases.get(group)
+            if base is None:
+                blocks[block_hash] = [x for pair in pairs for x in pair]
+                bases[group] = (block_hash, dict(pairs), [k for k, _ in pairs])
+                entries[rel_path] = [block_hash]
+                continue
+
+            base_hash, base_pairs, base_order = base
+            current = dict(pairs)
+            changed = [x for k, v in pairs if base_pairs.get(k) != v for x in (k, v)]
+            removed = [k for k in base_order if k not in current]
+            entry: list[Any] = [base_hash, changed, removed]
+            # Rebuilding keeps the order of the base with added keys at the end, store the order when that's wrong
+            order = [k for k, _ in pairs]
+            if [k for k in base_order if k in current] + [k for k in order if k not in base_pairs] != order:
+                entry.append(order)
+            entries[rel_path] = entry
+
+        self.__data = {
+            "version": PROFILE_STORE_VERSION,
+            "keys": list(keys),
+            "values": value_list,
+            "blocks": blocks,
+            "profiles": entries
+        }
+        self.__blocks: dict[str, dict[str, Any]] = {}
+
+    def __len__(self):
+        return len(self.__data["profiles"])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__data["profiles"])
+
+    def __contains__(self, rel_path: str):
+        return rel_path in self.__data["profiles"]
+
+    def __block(self, block_hash: str) -> dict[str, Any]:
+        block = self.__blocks.get(block_hash)
+        if block is None:
+            keys, values = self.__data["keys"], self.__data["values"]
+            pairs = self.__data["blocks"][block_hash]
+            block = self.__blocks[block_hash] = {keys[pairs[i]]: values[pairs[i + 1]] for i in range(0, len(pairs), 2)}
+        return block
+
+    def get(self, rel_path: str) -> Optional[dict]:
+        """
+        Rebuild a profile, the values (lists) are shared and must not be modified
+        :returns: The profile data, None if there is no such profile
+        """
+        entry = self.__data["profiles"].get(rel_path)
+        if entry is None:
+            return None
+        if isinstance(entry, str):
+            return json.loads(entry)
+
+        data = dict(self.__block(entry[0]))
+        if len(entry) == 1:
+            return data
+        keys, values = self.__data["keys"], self.__data["values"]
+        changed, removed = entry[1], entry[2]
+        for k in removed:
+            del data[keys[k]]
+        for i in range(0, len(changed), 2):
+            data[keys[changed[i]]] = values[changed[i + 1]]
+        if len(entry) > 3:
+            data = {keys[k]: data[keys[k]] for k in entry[3]}
+        return data
+
+    def read(self, rel_path: str) -> Optional[bytes]:
+        """:returns: The contents of the profile file, None if there is no such profile"""
+        entry = self.__data["profiles"].get(rel_path)
+        if isinstance(entry, str):
+            return entry.encode("utf-8")
+        data = self.get(rel_path)
+        return None if data is None else encode_profile_data(data)
+
+    def encode(self) -> bytes:
+        content = json.dumps(self.__data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return gzip.compress(content, compresslevel=9, mtime=0)
+
+    def save(self, path: PathLike):
+        _write_bytes_atomic(Path(path), self.encode())
+
+    @staticmethod
+    def load(path: PathLike) -> Optional['ProfileStore']:
+        """:returns: The store, None if it doesn't exist or was written by a different version"""
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(gzip.decompress(f.read()))
+        except (OSError, EOFError, JSONDecodeError, UnicodeDecodeError):
+            return None
+        if not isinstance(data, dict) or data.get("version") != PROFILE_STORE_VERSION:
+            return None
+
+        store = ProfileStore.__new__(ProfileStore)
+        store.__data = data
+        store.__blocks = {}
+        return store
+
+
+# Stores loaded by load_profile_store(), by their path
+_profile_stores: dict[str, tuple[tuple[int, int], ProfileStore]] = {}
+
+
+def load_profile_store(profile_path: PathLike, slicer_name: str) -> Optional[ProfileStore]:
+    """
+    Load the store of a slicer's profiles, the loaded store is reused until the file changes
+    :returns: The store, None if the slicer's profiles aren't stored in a store
+    """
+    store_path = Path(profile_path).joinpath(f"{slicer_name}{PROFILE_STORE_SUFFIX}")
+    try:
+        stat = store_path.stat()
+    except OSError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _profile_stores.get(str(store_path))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    store = ProfileStore.load(store_path)
+    if store is not None:
+        _profile_stores[str(store_path)] = (signature, store)
+    return store
+
+
+def read_profile(profile_path: PathLike, slicer_name: str, rel_path: str) -> Optional[dict]:
+    """
+    Read a profile created by load_profiles.py, from its file or from the slicer's store
+    :param rel_path: The path of the profile relative to the slicer's profile folder (CatalogProfile.path)
+    :returns: The profile data, None if there is no such profile
+    """
+    file_path = Path(profile_path, slicer_name, rel_path)
+    if file_path.exists():
+        with file_path.open(encoding="utf-8") as f:
+            return json.load(f)
+    store = load_profile_store(profile_path, slicer_name)
+    return None if store is None else store.get(rel_path)
+
+
 # ---------------------------------
 # Init
 # ---------------------------------
@@ -1184,3 +2586,22 @@ load_stores()
 
 # Revert to previous CWD
 os.chdir(cwd)
+
+
+# If running from the command line, provide argument parsing
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--data-path", default="data", help="Set the path of the data folder to load")
+    parser.add_argument("--export-api", help="Export the database as a static API to the provided folder")
+    parser.add_argument("--no-gzip", action="store_true", help="Don't write precompressed .gz files with the static API")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="Load every brand from the data folder instead of using the snapshot cache")
+    args = parser.parse_args()
+
+    if args.export_api is not None:
+        loaded_brands = load_brands(args.data_path) if args.no_snapshot else load_brands_cached(args.data_path)
+        exported = export_static_api(loaded_brands, args.export_api, not args.no_gzip)
+        print(f"Exported static API to {args.export_api}: {exported.written} written, "
+              f"{exported.unchanged} unchanged, {exported.removed} removed")
@@ -1,22 +1,40 @@
-import fileinput
+import hashlib
 import json
+import multiprocessing
 import os
 import re
 import shutil
+import threading
+import time
+from collections import ChainMap, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from http.client import HTTPException
 from pathlib import Path
-from typing import Union, Optional
-from urllib.request import urlretrieve
-from zipfile import ZipFile
+from typing import Union, Optional, NamedTuple, Mapping, Iterable, Iterator, Callable, Any
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from xml.etree.ElementTree import ParseError, iterparse
+from zipfile import ZipFile, is_zipfile
 
-import iniconfig
-from iniconfig import IniConfig, ParseError
-
-iniconfig.COMMENTCHARS = ""
+from db_diff import diff_fields
+from db_serializer import ProfileCatalog, ProfileStore, PROFILE_CATALOG_FILE, PROFILE_MANIFEST_FILE, \
+    PROFILE_STORE_SUFFIX, encode_profile_data, read_profile, profile_manifest_digest
 
 PathLike = Union[str, os.PathLike[str]]
 
 # The output path for the extracted profiles
 profile_output_path = Path("./profiles")
+# The downloaded archives are kept here, so unchanged archives aren't downloaded again
+archive_cache_path = Path("./.cache/archives")
+# The archives are extracted here, profiles are generated from these files
+extracted_path = Path("./.cache/extracted")
+# Write each slicer's profiles to a single ProfileStore (see db_serializer) instead of a file per profile
+use_profile_store = False
+# If set, the profiles that changed since the last run are written to this file as JSON lines (see ProfileChange)
+change_report_path: Optional[Path] = None
+# If set, archives are downloaded from this server instead of https://github.com (with the same paths)
+archive_mirror: Optional[str] = None
 
 PRUSASLICER_URL_PRUSA_FFF = "https://github.com/prusa3d/PrusaSlicer-settings-prusa-fff/archive/refs/heads/main.zip"
 PRUSASLICER_URL_NON_PRUSA_FFF = "https://github.com/prusa3d/PrusaSlicer-settings-non-prusa-fff/archive/refs/heads/main.zip"
@@ -24,318 +42,1244 @@ BAMBUSTUDIO_URL = "https://github.com/bambulab/BambuStudio/archive/refs/heads/ma
 ORCASLICER_URL = "https://github.com/SoftFever/OrcaSlicer/archive/refs/heads/main.zip"
 CURA_URL = "https://github.com/Ultimaker/fdm_materials/archive/refs/heads/master.zip"
 
+# The stages run in threads, worker processes are started from a fork server so they aren't forked from them
+PROCESS_POOL_CONTEXT = multiprocessing.get_context("forkserver") \
+    if "forkserver" in multiprocessing.get_all_start_methods() else None
+
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+EXTRACT_CHUNK_SIZE = 1 << 16
+
+
+# ---------------------------------
+# Archive Cache
+# ---------------------------------
+
+def archive_cache_file(url: str) -> Path:
+    """The path an archive is cached at, its metadata is stored next to it with an added .json extension"""
+    name = url.rstrip("/").split("/github.com/")[-1].removesuffix(".zip")
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+    return archive_cache_path.joinpath(f"{re.sub(r'[^A-Za-z0-9.-]+', '_', name)}-{digest}.zip")
+
+
+def _read_archive_meta(archive_path: Path) -> dict:
+    try:
+        with archive_path.with_name(archive_path.name + ".json").open() as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _write_archive_meta(archive_path: Path, meta: dict):
+    meta_path = archive_path.with_name(archive_path.name + ".json")
+    tmp_path = meta_path.with_name(meta_path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp_path, meta_path)
+
+
+def fetch_archive(url: str, offline=False) -> tuple[Path, bool]:
+    """
+    Get an archive through the archive cache
+    A cached archive is revalidated with its ETag/Last-Modified, and only downloaded again if it changed.
+    Interrupted downloads are resumed when the server supports range requests, failed downloads are retried.
+    :param url: The url of the archive
+    :param offline: Only use the cache, an exception is raised if the archive isn't cached
+    :returns: The path of the cached archive and if it changed since the last run
+    """
+    archive_path = archive_cache_file(url)
+    part_path = archive_path.with_suffix(".zip.part")
+    meta = _read_archive_meta(archive_path) if archive_path.exists() else {}
+    if offline:
+        if not archive_path.exists():
+            raise Exception(f"The archive {url} isn't cached, run without offline mode first")
+        return archive_path, False
+
+    request_url = url
+    if archive_mirror is not None:
+        request_url = archive_mirror.rstrip("/") + url.removeprefix("https://github.com")
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+
+    for attempt in range(DOWNLOAD_RETRIES):
+        headers = {"User-Agent": "open-filament-database"}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        # Resume a partial download, If-Range makes the server send the whole archive if it changed in between
+        part_meta = _read_archive_meta(part_path) if part_path.exists() else {}
+        resume_from = part_path.stat().st_size if part_path.exists() else 0
+        if resume_from and (part_meta.get("etag") or part_meta.get("last_modified")):
+            headers["Range"] = f"bytes={resume_from}-"
+            headers["If-Range"] = part_meta.get("etag") or part_meta.get("last_modified")
+
+        try:
+            with urlopen(Request(request_url, headers=headers), timeout=DOWNLOAD_TIMEOUT) as response:
+                new_meta = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")
+                }
+                resumed = response.status == 206
+                if not resumed:
+                    # Remember the validators of the partial download so it can be resumed
+                    _write_archive_meta(part_path, new_meta)
+                with part_path.open("ab" if resumed else "wb") as f:
+                    shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+        except HTTPError as e:
+            if e.code == 304:
+                print(f"{url} is unchanged, using the cached archive")
+                return archive_path, False
+            if e.code == 416:
+                # The partial download is no longer valid
+                part_path.unlink(missing_ok=True)
+            elif e.code < 500 and e.code != 429:
+                raise
+            error = e
+        except (URLError, HTTPException, OSError) as e:
+            error = e
+        else:
+            if is_zipfile(part_path):
+                os.replace(part_path, archive_path)
+                _write_archive_meta(archive_path, new_meta)
+                part_path.with_name(part_path.name + ".json").unlink(missing_ok=True)
+                return archive_path, True
+            error = Exception("the downloaded archive is not a valid zip file")
+            part_path.unlink(missing_ok=True)
+
+        if attempt + 1 < DOWNLOAD_RETRIES:
+            print(f"Failed to download {url} ({error}), retrying...")
+            time.sleep(2 ** attempt)
+        else:
+            raise Exception(f"Failed to download {url}: {error}")
+
+
+# ---------------------------------
+# Worker Processes
+# ---------------------------------
 
-def download_and_extract(slicer_name: str, url: str, member: str, pattern: str, ignore_existing=False):
+# Every pool uses all CPUs, so the stages take turns instead of running several pools at once
+_process_pool_lock = threading.Lock()
+
+
+@contextmanager
+def process_pool(max_workers: Optional[int] = None, **kwargs) -> Iterator[ProcessPoolExecutor]:
+    """
+    A ProcessPoolExecutor that is safe to use from the pipeline's threads
+    The workers only get their explicit arguments and the module constants, the globals set from the command line
+    aren't passed on to them.
     """
+    with _process_pool_lock, ProcessPoolExecutor(max_workers=max_workers, mp_context=PROCESS_POOL_CONTEXT,
+                                                 **kwargs) as executor:
+        yield executor
+
+
+# ---------------------------------
+# Extraction
+# ---------------------------------
+
+def write_if_changed(path: Path, data: bytes) -> bool:
+    """
+    Write the file only if its contents differ from what is on disk, so unchanged profiles keep their mtime
+    :returns: True if the file was written
+    """
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def remove_stale_files(folder: Path, keep: set[str]) -> int:
+    """
+    Remove every file within the folder that isn't in keep, folders left empty are removed too
+    :param keep: Paths relative to the folder, in posix form
+    :returns: The number of removed files
+    """
+    if not folder.is_dir():
+        return 0
+    removed = 0
+    for dir_path, dir_names, file_names in os.walk(folder, topdown=False):
+        for file_name in file_names:
+            path = Path(dir_path, file_name)
+            if path.relative_to(folder).as_posix() not in keep:
+                path.unlink()
+                removed += 1
+        if dir_path != str(folder) and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+    return removed
+
+
+def extract_archive(zip_file_path: PathLike, member: str, pattern: str, output_path: Path,
+                    manifest_path: Path) -> tuple[int, int, int]:
+    """
+    Extract the matching members of a zip file, only writing the members that changed since the last extraction
+    The CRC32 and size of every extracted member are kept in a manifest, members with the same CRC32 and size
+    (according to the zip's central directory) are skipped without being decompressed.
+    Files that were extracted by the last run but are no longer in the archive are removed.
+    :param member: The folder within the zip file of where to begin extraction, ending with "/"
+    :param pattern: The pattern the member name needs to fully match
+    :param output_path: The folder to extract into
+    :param manifest_path: The manifest of this archive
+    :returns: The number of (written, removed, unchanged) files
+    """
+    try:
+        with manifest_path.open() as f:
+            old_manifest: dict[str, list[int]] = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        old_manifest = {}
+
+    manifest: dict[str, list[int]] = {}
+    written = unchanged = 0
+    pattern = re.compile(pattern)
+    with ZipFile(zip_file_path) as zip_f:
+        for info in zip_f.infolist():
+            file = info.filename
+            if not file.startswith(member) or info.is_dir() or not pattern.fullmatch(file):
+                continue
+            parts = Path(file).relative_to(member).parts
+            if "filament" in parts:
+                idx = parts.index("filament")
+                parts = parts[:idx] + parts[idx + 1:]
+            rel_path = Path(*parts).as_posix()
+            dest_path = output_path.joinpath(rel_path)
+
+            entry = [info.CRC, info.file_size]
+            manifest[rel_path] = entry
+            if old_manifest.get(rel_path) == entry and dest_path.is_file() \
+                    and dest_path.stat().st_size == info.file_size:
+                unchanged += 1
+                continue
+
+            # Stream the member with a bounded buffer instead of reading it into memory
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = dest_path.with_name(f".{dest_path.name}.tmp")
+            with zip_f.open(info) as src, open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, EXTRACT_CHUNK_SIZE)
+            os.replace(tmp_path, dest_path)
+            written += 1
+
+    removed = 0
+    for rel_path in old_manifest.keys() - manifest.keys():
+        path = output_path.joinpath(rel_path)
+        if path.is_file():
+            path.unlink()
+            removed += 1
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with manifest_path.open("w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    return written, removed, unchanged
+
+
+def download_and_extract(slicer_name: str, url: str, member: str, pattern: str, offline=False):
+    """
+    Extract the slicer's files from an archive into the extraction folder, only changed files are written
     :param slicer_name: The name of the slicer
-    :param url: The url to download from
+    :param url: The url to download from, the archive is fetched through the archive cache
     :param member: The folder, or "member" within the zip file of where to begin extraction.
     :param pattern: The pattern the file needs to match to be extracted. The match will be checked against the end of the string.
-    :param ignore_existing: If there is an existing folder at the output path, it is typically removed. This option disables that functionality.
+    :param offline: Only use the archive cache
     """
-    print(f"Downloading {slicer_name} archive...")
-    zip_file_path = urlretrieve(url)[0]
+    zip_file_path = fetch_archive(url, offline)[0]
 
     print(f"Extracting {slicer_name} archive...")
-    slicer_name = slicer_name.lower()
-    output_path = profile_output_path.joinpath(slicer_name)
+    output_path = extracted_path.joinpath(slicer_name.lower())
 
     # The parameter "member" is expected to be a folder
     # This adds the "/" if it isn't there
     if not member.endswith("/"):
         member += "/"
+    # Every archive has its own manifest, so archives that extract into the same folder only remove their own files
+    manifest_path = extracted_path.joinpath(".manifests", f"{archive_cache_file(url).stem}.json")
 
-    # Remove the existing folder structure (if not ignoring existing)
-    if not ignore_existing and os.path.exists(output_path):
-        shutil.rmtree(output_path)
+    written, removed, unchanged = extract_archive(zip_file_path, member, pattern, output_path,
+                                                  manifest_path)
+    print(f"{slicer_name}: {written} files extracted, {removed} removed, {unchanged} unchanged")
 
-    with ZipFile(zip_file_path) as zip_f:
-        if not pattern.endswith("$"):
-            pattern = pattern + "$"
-        pattern = re.compile(pattern)
-        for file in zip_f.namelist():
-            if not file.startswith(member) or file.endswith("/") or not re.match(pattern, file):
-                continue
-            rel_path = Path(file).relative_to(member)
-            dest_path = output_path.joinpath(rel_path)
-            parts = dest_path.parts
-            if "filament" in parts:
-                idx = parts.index("filament")
-                parts = parts[:idx] + parts[idx + 1:]
-                dest_path = Path(*parts)
-            dest_path.parent.mkdir(parents=True, exist_ok=True)
-            with zip_f.open(file) as src, open(dest_path, "wb") as dst:
-                dst.write(src.read())
 
+def read_extracted_files(slicer_name: str) -> dict[str, bytes]:
+    """:returns: Every extracted file of the slicer by its path relative to the slicer's extraction folder"""
+    slicer_path = extracted_path.joinpath(slicer_name.lower())
+    files = {}
+    for dir_path, _, file_names in os.walk(slicer_path):
+        for file_name in file_names:
+            path = Path(dir_path, file_name)
+            files[path.relative_to(slicer_path).as_posix()] = path.read_bytes()
+    return files
 
-def split_prusaslicer_bundle(path: Path):
+
+def write_profiles(slicer_name: str, profiles: dict[str, bytes], unchanged: Iterable[str] = ()) -> tuple[int, int]:
     """
-    Split PrusaSlicer's ini config bundles into individual JSON config files
-    :param path: Path to the ini config bundle
+    Write the profiles of a slicer to the profile output path
+    Only changed files are written, profiles that were not generated this time are removed
+    If global var 'use_profile_store' is set, the profiles are written to a single store instead of a file each
+    :param profiles: The file contents by their path relative to the slicer's output folder
+    :param unchanged: Profiles known to be unchanged (see the profile manifest), their files aren't read to compare
+    :returns: The number of (written, removed) files
     """
-    if path.suffix != ".ini":
-        return
+    output_path = profile_output_path.joinpath(slicer_name.lower())
+    store_path = profile_output_path.joinpath(f"{slicer_name.lower()}{PROFILE_STORE_SUFFIX}")
+    if use_profile_store:
+        written = int(write_if_changed(store_path, ProfileStore(profiles).encode()))
+        removed = remove_stale_files(output_path, set())
+        if output_path.is_dir() and not any(output_path.iterdir()):
+            output_path.rmdir()
+        print(f"{slicer_name}: {len(profiles)} profiles stored in {store_path.name}, "
+              f"{'written' if written else 'unchanged'}, {removed} profile files removed")
+        return written, removed
+
+    unchanged = set(unchanged)
+    written = 0
+    for rel_path, data in profiles.items():
+        path = output_path.joinpath(rel_path)
+        if rel_path in unchanged and path.is_file():
+            continue
+        written += write_if_changed(path, data)
+    removed = remove_stale_files(output_path, set(profiles.keys()))
+    if store_path.exists():
+        store_path.unlink()
+        removed += 1
+    print(f"{slicer_name}: {written} profiles written, {removed} removed, {len(profiles) - written} unchanged")
+    return written, removed
+
+
+def encode_profile(data: dict) -> bytes:
+    # Same encoding as the profile store, so stored profiles are rebuilt byte for byte
+    return encode_profile_data(data)
+
+
+# ---------------------------------
+# Profile Manifest
+# ---------------------------------
 
+# The manifest (PROFILE_MANIFEST_FILE) has the hash of every profile written by the last run,
+# so the next run can tell which profiles changed
+# Bump when the manifest format changes
+PROFILE_MANIFEST_VERSION = 1
+
+
+class ProfileChange(NamedTuple):
+    action: str  # "add", "remove" or "modify"
+    slicer: str  # The lower case name of the slicer
+    path: str  # The path of the profile relative to the slicer's profile folder
+    keys: tuple[str, ...]  # The settings that were added, removed or changed by a "modify", empty if unknown
+
+    def to_dict(self):
+        return {"action": self.action, "slicer": self.slicer, "path": self.path, "keys": list(self.keys)}
+
+
+def profile_hash(data: bytes) -> str:
+    # The same hash as CatalogProfile.hash
+    return hashlib.sha1(data).hexdigest()
+
+
+def load_profile_manifest() -> dict[str, dict[str, str]]:
+    """:returns: The slicers (by their lower case name) mapped to the hashes of their profiles by path"""
     try:
-        config = IniConfig(path)
-    except ParseError as e:
-        # Temporary workaround for malformed ini files
-        if e.msg == "unexpected value continuation":
-            with fileinput.FileInput(path, inplace=True) as f:
-                for line in f:
-                    print(line.strip())
-            config = IniConfig(path)
+        with profile_output_path.joinpath(PROFILE_MANIFEST_FILE).open(encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != PROFILE_MANIFEST_VERSION:
+        return {}
+    return manifest.get("profiles", {})
+
+
+def save_profile_manifest(manifest: dict[str, dict[str, str]]) -> bool:
+    """:returns: True if the manifest changed"""
+    data = {
+        "version": PROFILE_MANIFEST_VERSION,
+        "profiles": {slicer: dict(sorted(hashes.items())) for slicer, hashes in sorted(manifest.items())}
+    }
+    # A line per profile, so the manifest's git history shows which profiles changed
+    content = json.dumps(data, indent=1, ensure_ascii=False) + "\n"
+    return write_if_changed(profile_output_path.joinpath(PROFILE_MANIFEST_FILE), content.encode("utf-8"))
+
+
+# The profiles stages of different slicers update the manifest at the same time
+_manifest_lock = threading.Lock()
+
+
+def update_profile_manifest(slicer_name: str, hashes: Optional[dict[str, str]]):
+    """
+    Replace the hashes of a slicer's profiles in the manifest, the other slicers keep theirs
+    :param hashes: The new hashes, None removes the slicer from the manifest
+    """
+    with _manifest_lock:
+        manifest = load_profile_manifest()
+        if hashes is None:
+            manifest.pop(slicer_name.lower(), None)
         else:
-            raise
+            manifest[slicer_name.lower()] = hashes
+        save_profile_manifest(manifest)
 
-    profiles: dict[str, dict[str, str]] = {}
 
-    # Gather all the profiles from the bundle
-    for section in config:
-        if not section.name.startswith("filament:"):
+def current_profile_hashes(slicer_name: str) -> dict[str, str]:
+    """
+    Hash the profiles of a slicer that are currently in the profile output path, from its files and its store
+    Only needed when the manifest has no hashes for the slicer, on the first run or if the last write didn't finish
+    """
+    key = slicer_name.lower()
+    hashes = {}
+    store = ProfileStore.load(profile_output_path.joinpath(f"{key}{PROFILE_STORE_SUFFIX}"))
+    if store is not None:
+        hashes.update({rel_path: profile_hash(store.read(rel_path)) for rel_path in store})
+    output_path = profile_output_path.joinpath(key)
+    for dir_path, _, file_names in os.walk(output_path):
+        for file_name in file_names:
+            path = Path(dir_path, file_name)
+            hashes[path.relative_to(output_path).as_posix()] = profile_hash(path.read_bytes())
+    return hashes
+
+
+def diff_profiles(slicer_name: str, old_hashes: dict[str, str], profiles: dict[str, bytes],
+                  new_hashes: dict[str, str]) -> list[ProfileChange]:
+    """
+    Compare the new profiles of a slicer with the ones written by the last run, by their hashes
+    Only the previous versions of modified profiles are read, to find out which settings changed.
+    Must be called before the new profiles are written.
+    :param old_hashes: The hashes of the last run's profiles
+    :param profiles: The new profiles
+    :param new_hashes: The hashes of the new profiles
+    """
+    key = slicer_name.lower()
+    changes = []
+    for rel_path in sorted(old_hashes.keys() | new_hashes.keys()):
+        old_hash = old_hashes.get(rel_path)
+        new_hash = new_hashes.get(rel_path)
+        if old_hash == new_hash:
             continue
-        name = section.name.removeprefix("filament:")
-        profiles[name] = dict(section.items())
-
-    # Cached "squashed" profiles
-    squashed_profiles: dict[str, dict[str, str]] = {}
-
-    def squash_inherits(profile_name: str):
-        """Recursively "squash" the profiles from inherits so that all settings are contained in a single file"""
-        if profile_name in squashed_profiles:
-            return squashed_profiles[profile_name]
-
-        if "inherits" not in profiles[profile_name]:
-            return profiles[profile_name]
-
-        profile = profiles[profile_name]
-        profile_out: dict[str, str] = {}
-        inherits = [x.strip() for x in profile["inherits"].split(";")]
-        for _ in inherits:
-            if _ != "":
-                profile_out.update(squash_inherits(_))
-        profile_out.update(profile)
-        del profile_out["inherits"]
-        squashed_profiles[profile_name] = profile_out
-        return squashed_profiles[profile_name]
+        if old_hash is None:
+            changes.append(ProfileChange("add", key, rel_path, ()))
+        elif new_hash is None:
+            changes.append(ProfileChange("remove", key, rel_path, ()))
+        else:
+            keys = ()
+            try:
+                old = read_profile(profile_output_path, key, rel_path)
+                new = json.loads(profiles[rel_path])
+                if isinstance(old, dict) and isinstance(new, dict):
+                    keys = tuple(diff_fields(old, new))
+            except (OSError, json.JSONDecodeError, UnicodeDecodeError):
+                pass
+            changes.append(ProfileChange("modify", key, rel_path, keys))
+    return changes
+
+
+def write_change_report(changes: list[ProfileChange], path: Path):
+    """Write the changes as JSON lines, like db_diff.py's --output"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8") as f:
+        for change in changes:
+            f.write(json.dumps(change.to_dict(), ensure_ascii=False) + "\n")
+
+
+# ---------------------------------
+# Profile Inheritance
+# ---------------------------------
+
+class InheritanceDiagnostic(NamedTuple):
+    kind: str  # "cycle" or "missing_parent"
+    profile: str  # The profile with the problem
+    parent: str  # The parent that couldn't be used
+
+    def __str__(self):
+        if self.kind == "cycle":
+            return f"'{self.profile}' inherits '{self.parent}', which is part of an inheritance cycle"
+        return f"'{self.profile}' inherits '{self.parent}', which doesn't exist"
+
+
+class ResolvedProfiles(NamedTuple):
+    profiles: dict[str, dict]  # The resolved profiles by name, shared and must not be modified
+    diagnostics: list[InheritanceDiagnostic]
+
+
+class InheritanceResolver:
+    """
+    Resolves the "inherits" chains of profiles into self-contained profiles
+    The settings of the parents are applied in order, then the profile's own settings, "inherits" is removed.
+    Profiles are resolved iteratively in topological order, so deep chains don't hit the recursion limit.
+    Cycles and missing parents are reported as diagnostics, the profile is resolved without that parent.
+
+    Resolved profiles are memoized by the contents of the profile and of its resolved parents, so identical base
+    profiles are only resolved once per resolver. Profiles are resolved in worker processes, so each worker has its
+    own memo and it's shared by the vendors (or bundles) that worker handles for the current slicer.
+    """
+
+    def __init__(self):
+        self.__memo: dict[str, dict] = {}
+
+    @staticmethod
+    def __digest(profile: dict) -> str:
+        return hashlib.sha1(json.dumps(profile, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def parents_of(profile: dict, separator: Optional[str]) -> list[str]:
+        inherits = profile.get("inherits", "")
+        names = inherits.split(separator) if separator is not None else [inherits]
+        return [x.strip() for x in names if x.strip()]
+
+    def resolve(self, profiles: Mapping[str, dict], names: Optional[Iterable[str]] = None,
+                separator: Optional[str] = None) -> ResolvedProfiles:
+        """
+        :param profiles: The profiles by name, including every profile that can be inherited from
+        :param names: The profiles to resolve (default: all of them)
+        :param separator: Split "inherits" into multiple parents with this separator (PrusaSlicer uses ";")
+        :returns: The resolved profiles (including the resolved parents) and the diagnostics
+        """
+        resolved: dict[str, dict] = {}
+        # The memo key of each resolved profile, profiles are hashed once per call
+        keys: dict[str, str] = {}
+        diagnostics: list[InheritanceDiagnostic] = []
+        visiting: set[str] = set()
+
+        for root in (profiles.keys() if names is None else names):
+            if root in resolved or root not in profiles:
+                continue
+            # (name, parents, index of the next parent to visit)
+            stack = [(root, self.parents_of(profiles[root], separator), 0)]
+            visiting.add(root)
+            while stack:
+                name, parents, idx = stack[-1]
+                if idx < len(parents):
+                    stack[-1] = (name, parents, idx + 1)
+                    parent = parents[idx]
+                    if parent in resolved:
+                        continue
+                    if parent not in profiles:
+                        diagnostics.append(InheritanceDiagnostic("missing_parent", name, parent))
+                    elif parent in visiting:
+                        diagnostics.append(InheritanceDiagnostic("cycle", name, parent))
+                    else:
+                        visiting.add(parent)
+                        stack.append((parent, self.parents_of(profiles[parent], separator), 0))
+                    continue
+
+                # Every parent is resolved (or unusable), resolve the profile itself
+                stack.pop()
+                visiting.discard(name)
+                profile = profiles[name]
+                usable = [x for x in parents if x in resolved]
+                key = hashlib.sha1("|".join([self.__digest(profile)] + [keys[x] for x in usable])
+                                   .encode("utf-8")).hexdigest()
+                data = self.__memo.get(key)
+                if data is None:
+                    if "inherits" not in profile:
+                        data = profile
+                    else:
+                        data = {}
+                        for parent in usable:
+                            data.update(resolved[parent])
+                        data.update(profile)
+                        del data["inherits"]
+                    self.__memo[key] = data
+                resolved[name] = data
+                keys[name] = key
+
+        return ResolvedProfiles(resolved, diagnostics)
+
+
+# Shared by everything resolved within this process, worker processes only live for one slicer
+profile_resolver = InheritanceResolver()
+
+
+# ---------------------------------
+# Profiles
+# ---------------------------------
+
+def iter_bundle_sections(path: PathLike, prefix: str = "filament:") -> Iterator[tuple[str, dict[str, str]]]:
+    """
+    Stream the sections of a PrusaSlicer ini config bundle
+    Only sections whose name starts with prefix are parsed, every other line is skipped as cheaply as possible.
+    Lines starting with "#" or ";" are comments, values are kept as is (";" separates values in PrusaSlicer).
+    Indented key lines are regular keys, indented lines without a key continue the previous value.
+    A warning is printed for keys that are set more than once within a section, the last value is used.
+    :param path: Path to the ini config bundle
+    :param prefix: Only parse the sections starting with this prefix
+    :returns: (section name without the prefix, the section's values) for each matching section
+    """
+    name: Optional[str] = None
+    section: dict[str, str] = {}
+    key: Optional[str] = None
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            stripped = line.strip()
+            if not stripped:
+                continue
+            first = stripped[0]
+            if first == "[":
+                header = stripped.split("#")[0].split(";")[0].rstrip()
+                if header.endswith("]"):
+                    if name is not None:
+                        yield name, section
+                    header = header[1:-1]
+                    name = header[len(prefix):] if header.startswith(prefix) else None
+                    section = {}
+                    key = None
+                    continue
+            # Skip the lines of sections that aren't needed
+            if name is None or first == "#" or first == ";":
+                continue
+
+            sep = stripped.find("=")
+            if sep == -1 or ":" in stripped[:sep]:
+                sep = stripped.find(":")
+            if sep != -1:
+                key = stripped[:sep].rstrip()
+                if key in section:
+                    print(f"Warning: {path}:{lineno}: '{key}' is set again in [{prefix}{name}], the last value is used")
+                section[key] = stripped[sep + 1:].lstrip()
+            elif key is not None and line[0].isspace():
+                section[key] = f"{section[key]}\n{stripped}" if section[key] else stripped
+            else:
+                raise Exception(f"{path}:{lineno}: Unexpected line in [{prefix}{name}]: {stripped!r}")
+    if name is not None:
+        yield name, section
+
+
+def split_prusaslicer_bundle(path: Path) -> dict[str, dict[str, str]]:
+    """
+    Split PrusaSlicer's ini config bundles into individual JSON configs
+    :param path: Path to the ini config bundle
+    :returns: The squashed profiles by their file name
+    """
+    if path.suffix != ".ini":
+        return {}
+
+    # Gather all the profiles from the bundle
+    profiles: dict[str, dict[str, str]] = {}
+    for name, section in iter_bundle_sections(path):
+        if name in profiles:
+            print(f"Warning: {path}: There are multiple [filament:{name}] sections, the last one is used")
+        profiles[name] = section
+
+    resolved, diagnostics = profile_resolver.resolve(profiles, separator=";")
+    for diagnostic in diagnostics:
+        print(f"Warning: {path}: {diagnostic}")
 
     def cleanse_name(file_name: str) -> str:
         return file_name.replace("/", " ")
 
-    for name, data in profiles.items():
+    res: dict[str, dict[str, str]] = {}
+    for name in profiles:
         # Profiles that begin with "*" are only for use within the config bundle and should not be exported
         if name.startswith("*"):
             continue
-        out_path = path.parent.joinpath(f"{cleanse_name(name)}.json")
-        data_out = squash_inherits(name)
+        # Resolved profiles are shared, so the profile is copied before filament_settings_id is set
+        data_out = dict(resolved[name])
         data_out["filament_settings_id"] = name
-        with out_path.open("w") as f:
-            json.dump(data_out, f, indent=4)
+        res[f"{cleanse_name(name)}.json"] = data_out
+    return res
+
+
+def _unpack_bundle(vendor: str, path: Path) -> dict[str, bytes]:
+    """Split a vendor's bundle, the profiles are encoded in the worker so only bytes are sent back"""
+    return {f"{vendor}/{file_name}": encode_profile(data) for file_name, data in split_prusaslicer_bundle(path).items()}
 
 
-def unpack_prusaslicer_bundles():
+def unpack_prusaslicer_bundles(max_workers: Optional[int] = None) -> dict[str, bytes]:
     """
     Finds the latest release for each vendor and runs split_prusaslicer_bundle() on it
-    All the ini files are also removed during this process
+    The bundles are independent of each other, so they are split in parallel worker processes.
+    :param max_workers: The max number of worker processes
+    :returns: The profiles by their path relative to the slicer's output folder
     """
     print("Unpacking PrusaSlicer bundles...")
     version_re = re.compile("([0-9]+)\\.([0-9]+)\\.([0-9]+)\\.ini", re.RegexFlag.IGNORECASE)
-    for vendor_dir in profile_output_path.joinpath("prusaslicer").iterdir():
+    res: dict[str, bytes] = {}
+    slicer_path = extracted_path.joinpath("prusaslicer")
+    if not slicer_path.is_dir():
+        return res
+
+    bundles: dict[str, Path] = {}
+    for vendor_dir in slicer_path.iterdir():
         if not vendor_dir.is_dir():
             continue
         # Find the latest version that is a release version
-        latest: tuple[int, int, int] = (0, 0, 0)
+        latest: Optional[tuple[int, int, int]] = None
+        latest_file = None
         for config_file in vendor_dir.iterdir():
             match = re.fullmatch(version_re, config_file.name)
             if not match:
                 continue
             tmp = (int(match.group(1)), int(match.group(2)), int(match.group(3)))
-            if tmp[0] <= latest[0] and tmp[1] <= latest[1] and tmp[2] <= latest[2]:
+            if latest is not None and tmp <= latest:
                 continue
             latest = tmp
-
-        latest_file_name = f"{latest[0]}.{latest[1]}.{latest[2]}.ini"
-
-        # Delete all except the latest
-        for config_file in vendor_dir.iterdir():
-            if config_file.name.lower() != latest_file_name:
-                config_file.unlink()
-
-        # Split the latest file into individual configs then delete it
-        latest_file = vendor_dir.joinpath(latest_file_name)
-        split_prusaslicer_bundle(latest_file)
-        latest_file.unlink()
-
-
-def squash_slic3r_profiles(slicer_name: str, filament_library_name: Optional[str] = None):
-    """
-    Recursively "squash" all profiles for the specified slic3r based slicer
-
-    Note: This function should not be run on PrusaSlicer profiles. Squashing is already handled while unpacking the bundles.
+            latest_file = config_file
+        if latest_file is not None:
+            bundles[vendor_dir.name] = latest_file
+
+    # Split the latest files into individual configs
+    with process_pool(max_workers) as executor:
+        futures = {executor.submit(_unpack_bundle, vendor, path): vendor for vendor, path in sorted(bundles.items())}
+        for idx, future in enumerate(as_completed(futures), 1):
+            vendor_profiles = future.result()
+            print(f"[{idx}/{len(futures)}] Unpacked {len(vendor_profiles)} PrusaSlicer profiles of {futures[future]}")
+            res.update(vendor_profiles)
+    # Keep the output independent of the order the bundles finished in
+    return dict(sorted(res.items()))
+
+
+def load_overlay_profiles(slicer_name: str, overlay_path: PathLike = "./overlay") -> dict[str, Path]:
     """
-    if slicer_name.lower() == "prusaslicer":
-        raise Exception("PrusaSlicer profile squashing is incompatible with this function")
-
-    print(f"Squashing {slicer_name} profiles...")
-    slicer_path = profile_output_path.joinpath(slicer_name.lower())
-
-    def load_json_from_folder(folder: Path):
-        """Recursively get all the JSON files from a specified folder"""
-        profiles: dict[str, tuple[Path, dict]] = {}
-        for _item in folder.iterdir():
-            if _item.is_dir():
-                profiles.update(load_json_from_folder(_item))
-                continue
-            if _item.suffix != ".json":
-                continue
-            with _item.open() as f:
-                file_data = json.load(f)
-
-            name: str
-            if "name" in file_data:
-                name = file_data["name"]
-            elif "filament_settings_id" in file_data:
-                name = file_data["filament_settings_id"]
-            else:
-                continue
+    Find the overlay profiles of a slicer
+    Overlay profiles can override or supplement the downloaded profiles.
 
-            profiles[name] = (_item, file_data)
-        return profiles
+    Overlay profiles should be organized as:
+    overlay/profiles/[slicer_name]/[vendor]/[profile_name].json
 
-    # Load filament library
-    filament_library_profiles = {}
-    if filament_library_name is not None:
-        filament_library_profiles = load_json_from_folder(slicer_path.joinpath(filament_library_name))
+    :param slicer_name: The name of the slicer
+    :param overlay_path: Path to the overlay directory (default: "./overlay")
+    :returns: The overlay profiles by their path relative to the slicer's output folder
+    """
+    slicer_overlay_path = Path(overlay_path).joinpath("profiles", slicer_name.lower())
+    res: dict[str, Path] = {}
+    if not slicer_overlay_path.is_dir():
+        return res
 
-    for _vendor_folder in slicer_path.iterdir():
-        if not _vendor_folder.is_dir():
+    # Iterate through all vendor directories
+    for vendor_dir in slicer_overlay_path.iterdir():
+        if not vendor_dir.is_dir():
             continue
-
-        # Load profiles from the filament library so they can be used as base profiles
-        if _vendor_folder.name == filament_library_name:
-            profiles = {}
-        else:
-            profiles = filament_library_profiles.copy()
-
-        # Add profiles from the vendor folder
-        # Any profiles with the same name as one from the filament library will override the filament library profile
-        profiles.update(load_json_from_folder(_vendor_folder))
-
-        # Cached "squashed" profiles
-        squashed_profiles: dict[str, dict] = {}
-
-        def squash_inherits(profile_name: str):
-            """Recursively "squash" the profiles from inherits so that all settings are contained in a single file"""
-            if profile_name in squashed_profiles:
-                return squashed_profiles[profile_name]
-
-            profile = profiles[profile_name][1]
-            if "inherits" not in profile:
-                return profile
-
-            profile_out = squash_inherits(profile["inherits"]).copy()
-            profile_out.update(profile)
-            del profile_out["inherits"]
-            squashed_profiles[profile_name] = profile_out
-            return squashed_profiles[profile_name]
-
-        # Remove all existing profiles
-        shutil.rmtree(_vendor_folder)
-
-        # Write out the squashed profiles
-        for name, (path, data) in profiles.items():
-            # Profiles with instantiation == false are only used as base profiles and don't need to be exported
-            # Ensure the folder name is in the path so profiles from the filament library aren't exported into vendor folders
-            if data.get("instantiation") != "true" or _vendor_folder.name not in path.parts:
+        for profile_file in vendor_dir.iterdir():
+            if profile_file.suffix != ".json":
                 continue
-            path.parent.mkdir(parents=True, exist_ok=True)
-            with path.open("w") as f:
-                json.dump(squash_inherits(name), f, indent=4)
-
+            res[f"{vendor_dir.name}/{profile_file.name}"] = profile_file
 
-def load_overlay_profiles(overlay_path: PathLike = "./overlay"):
-    """
-    Load overlay profiles and copy them to the profile output directory.
-    Overlay profiles can override or supplement the downloaded profiles.
+    if res:
+        print(f"Loaded {len(res)} {slicer_name} overlay profiles")
+    return res
 
-    Overlay profiles should be organized as:
-    overlay/profiles/[slicer_name]/[vendor]/[profile_name].json
 
-    :param overlay_path: Path to the overlay directory (default: "./overlay")
-    """
-    overlay_path = Path(overlay_path)
-    profiles_overlay_path = overlay_path.joinpath("profiles")
+def _add_slic3r_profile(profiles: dict[str, tuple[str, dict]], rel_path: str, file_path: Path):
+    """Load a slic3r JSON profile and add it to profiles by its name, files without a name are ignored"""
+    with file_path.open() as f:
+        file_data = json.load(f)
 
-    # Check if overlay profiles directory exists
-    if not profiles_overlay_path.exists():
-        print("No overlay profiles directory found, skipping overlay load...")
+    name: str
+    if "name" in file_data:
+        name = file_data["name"]
+    elif "filament_settings_id" in file_data:
+        name = file_data["filament_settings_id"]
+    else:
         return
 
-    print("Loading overlay profiles...")
-    overlay_count = 0
-
-    # Iterate through all slicer directories in the overlay
-    for slicer_dir in profiles_overlay_path.iterdir():
-        if not slicer_dir.is_dir():
-            continue
+    profiles[name] = (rel_path, file_data)
 
-        slicer_name = slicer_dir.name
-        output_slicer_path = profile_output_path.joinpath(slicer_name)
 
-        # Iterate through all vendor directories
-        for vendor_dir in slicer_dir.iterdir():
-            if not vendor_dir.is_dir():
+def _load_slic3r_folder(folder: Path, slicer_path: Path) -> dict[str, tuple[str, dict]]:
+    """Recursively get all the JSON profiles from a specified folder, with their path relative to slicer_path"""
+    profiles: dict[str, tuple[str, dict]] = {}
+    for dir_path, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            if not file_name.endswith(".json"):
                 continue
+            file_path = Path(dir_path, file_name)
+            _add_slic3r_profile(profiles, file_path.relative_to(slicer_path).as_posix(), file_path)
+    return profiles
 
-            vendor_name = vendor_dir.name
-            output_vendor_path = output_slicer_path.joinpath(vendor_name)
-
-            # Create vendor directory if it doesn't exist
-            output_vendor_path.mkdir(parents=True, exist_ok=True)
 
-            # Copy all JSON profiles from vendor directory
-            for profile_file in vendor_dir.iterdir():
-                if profile_file.suffix != ".json":
-                    continue
+# The filament library profiles of the slicer being squashed, set once per worker process
+_library_profiles: dict[str, tuple[str, dict]] = {}
 
-                dest_path = output_vendor_path.joinpath(profile_file.name)
-                shutil.copy2(profile_file, dest_path)
-                overlay_count += 1
 
-    print(f"Loaded {overlay_count} overlay profiles")
+def _init_squash_worker(library_profiles: dict[str, tuple[str, dict]]):
+    global _library_profiles
+    _library_profiles = library_profiles
 
 
-def run():
+def _squash_vendor(slicer_path: Path, vendor: str, use_library: bool,
+                   overlay_files: list[tuple[str, Path]]) -> tuple[dict[str, bytes], list[InheritanceDiagnostic]]:
     """
-    Run the download and extract routine
-    Set global var 'profile_output_path' to set the output path for the profiles
+    Squash the profiles of a single vendor folder
+    :param use_library: Use the filament library profiles (set by _init_squash_worker) as base profiles
+    :returns: The squashed profiles by their path relative to the slicer's output folder, and the inheritance diagnostics
+    """
+    # Add profiles from the vendor folder
+    vendor_profiles: dict[str, tuple[str, dict]] = {}
+    if slicer_path.joinpath(vendor).is_dir():
+        vendor_profiles = _load_slic3r_folder(slicer_path.joinpath(vendor), slicer_path)
+    for rel_path, file_path in overlay_files:
+        _add_slic3r_profile(vendor_profiles, rel_path, file_path)
+
+    # Profiles from the filament library can be used as base profiles, they are shared and never modified
+    # Any profiles with the same name as one from the filament library will override the filament library profile
+    profiles = ChainMap(vendor_profiles, _library_profiles) if use_library else vendor_profiles
+
+    exported = [name for name, (rel_path, data) in vendor_profiles.items()
+                # Profiles with instantiation == false are only used as base profiles and don't need to be exported
+                # Ensure the profile is in the vendor folder so overlay profiles of other vendors aren't exported here
+                if data.get("instantiation") == "true" and rel_path.split("/")[0] == vendor]
+    resolved, diagnostics = profile_resolver.resolve({name: data for name, (_, data) in profiles.items()}, exported)
+
+    res: dict[str, bytes] = {}
+    for name in exported:
+        res[vendor_profiles[name][0]] = encode_profile(resolved[name])
+    return res, diagnostics
+
+
+def squash_slic3r_profiles(slicer_name: str, filament_library_name: Optional[str] = None,
+                           overlay_path: PathLike = "./overlay", max_workers: Optional[int] = None) -> dict[str, bytes]:
     """
+    Recursively "squash" all profiles for the specified slic3r based slicer
+    Overlay profiles are included, so they can inherit from (and be inherited by) the downloaded profiles.
+    Vendors are independent of each other, so they are squashed in parallel worker processes.
+    The filament library is parsed once and sent to each worker once.
 
-    # Download and unzip PrusaSlicer profiles
-    download_and_extract("PrusaSlicer", PRUSASLICER_URL_PRUSA_FFF, "PrusaSlicer-settings-prusa-fff-main/",
-                         r".*\.ini")
-    download_and_extract("PrusaSlicer", PRUSASLICER_URL_NON_PRUSA_FFF, "PrusaSlicer-settings-non-prusa-fff-main/",
-                         r".*\.ini", True)
+    Note: This function should not be run on PrusaSlicer profiles. Squashing is already handled while unpacking the bundles.
+    :param max_workers: The max number of worker processes
+    :returns: The squashed profiles by their path relative to the slicer's output folder
+    """
+    if slicer_name.lower() == "prusaslicer":
+        raise Exception("PrusaSlicer profile squashing is incompatible with this function")
 
-    unpack_prusaslicer_bundles()
+    print(f"Squashing {slicer_name} profiles...")
+    slicer_path = extracted_path.joinpath(slicer_name.lower())
 
-    # Download and unzip BambuStudio profiles
-    download_and_extract("BambuStudio", BAMBUSTUDIO_URL, "BambuStudio-master/resources/profiles", ".*/filament/.*")
+    # Load filament library
+    filament_library_profiles = {}
+    if filament_library_name is not None and slicer_path.joinpath(filament_library_name).is_dir():
+        filament_library_profiles = _load_slic3r_folder(slicer_path.joinpath(filament_library_name), slicer_path)
+
+    overlay_profiles = load_overlay_profiles(slicer_name, overlay_path)
+    vendors = {x.name for x in slicer_path.iterdir() if x.is_dir()} if slicer_path.is_dir() else set()
+    vendors.update(x.split("/")[0] for x in overlay_profiles)
+
+    res: dict[str, bytes] = {}
+    with process_pool(max_workers, initializer=_init_squash_worker,
+                      initargs=(filament_library_profiles,)) as executor:
+        futures = {}
+        for vendor in sorted(vendors):
+            overlay_files = [(k, v) for k, v in overlay_profiles.items() if k.split("/")[0] == vendor]
+            futures[executor.submit(_squash_vendor, slicer_path, vendor, vendor != filament_library_name,
+                                    overlay_files)] = vendor
+        for idx, future in enumerate(as_completed(futures), 1):
+            vendor_profiles, diagnostics = future.result()
+            print(f"[{idx}/{len(futures)}] Squashed {len(vendor_profiles)} {slicer_name} profiles of {futures[future]}")
+            for diagnostic in diagnostics:
+                print(f"Warning: {slicer_name}/{futures[future]}: {diagnostic}")
+            res.update(vendor_profiles)
+    # Keep the output independent of the order the vendors finished in
+    return dict(sorted(res.items()))
+
+
+# ---------------------------------
+# Cura Materials
+# ---------------------------------
+
+CURA_EXTENSION = ".xml.fdm_material"
+
+# The settings in Cura's material files that use a descriptive key, mapped to the Cura setting they set
+# Keys that already are Cura setting names (e.g. "cool_min_layer_time") are used as is
+CURA_SETTING_KEYS = {
+    "print temperature": "material_print_temperature",
+    "heated bed temperature": "material_bed_temperature",
+    "standby temperature": "material_standby_temperature",
+    "processing temperature graph": "material_flow_temp_graph",
+    "print cooling": "cool_fan_speed",
+    "retraction amount": "retraction_amount",
+    "retraction speed": "retraction_speed",
+    "adhesion tendency": "material_adhesion_tendency",
+    "surface energy": "material_surface_energy",
+    "build volume temperature": "build_volume_temperature",
+    "anti ooze retract position": "material_anti_ooze_retracted_position",
+    "anti ooze retract speed": "material_anti_ooze_retraction_speed",
+    "break preparation position": "material_break_preparation_retracted_position",
+    "break preparation speed": "material_break_preparation_speed",
+    "break preparation temperature": "material_break_preparation_temperature",
+    "break position": "material_break_retracted_position",
+    "break speed": "material_break_speed",
+    "break temperature": "material_break_temperature",
+    "flush purge speed": "material_flush_purge_speed",
+    "flush purge length": "material_flush_purge_length",
+    "end of filament purge speed": "material_end_of_filament_purge_speed",
+    "end of filament purge length": "material_end_of_filament_purge_length",
+    "maximum park duration": "material_maximum_park_duration",
+    "no load move factor": "material_no_load_move_factor",
+    # Not a setting, "no" marks printers and hotends the material can't be used with
+    "hardware compatible": "hardware_compatible",
+}
+
+# Cura defaults the first layer temperatures to the regular temperatures, the same is done for the converted profiles
+CURA_LAYER_0_DEFAULTS = {
+    "material_print_temperature_layer_0": "material_print_temperature",
+    "material_bed_temperature_layer_0": "material_bed_temperature",
+}
+
+
+def cura_setting_key(key: str) -> Optional[str]:
+    """:returns: The Cura setting set by a setting in a material file, None if it isn't a setting Cura uses"""
+    if key in CURA_SETTING_KEYS:
+        return CURA_SETTING_KEYS[key]
+    if " " not in key:
+        return key
+    return None
+
+
+def convert_cura_material(path: PathLike) -> dict:
+    """
+    Convert a Cura material file (.xml.fdm_material) into a JSON profile
+    The file is parsed as a stream, the elements are discarded once they are read.
+    Settings are stored by the Cura setting they set, so overrides (e.g. SlicerSettings.CURA_MAP) can be applied directly.
+    Settings specific to a printer (and its hotends) are stored in "machines" by the printer's product name.
+    :param path: Path to the material file
+    :returns: The profile
+    """
+    metadata: dict[str, str] = {}
+    properties: dict[str, str] = {}
+    settings: dict[str, str] = {}
+    machines: dict[str, dict] = {}
+
+    # The local tag names of the open elements
+    tags: list[str] = []
+    machine_settings: Optional[dict[str, str]] = None
+    machine_products: list[str] = []
+    hotend_settings: Optional[dict[str, str]] = None
+    hotends: dict[str, dict[str, str]] = {}
+
+    for event, elem in iterparse(path, events=("start", "end")):
+        # Settings can be in the material or the cura namespace
+        tag = elem.tag.rpartition("}")[2]
+        if event == "start":
+            tags.append(tag)
+            if tag == "machine":
+                machine_settings, machine_products, hotends = {}, [], {}
+            elif tag == "hotend" and machine_settings is not None:
+                hotend_settings = {}
+                hotends[elem.get("id", "")] = hotend_settings
+            continue
 
-    # Download and unzip OrcaSlicer profiles
-    download_and_extract("OrcaSlicer", ORCASLICER_URL, "OrcaSlicer-main/resources/profiles/", ".*/filament/.*")
+        tags.pop()
+        parent = tags[-1] if tags else ""
+        text = (elem.text or "").strip()
+        if parent == "name" and len(tags) >= 2 and tags[-2] == "metadata":
+            metadata[tag] = text
+        elif parent == "metadata" and tag in ("GUID", "color_code", "version"):
+            metadata[tag.lower()] = text
+        elif parent == "properties":
+            properties[tag] = text
+        elif tag == "setting":
+            key = cura_setting_key(elem.get("key", ""))
+            if key is not None:
+                target = hotend_settings if parent == "hotend" else machine_settings if parent == "machine" else settings
+                if target is not None:
+                    target[key] = text
+        elif tag == "machine_identifier" and machine_settings is not None:
+            machine_products.append(elem.get("product", ""))
+        elif tag == "hotend":
+            hotend_settings = None
+        elif tag == "machine" and machine_settings is not None:
+            for product in machine_products:
+                data: dict = dict(machine_settings)
+                if hotends:
+                    data["hotends"] = hotends
+                machines[product] = data
+            machine_settings = None
+
+        # Only the open elements are kept
+        if tag not in ("metadata", "properties", "settings", "machine", "hotend", "fdmmaterial"):
+            elem.clear()
+
+    for key, source in CURA_LAYER_0_DEFAULTS.items():
+        if key not in settings and source in settings:
+            settings[key] = settings[source]
+
+    profile = {
+        "name": Path(path).name.removesuffix(CURA_EXTENSION),
+        "guid": metadata.get("guid", ""),
+        "brand": metadata.get("brand", ""),
+        "material": metadata.get("material", ""),
+        "color": metadata.get("color", ""),
+        "label": metadata.get("label", ""),
+        "color_code": metadata.get("color_code", ""),
+        "version": metadata.get("version", ""),
+    }
+    if "diameter" in properties:
+        profile["material_diameter"] = properties["diameter"]
+    if "density" in properties:
+        profile["material_density"] = properties["density"]
+    if "weight" in properties:
+        profile["material_weight"] = properties["weight"]
+    profile.update(settings)
+    if machines:
+        profile["machines"] = machines
+    return profile
+
+
+def _convert_cura_file(path: Path) -> Optional[tuple[str, bytes]]:
+    """:returns: The converted profile by its path relative to the slicer's output folder, None if it is malformed"""
+    try:
+        profile = convert_cura_material(path)
+    except ParseError as e:
+        print(f"Failed to parse {path}: {e}")
+        return None
+    # Materials are grouped by brand, like the vendor folders of the other slicers
+    brand = profile["brand"].replace("/", " ").strip() or "Generic"
+    return f"{brand}/{profile['name']}.json", encode_profile(profile)
 
-    # Download and unzip Cura profiles
-    download_and_extract("Cura", CURA_URL, "fdm_materials-master", ".*.fdm_material$")
 
-    # Load overlay profiles (these can override or supplement downloaded profiles)
-    load_overlay_profiles()
+def convert_cura_profiles(overlay_path: PathLike = "./overlay", max_workers: Optional[int] = None) -> dict[str, bytes]:
+    """
+    Convert the extracted Cura material files into JSON profiles, with the overlay profiles on top
+    The files are converted in parallel worker processes.
+    :param max_workers: The max number of worker processes
+    :returns: The profiles by their path relative to the slicer's output folder
+    """
+    print("Converting Cura materials...")
+    slicer_path = extracted_path.joinpath("cura")
+    files = sorted(slicer_path.rglob(f"*{CURA_EXTENSION}")) if slicer_path.is_dir() else []
+
+    res: dict[str, bytes] = {}
+    if files:
+        with process_pool(max_workers) as executor:
+            for converted in executor.map(_convert_cura_file, files, chunksize=16):
+                if converted is not None:
+                    res[converted[0]] = converted[1]
+    for rel_path, file_path in load_overlay_profiles("Cura", overlay_path).items():
+        res[rel_path] = file_path.read_bytes()
+    return dict(sorted(res.items()))
+
+
+# ---------------------------------
+# Pipeline
+# ---------------------------------
+
+# The archives of each slicer: (url, the folder within the archive to extract, the pattern of the files to extract)
+SLICER_ARCHIVES = {
+    "PrusaSlicer": [
+        (PRUSASLICER_URL_PRUSA_FFF, "PrusaSlicer-settings-prusa-fff-main/", r".*\.ini"),
+        (PRUSASLICER_URL_NON_PRUSA_FFF, "PrusaSlicer-settings-non-prusa-fff-main/", r".*\.ini")
+    ],
+    "BambuStudio": [(BAMBUSTUDIO_URL, "BambuStudio-master/resources/profiles", ".*/filament/.*")],
+    "OrcaSlicer": [(ORCASLICER_URL, "OrcaSlicer-main/resources/profiles/", ".*/filament/.*")],
+    "Cura": [(CURA_URL, "fdm_materials-master", ".*.fdm_material$")],
+}
+
+
+def prusaslicer_profiles() -> dict[str, bytes]:
+    """The unpacked PrusaSlicer bundles, overlay profiles override or supplement the bundle profiles"""
+    profiles = unpack_prusaslicer_bundles()
+    for rel_path, file_path in load_overlay_profiles("PrusaSlicer").items():
+        profiles[rel_path] = file_path.read_bytes()
+    return profiles
+
+
+# Create the profiles of each slicer from its extracted files
+SLICER_PROFILE_BUILDERS: dict[str, Callable[[], dict[str, bytes]]] = {
+    "PrusaSlicer": prusaslicer_profiles,
+    "BambuStudio": lambda: squash_slic3r_profiles("BambuStudio"),
+    "OrcaSlicer": lambda: squash_slic3r_profiles("OrcaSlicer", "OrcaFilamentLibrary"),
+    "Cura": convert_cura_profiles,
+}
+
+
+class Stage(NamedTuple):
+    name: str
+    deps: tuple[str, ...]  # The stages that have to finish first
+    func: Callable[[dict[str, Any]], Any]  # Called with the results of the finished stages, returns its own result
+
+
+def _extract_stage(slicer_name: str):
+    for url, member, pattern in SLICER_ARCHIVES[slicer_name]:
+        download_and_extract(slicer_name, url, member, pattern, offline=True)
+
+
+class BuiltProfiles(NamedTuple):
+    profiles: dict[str, bytes]  # The file contents by their path relative to the slicer's output folder
+    hashes: dict[str, str]  # The hashes of the profiles by their path
+    changes: list[ProfileChange]  # The changes since the last run
+
+
+def _profiles_stage(slicer_name: str) -> BuiltProfiles:
+    profiles = SLICER_PROFILE_BUILDERS[slicer_name]()
+    hashes = {rel_path: profile_hash(data) for rel_path, data in profiles.items()}
+    old_hashes = load_profile_manifest().get(slicer_name.lower())
+    if old_hashes is None:
+        old_hashes = current_profile_hashes(slicer_name)
+
+    # The changes are found before writing, while the previous versions of the profiles still exist
+    changes = diff_profiles(slicer_name, old_hashes, profiles, hashes)
+    # The old hashes no longer describe the files once writing starts, if writing fails midway the next run
+    # hashes the files it finds instead of skipping files that only match the old hashes
+    update_profile_manifest(slicer_name, None)
+    write_profiles(slicer_name, profiles, [k for k, v in hashes.items() if old_hashes.get(k) == v])
+    update_profile_manifest(slicer_name, hashes)
+    return BuiltProfiles(profiles, hashes, changes)
+
+
+def _built_profiles(results: dict[str, Any]) -> dict[str, BuiltProfiles]:
+    """:returns: The results of the profiles stages by the lower case slicer name"""
+    return {k.removeprefix("profiles:"): v for k, v in results.items() if k.startswith("profiles:")}
+
+
+def _catalog_stage(results: dict[str, Any]):
+    """Index every profile, so they can be looked up without reading the profile files"""
+    built = {k: v.profiles for k, v in _built_profiles(results).items()}
+    # The manifest was written by the profiles stages, the catalog is up to date as long as it doesn't change
+    digest = profile_manifest_digest(profile_output_path)
+    catalog = ProfileCatalog.from_profiles(built, digest)
+
+    # Slicers that weren't part of this run are read from their profiles, the previous catalog may be outdated
+    if any(x.lower() not in built for x in SLICER_ARCHIVES):
+        previous = ProfileCatalog.from_folder(profile_output_path)
+        catalog = ProfileCatalog([x for x in previous if x.slicer not in built] + list(catalog), digest)
+
+    catalog_path = profile_output_path.joinpath(PROFILE_CATALOG_FILE)
+
+    if write_if_changed(catalog_path, catalog.encode()):
+        print(f"Wrote the profile catalog ({len(catalog)} profiles)")
+
+
+def _report_stage(results: dict[str, Any]):
+    """Report what changed since the last run, the manifest was already updated by the profiles stages"""
+    built = _built_profiles(results)
+    changes = [change for key in sorted(built) for change in built[key].changes]
+    counts = Counter((x.slicer, x.action) for x in changes)
+    for key in sorted(built):
+        print(f"{key}: {counts[(key, 'add')]} profiles added, {counts[(key, 'remove')]} removed, "
+              f"{counts[(key, 'modify')]} modified since the last run")
+    if change_report_path is not None:
+        write_change_report(changes, change_report_path)
+        print(f"Wrote {len(changes)} profile changes to {change_report_path}")
 
-    # Squash slic3r based profiles
-    squash_slic3r_profiles("BambuStudio")
-    squash_slic3r_profiles("OrcaSlicer", "OrcaFilamentLibrary")
 
-    # TODO: Convert cura XML files to custom json
+def pipeline_stages(offline=False, only: Optional[Iterable[str]] = None) -> dict[str, Stage]:
+    """
+    The stages run() is made of
+    Each archive is fetched, each slicer's archives are extracted and turned into profiles,
+    the catalog is written and the changes are reported last.
+    :param offline: Don't download anything, only use the cached archives
+    :param only: Only include the stages of these slicers (by their lower case name)
+    :returns: The stages by their name
+    """
+    selected = None if only is None else {x.lower() for x in only}
+    stages: dict[str, Stage] = {}
+    for slicer_name in SLICER_ARCHIVES:
+        key = slicer_name.lower()
+        if selected is not None and key not in selected:
+            continue
+        fetches = []
+        for url, _, _ in SLICER_ARCHIVES[slicer_name]:
+            # Named after the repository, e.g. "fetch:OrcaSlicer"
+            name = f"fetch:{url.split('/')[4]}"
+            stages[name] = Stage(name, (), lambda _, url=url: fetch_archive(url, offline))
+            fetches.append(name)
+        stages[f"extract:{key}"] = Stage(f"extract:{key}", tuple(fetches),
+                                         lambda _, x=slicer_name: _extract_stage(x))
+        stages[f"profiles:{key}"] = Stage(f"profiles:{key}", (f"extract:{key}",),
+                                          lambda _, x=slicer_name: _profiles_stage(x))
+    built = tuple(x for x in stages if x.startswith("profiles:"))
+    stages["catalog"] = Stage("catalog", built, _catalog_stage)
+    stages["report"] = Stage("report", built, _report_stage)
+    return stages
+
+
+def plan_stages(stages: dict[str, Stage]) -> list[list[str]]:
+    """
+    Order the stages by their dependencies
+    :returns: The stages in waves, every stage of a wave only depends on stages of earlier waves
+    """
+    for stage in stages.values():
+        for dep in stage.deps:
+            if dep not in stages:
+                raise Exception(f"Stage '{stage.name}' depends on unknown stage '{dep}'")
+
+    waves: list[list[str]] = []
+    done: set[str] = set()
+    remaining = list(stages)
+    while remaining:
+        wave = [x for x in remaining if all(dep in done for dep in stages[x].deps)]
+        if not wave:
+            raise Exception(f"Stages with cyclic dependencies: {', '.join(remaining)}")
+        waves.append(wave)
+        done.update(wave)
+        remaining = [x for x in remaining if x not in done]
+    return waves
+
+
+def run_stages(stages: dict[str, Stage], max_workers: Optional[int] = None) -> dict[str, tuple[float, float]]:
+    """
+    Run the stages, each stage starts as soon as its dependencies finished
+    Stages run in threads, the CPU heavy stages use their own worker processes.
+    If a stage fails the stages depending on it are skipped, the others still run.
+    :param max_workers: The max number of stages running at the same time (default: no limit)
+    :returns: The finished stages mapped to (start, duration) in seconds, relative to the start of the run
+    """
+    plan_stages(stages)
+    results: dict[str, Any] = {}
+    timings: dict[str, tuple[float, float]] = {}
+    failed: list[str] = []
+    pending = dict(stages)
+    running: dict[Future, str] = {}
+    start = time.perf_counter()
+
+    def run_stage(stage: Stage) -> tuple[Any, float]:
+        stage_start = time.perf_counter()
+        timings[stage.name] = (stage_start - start, 0)
+        return stage.func(results), time.perf_counter() - stage_start
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dep in failed for dep in stage.deps):
+                    print(f"Skipping stage {name}, a stage it depends on failed")
+                    failed.append(name)
+                    del pending[name]
+                elif all(dep in results for dep in stage.deps):
+                    running[executor.submit(run_stage, stage)] = name
+                    del pending[name]
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name], duration = future.result()
+                    timings[name] = (timings[name][0], duration)
+                except Exception as e:
+                    print(f"Stage {name} failed: {e!r}")
+                    timings.pop(name, None)
+                    failed.append(name)
+
+    print(f"Stage timings ({time.perf_counter() - start:.2f} s total):")
+    for name, (stage_start, duration) in sorted(timings.items(), key=lambda x: x[1][0]):
+        print(f"  {name:<40} started at {stage_start:7.2f} s, took {duration:7.2f} s")
+    if failed:
+        raise Exception(f"{len(failed)} stages failed or were skipped: {', '.join(failed)}")
+    return timings
+
+
+def run(offline=False, only: Optional[Iterable[str]] = None, dry_run=False):
+    """
+    Run the download and extract routine, then write the catalog of every profile (see db_serializer.ProfileCatalog)
+    and the manifest of their hashes, which tells the next run which profiles changed
+    Independent stages overlap, e.g. OrcaSlicer is downloaded while the PrusaSlicer bundles are unpacked.
+    Set global var 'profile_output_path' to set the output path for the profiles
+    Set global var 'archive_cache_path' to set where the downloaded archives are cached
+    Set global var 'extracted_path' to set where the archives are extracted to
+    Set global var 'use_profile_store' to write the profiles to a store per slicer
+    Set global var 'change_report_path' to write the profiles that changed since the last run to a file
+    :param offline: Don't download anything, only use the cached archives
+    :param only: Only update the profiles of these slicers (by their lower case name)
+    :param dry_run: Only print the stages that would run
+    """
+    stages = pipeline_stages(offline, only)
+    if dry_run:
+        for idx, wave in enumerate(plan_stages(stages), 1):
+            for name in wave:
+                deps = f" (after {', '.join(stages[name].deps)})" if stages[name].deps else ""
+                print(f"{idx}. {name}{deps}")
+        return
+    run_stages(stages)
 
 
 # If running from the command line, provide argument parsing
@@ -344,9 +1288,29 @@ if __name__ == "__main__":
 
     parser = ArgumentParser()
     parser.add_argument("--profile-path", help="Set the output path for the extracted profiles")
+    parser.add_argument("--cache-path", help="Set the path of the downloaded archive cache")
+    parser.add_argument("--extract-path", help="Set the path the archives are extracted to")
+    parser.add_argument("--offline", action="store_true", help="Only use the cached archives, don't download anything")
+    parser.add_argument("--store", action="store_true",
+                        help="Write each slicer's profiles to a single compact store instead of a file per profile")
+    parser.add_argument("--report",
+                        help="Write the profiles that changed since the last run to this file, as JSON lines")
+    parser.add_argument("--only", action="append", choices=[x.lower() for x in SLICER_ARCHIVES],
+                        help="Only update the profiles of this slicer (can be repeated)")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the stages that would run")
+    parser.add_argument("--mirror",
+                        help="Download the archives from this server instead of GitHub, e.g. a local test server")
     args = parser.parse_args()
 
     if isinstance(args.profile_path, str):
         profile_output_path = Path(args.profile_path)
-
-    run()
+    if isinstance(args.cache_path, str):
+        archive_cache_path = Path(args.cache_path)
+    if isinstance(args.extract_path, str):
+        extracted_path = Path(args.extract_path)
+    archive_mirror = args.mirror
+    use_profile_store = args.store
+    if isinstance(args.report, str):
+        change_report_path = Path(args.report)
+
+    run(args.offline, args.only, args.dry_run)
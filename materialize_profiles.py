@@ -0,0 +1,272 @@
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from db_serializer import Brand, Material, Filament, load_brands_cached, cleanse_folder_name, CatalogProfile, \
+    load_profile_catalog, read_profile
+
+# The path of the squashed base profiles created by load_profiles.py
+profile_input_path = Path("./profiles")
+# The output path for the materialized profiles
+materialized_output_path = Path("./materialized_profiles")
+
+MANIFEST_FILE = "manifest.json"
+# Bump when the output format changes so every profile is regenerated
+MATERIALIZE_VERSION = 2
+
+# Slicers that profiles can be materialized for, and the extension of the files written for them
+SLICER_EXTENSIONS = {
+    "prusaslicer": ".ini",
+    "bambustudio": ".json",
+    "orcaslicer": ".json",
+}
+
+
+class MaterializeJob(NamedTuple):
+    key: str  # "<slicer>/<brand>/<material>/<filament>", used as the manifest key
+    name: str  # The profile name without the printer variant suffix
+    brand_name: str
+    overrides: dict
+
+
+# ---------------------------------
+# Materialization
+# ---------------------------------
+
+def apply_overrides(profile: dict, overrides: dict):
+    """
+    Apply overrides to a base profile
+    Slic3r JSON profiles store most values as lists (one per extruder), scalar overrides are expanded to match
+    """
+    for key, value in overrides.items():
+        current = profile.get(key)
+        if isinstance(value, list):
+            value = [str(x) for x in value]
+        elif isinstance(current, list):
+            value = [str(value)] * max(len(current), 1)
+        else:
+            value = str(value)
+        profile[key] = value
+
+
+def output_file_name(slicer_name: str, name: str, base: CatalogProfile) -> str:
+    file_name = name if not base.suffix else f"{name} @{base.suffix}"
+    return f"{cleanse_folder_name(file_name)}{SLICER_EXTENSIONS[slicer_name]}"
+
+
+def deepcopy_profile(profile: dict) -> dict:
+    """Profiles only contain strings and lists of strings, so copying the lists is enough"""
+    return {k: v.copy() if isinstance(v, list) else v for k, v in profile.items()}
+
+
+def materialize_profile(slicer_name: str, base_data: dict, job: MaterializeJob, base: CatalogProfile) -> str:
+    """
+    Create a ready to import profile from a base profile
+    :returns: The file contents
+    """
+    profile = deepcopy_profile(base_data)
+    apply_overrides(profile, job.overrides)
+    profile.pop("inherits", None)
+
+    full_name = job.name if not base.suffix else f"{job.name} @{base.suffix}"
+    if slicer_name == "prusaslicer":
+        profile["filament_settings_id"] = full_name
+        profile["filament_vendor"] = job.brand_name
+        return "".join(f"{k} = {v}\n" for k, v in profile.items())
+
+    profile.pop("setting_id", None)
+    profile["name"] = full_name
+    profile["from"] = "User"
+    profile["instantiation"] = "true"
+    profile["filament_settings_id"] = [full_name]
+    profile["filament_vendor"] = [job.brand_name]
+    return json.dumps(profile, indent=4)
+
+
+def _materialize_group(slicer_name: str, bases: list[CatalogProfile], jobs: list[MaterializeJob],
+                       input_root: str, output_root: str) -> dict[str, list[str]]:
+    """
+    Materialize every job that shares a base profile, each printer variant of the base profile is loaded once
+    :returns: The job keys mapped to the files written for them, relative to output_root
+    """
+    written: dict[str, list[str]] = {job.key: [] for job in jobs}
+    for base in bases:
+        base_data = read_profile(input_root, slicer_name, base.path)
+        if base_data is None:
+            print(f"Failed to read {slicer_name} base profile {base.path}")
+            continue
+
+        out_folder = Path(output_root, slicer_name, base.vendor)
+        out_folder.mkdir(parents=True, exist_ok=True)
+        for job in jobs:
+            out_path = out_folder.joinpath(output_file_name(slicer_name, job.name, base))
+            with out_path.open("w", encoding="utf-8") as f:
+                f.write(materialize_profile(slicer_name, base_data, job, base))
+            written[job.key].append(out_path.relative_to(output_root).as_posix())
+    return written
+
+
+def job_hash(job: MaterializeJob, profile_name: str, bases: list[CatalogProfile]) -> str:
+    """Hash everything a materialized profile depends on, base profiles are identified by their content hash"""
+    base_signatures = [[base.vendor, base.suffix, base.path, base.hash] for base in bases]
+
+    data = json.dumps({
+        "version": MATERIALIZE_VERSION,
+        "name": job.name,
+        "brand": job.brand_name,
+        "profile_name": profile_name,
+        "overrides": job.overrides,
+        "bases": base_signatures
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def iter_filaments(brands: list[Brand]):
+    for brand in brands:
+        for material in brand.materials:
+            for filament in material.filaments:
+                yield brand, material, filament
+
+
+def profile_display_name(brand: Brand, material: Material, filament: Filament) -> str:
+    """The profile name shown in the slicer, the material is included when the filament name doesn't contain it"""
+    if material.material_name.lower() in filament.name.lower():
+        return f"{brand.brand_name} {filament.name}"
+    return f"{brand.brand_name} {material.material_name} {filament.name}"
+
+
+def load_manifest() -> dict[str, dict]:
+    path = materialized_output_path.joinpath(MANIFEST_FILE)
+    if not path.exists():
+        return {}
+    try:
+        with path.open(encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if manifest.get("version") != MATERIALIZE_VERSION:
+        return {}
+    return manifest.get("entries", {})
+
+
+def materialize_profiles(brands: list[Brand], slicers: Optional[list[str]] = None, force=False,
+                         max_workers: Optional[int] = None):
+    """
+    Materialize slicer profiles for every filament that has slicer settings
+    Only filaments whose settings or base profiles changed since the last run are regenerated
+    Filaments whose profiles would be written to the same files as the profiles of another filament are skipped
+    Set global vars 'profile_input_path' and 'materialized_output_path' to change the input/output paths
+    :param brands: The brands to materialize the profiles of
+    :param slicers: The slicers to materialize profiles for (default: all supported slicers)
+    :param force: Regenerate every profile, even if it is up to date (stale profiles are still removed)
+    :param max_workers: The max number of worker processes
+    """
+    if slicers is None:
+        slicers = list(SLICER_EXTENSIONS)
+
+    old_entries = load_manifest()
+    entries: dict[str, dict] = {}
+    # The files that are written, relative to the output path, mapped to the job key they are written for
+    owners: dict[str, str] = {}
+    # (slicer, profile_name) -> jobs that need to be (re)generated
+    groups: dict[tuple[str, str], list[MaterializeJob]] = {}
+    missing: set[tuple[str, str]] = set()
+
+    catalog = load_profile_catalog(profile_input_path)
+    for slicer_name in slicers:
+        if slicer_name not in catalog.slicers:
+            print(f"No profiles found for {slicer_name} in {profile_input_path}, run load_profiles.py first")
+            continue
+
+        for brand, material, filament in iter_filaments(brands):
+            specific = filament.get_resolved_slicer_settings().get_slicer_data(slicer_name)
+            if specific is None:
+                continue
+            bases = catalog.find(slicer_name, specific.profile_name)
+            if not bases:
+                missing.add((slicer_name, specific.profile_name))
+                continue
+
+            key = "/".join(cleanse_folder_name(x) for x in
+                           (slicer_name, brand.brand_name, material.material_name, filament.name))
+            job = MaterializeJob(key, profile_display_name(brand, material, filament), brand.brand_name,
+                                 dict(specific.overrides))
+            digest = job_hash(job, specific.profile_name, bases)
+
+            # Different names can end up as the same key or file name after cleansing
+            if key in entries:
+                print(f"Skipping {key}, another filament has the same brand, material and filament names")
+                continue
+            paths = {f"{slicer_name}/{base.vendor}/{output_file_name(slicer_name, job.name, base)}" for base in bases}
+            clash = next((owners[x] for x in sorted(paths) if x in owners), None)
+            if clash is not None:
+                print(f"Skipping {key}, its profiles would overwrite the profiles of {clash}")
+                continue
+            owners.update(dict.fromkeys(paths, key))
+
+            old = old_entries.get(key)
+            if not force and old is not None and old["hash"] == digest and all(
+                    materialized_output_path.joinpath(x).exists() for x in old["files"]):
+                entries[key] = old
+                continue
+            entries[key] = {"hash": digest, "files": []}
+            groups.setdefault((slicer_name, specific.profile_name), []).append(job)
+
+    for slicer_name, profile_name in sorted(missing):
+        print(f"No {slicer_name} base profile named '{profile_name}'")
+
+    job_count = sum(len(x) for x in groups.values())
+    print(f"Materializing {job_count} filament profiles ({len(entries) - job_count} up to date)...")
+
+    if groups:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_materialize_group, slicer_name, catalog.find(slicer_name, profile_name), jobs,
+                                str(profile_input_path), str(materialized_output_path))
+                for (slicer_name, profile_name), jobs in groups.items()
+            ]
+            for future in futures:
+                for key, files in future.result().items():
+                    entries[key]["files"] = files
+
+    # Remove files that are no longer produced by any filament
+    current_files = {x for entry in entries.values() for x in entry["files"]}
+    removed = 0
+    for entry in old_entries.values():
+        for rel_path in entry["files"]:
+            if rel_path in current_files:
+                continue
+            path = materialized_output_path.joinpath(rel_path)
+            if path.exists():
+                path.unlink()
+                removed += 1
+    if removed:
+        print(f"Removed {removed} stale profiles")
+
+    materialized_output_path.mkdir(parents=True, exist_ok=True)
+    with materialized_output_path.joinpath(MANIFEST_FILE).open("w", encoding="utf-8") as f:
+        json.dump({"version": MATERIALIZE_VERSION, "entries": entries}, f, indent=4, sort_keys=True)
+
+
+# If running from the command line, provide argument parsing
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--data-path", default="data", help="Set the path of the filament database")
+    parser.add_argument("--profile-path", help="Set the path of the squashed base profiles")
+    parser.add_argument("--output-path", help="Set the output path for the materialized profiles")
+    parser.add_argument("--slicer", action="append", choices=list(SLICER_EXTENSIONS),
+                        help="Only materialize profiles for this slicer (can be repeated)")
+    parser.add_argument("--force", action="store_true", help="Regenerate every profile, even if it is up to date")
+    parser.add_argument("--workers", type=int, help="Max number of worker processes")
+    args = parser.parse_args()
+
+    if isinstance(args.profile_path, str):
+        profile_input_path = Path(args.profile_path)
+    if isinstance(args.output_path, str):
+        materialized_output_path = Path(args.output_path)
+
+    materialize_profiles(load_brands_cached(args.data_path), args.slicer, args.force, args.workers)